@@ -10,6 +10,34 @@ import os
 import time
 import json
 import getpass
+import re
+import math
+import select
+import errno
+import shlex
+import struct
+import ctypes
+import ctypes.util
+import fcntl
+import mmap
+import hashlib
+import shutil
+import queue
+import threading
+import http.client
+import urllib.parse
+import socket
+import socketserver
+import sqlite3
+import tempfile
+import zlib
+import abc
+import atexit
+import contextlib
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from itertools import compress
 from pathlib import Path
 from datetime import datetime
 
@@ -19,7 +47,62 @@ MOUNT_DIR = HOME / "nicenano_mount"
 DOWNLOADS = HOME / "Downloads" / "zmk-firmware"
 PASS_FILE = HOME / "pss_file"
 VERSION_FILE = DOWNLOADS / ".version.json"
+HISTORY_DB = DOWNLOADS / "history.db"
+STORE_MAX_BUILDS = 10  # сколько сборок хранить локально (LRU)
+WATCH_ACTIVE_INTERVAL = 10  # сек, интервал опроса CI, пока сборка идет
+WATCH_IDLE_INTERVAL = 30  # сек, начальный интервал опроса без активных сборок
+WATCH_MAX_INTERVAL = 300  # сек, предел роста интервала, пока ничего не меняется
+WATCH_BACKOFF = 1.5  # во сколько раз растет интервал после опроса без изменений
+WATCH_RATE_RESERVE = 20  # запросов API, которые watch оставляет в запасе до сброса лимита
+HELPER_START_TIMEOUT = 15  # сек, ожидание запуска привилегированного помощника
+STATION_WORKERS = 4  # параллельных прошивок в режиме станции
+DEVICE_GONE_TIMEOUT = 30  # сек, ожидание перезагрузки контроллера после прошивки
 REPO = "mshegolev/zmk-config-s"
+GITHUB_API = os.environ.get("SOFLE_GITHUB_API", "https://api.github.com")
+CACHE_DIR = HOME / ".cache" / "sofle-flash"
+API_CACHE_FILE = CACHE_DIR / "api_cache.json"
+TAG_INDEX_FILE = CACHE_DIR / "tag_index.json"
+SPANS_FILE = CACHE_DIR / "spans.jsonl"
+KEYMAP_CACHE_FILE = CACHE_DIR / "keymap_ast.json"
+KEYMAP_AST_VERSION = 1  # увеличить при изменении формата AST
+CONFIG_DIR = Path(__file__).resolve().parent.parent / "config"
+KEYMAP_FILE = CONFIG_DIR / "sofle.keymap"
+BUILD_MATRIX_FILE = CONFIG_DIR.parent / "build.yaml"
+BUILD_CACHE_DIR = CACHE_DIR / "builds"
+# Команда сборки одного элемента матрицы (запускается из корня репозитория).
+# Подстановки: {board} {shield} {cmake_args} {config} {build_dir} {output}
+LOCAL_BUILD_COMMAND = ("west build -p auto -s zmk/app -d {build_dir} -b {board} -- "
+                       "-DSHIELD={shield} -DZMK_CONFIG={config} {cmake_args}")
+SPANS_MAX_BYTES = 8 * 1024 * 1024  # при превышении в журнале остается свежая половина
+SWEEP_CACHE_FILE = CACHE_DIR / "sweep_cache.json"
+FLASH_LEDGER_FILE = CACHE_DIR / "flash_ledger.json"  # прежний JSON-журнал прошивок (переносится в HISTORY_DB)
+HELPER_LOG_FILE = CACHE_DIR / "helper.log"  # stderr sudo и привилегированного помощника
+BOOTLOADER_LABEL = "NICENANO"
+# USB Vendor ID UF2 bootloader'а nice!nano (Adafruit nRF52 bootloader, 239a:00b3)
+BOOTLOADER_USB_VENDORS = {'239a'}
+DRIVE_POLL_INTERVAL = 0.25  # сек, интервал опроса если нет уведомлений ОС
+AUTOMOUNT_GRACE = 2.0  # сек, сколько ждать автомонтирования, прежде чем взять диск как /dev/<device>
+UF2_BLOCK_SIZE = 512
+WRITE_CHUNK_BLOCKS = 64  # блоков UF2 за одну запись (32 КБ)
+
+# Артефакты сборки (см. build.yaml): ключ прошивки -> префикс файла
+FIRMWARE_TARGETS = {
+    'left': 'sofle_left',
+    'right': 'sofle_right',
+    'reset': 'settings_reset'
+}
+
+FIRMWARE_HALVES = ('left', 'right')
+
+# Формат UF2 (https://github.com/microsoft/uf2)
+UF2_MAGIC_START0 = 0x0A324655
+UF2_MAGIC_START1 = 0x9E5D5157
+UF2_MAGIC_END = 0x0AB16F30
+UF2_FLAG_FAMILY_ID = 0x00002000
+UF2_MAX_PAYLOAD = 476
+NRF52840_FAMILY_ID = 0xADA52840
+# Область приложения nice!nano v2: после SoftDevice S140 и до bootloader'а
+NRF52840_APP_RANGE = (0x00026000, 0x000F4000)
 
 # Цвета для терминала
 class Colors:
@@ -34,36 +117,536 @@ def print_color(text, color=Colors.NC):
     """Печать текста с цветом"""
     print(f"{color}{text}{Colors.NC}")
 
+def timestamp():
+    """Текущая временная метка"""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def get_option(name, default=None):
+    """Значение опции командной строки вида --name VALUE"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def get_arguments(flags=()):
+    """Позиционные аргументы после команды (без опций и их значений)"""
+    args = []
+    rest = iter(sys.argv[2:])
+    for arg in rest:
+        if arg.startswith('--'):
+            if arg not in flags:
+                next(rest, None)
+        else:
+            args.append(arg)
+    return args
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 файла чтением по chunk_size (hashlib.file_digest есть только с Python 3.11)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def percentile(values, q):
+    """Перцентиль q (0-100) с линейной интерполяцией"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+def version_key(tag):
+    """Ключ сортировки тегов вида v1.2.3"""
+    numbers = re.findall(r'\d+', tag or '')
+    return tuple(int(n) for n in numbers[:3]) + (tag or '',)
+
+# ===== Процессы и ввод-вывод =====
+class CommandExecutor:
+    """Запуск внешних команд без shell с учетом каждого вызова.
+
+    Для каждого вызова сохраняются длительность, код возврата и объем
+    вывода - по отчету (--profile) видно, какие внешние вызовы съедают время.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, name, ms, returncode, out_bytes=0):
+        with self._lock:
+            self.calls.append({'cmd': name, 'ms': ms, 'rc': returncode, 'out_bytes': out_bytes})
+
+    @staticmethod
+    def command_name(argv):
+        """Имя для отчета: утилита + подкоманда (gh run, diskutil eject)"""
+        name = Path(argv[0]).name
+        if len(argv) > 1 and not argv[1].startswith('-'):
+            name += f" {argv[1]}"
+        return name
+
+    def run(self, argv, capture=True, input_data=None):
+        """subprocess.run без shell; возвращает CompletedProcess"""
+        start = time.monotonic()
+        try:
+            result = subprocess.run(argv, capture_output=capture, text=True, input=input_data)
+        except OSError:
+            self.record(self.command_name(argv), (time.monotonic() - start) * 1000, 127)
+            raise
+        out_bytes = len(result.stdout or '') + len(result.stderr or '') if capture else 0
+        self.record(self.command_name(argv), (time.monotonic() - start) * 1000, result.returncode, out_bytes)
+        return result
+
+    def print_report(self):
+        """Сводка по внешним вызовам, отсортированная по суммарному времени"""
+        with self._lock:
+            calls = list(self.calls)
+        if not calls:
+            print("ℹ️  Внешних вызовов не было")
+            return
+
+        summary = {}
+        for call in calls:
+            item = summary.setdefault(call['cmd'], {'count': 0, 'ms': 0.0, 'max': 0.0, 'failed': 0, 'bytes': 0})
+            item['count'] += 1
+            item['ms'] += call['ms']
+            item['max'] = max(item['max'], call['ms'])
+            item['failed'] += call['rc'] != 0
+            item['bytes'] += call['out_bytes']
+
+        print("━" * 80)
+        print_color("⏱️  ВНЕШНИЕ ВЫЗОВЫ", Colors.BLUE)
+        print("━" * 80)
+        print(f"{'Команда':<28} {'Вызовов':>8} {'Всего, мс':>11} {'Макс, мс':>10} {'Ошибок':>7} {'Вывод':>10}")
+        for name, item in sorted(summary.items(), key=lambda kv: kv[1]['ms'], reverse=True):
+            print(f"{name:<28} {item['count']:>8} {item['ms']:>11.1f} {item['max']:>10.1f} "
+                  f"{item['failed']:>7} {format_size(item['bytes']):>10}")
+        print()
+
+EXECUTOR = CommandExecutor()
+
 def run_command(cmd, capture=True, check=True, input_data=None):
-    """Выполнение команды с обработкой ошибок"""
+    """Выполнение команды (список аргументов, без shell) с обработкой ошибок"""
     try:
+        result = EXECUTOR.run(cmd, capture=capture, input_data=input_data)
         if capture:
-            result = subprocess.run(
-                cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                input=input_data
-            )
             if check and result.returncode != 0:
                 return None, result.stderr
             return result.stdout.strip(), result.stderr
-        else:
-            result = subprocess.run(cmd, shell=True, check=check)
-            return result.returncode == 0, None
-    except subprocess.CalledProcessError as e:
-        return None, str(e)
+        return result.returncode == 0, None
     except Exception as e:
         return None, str(e)
 
-def timestamp():
-    """Текущая временная метка"""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def device_for_mount(mount_point):
+    """Блочное устройство смонтированной ФС (без df): 'disk4', 'sdb' или None"""
+    mount_point = os.path.realpath(mount_point)
+
+    # Linux: таблица монтирования процесса
+    mountinfo = Path("/proc/self/mountinfo")
+    if mountinfo.exists():
+        for line in mountinfo.read_text().splitlines():
+            fields = line.split()
+            if len(fields) > 4 and _unescape_mountinfo(fields[4]) == mount_point:
+                source = fields[fields.index('-') + 2]
+                return source.replace('/dev/', '') if source.startswith('/dev/') else None
+        return None
+
+    # macOS/BSD: устройство, чей st_rdev совпадает с st_dev точки монтирования
+    st_dev = os.stat(mount_point).st_dev
+    with os.scandir("/dev") as entries:
+        for entry in entries:
+            if not entry.name.startswith("disk"):
+                continue
+            try:
+                if os.stat(entry.path).st_rdev == st_dev:
+                    return entry.name
+            except OSError:
+                continue
+    return None
+
+def wait_device_gone(device, timeout=DEVICE_GONE_TIMEOUT):
+    """Ожидание исчезновения узла /dev/<device> (контроллер перезагрузился)"""
+    deadline = time.monotonic() + timeout
+    with TELEMETRY.span("flash.disconnect", device=device) as span:
+        while os.path.exists(f"/dev/{device}"):
+            if time.monotonic() >= deadline:
+                span['outcome'] = 'timeout'
+                return False
+            time.sleep(DRIVE_POLL_INTERVAL)
+    return True
+
+def _sysfs_usb_device(device):
+    """Каталог sysfs USB-устройства, которому принадлежит блочное устройство, или None"""
+    block = Path("/sys/class/block") / device
+    if not block.exists():
+        return None
+    for parent in block.resolve().parents:
+        if (parent / "idVendor").exists():
+            return parent
+    return None
+
+def device_serial(device):
+    """Серийный номер USB-устройства, которому принадлежит диск, или None"""
+    # Linux: ближайший предок блочного устройства в sysfs с idVendor/serial
+    if Path("/sys/class/block").is_dir():
+        usb = _sysfs_usb_device(device)
+        serial = usb / "serial" if usb else None
+        if not serial or not serial.exists():
+            return None
+        return serial.read_text().strip() or None
+
+    # macOS: дерево USB-устройств ioreg, диск - потомок своего устройства
+    if sys.platform == "darwin":
+        out, _ = run_command(["ioreg", "-r", "-c", "IOUSBHostDevice", "-l", "-w0"])
+        serial = None
+        for line in (out or '').splitlines():
+            if "<class IOUSBHostDevice" in line:
+                serial = None
+            match = re.search(r'"(USB Serial Number|BSD Name)" = "([^"]*)"', line)
+            if not match:
+                continue
+            if match.group(1) == "USB Serial Number":
+                serial = match.group(2)
+            elif match.group(2) == device:
+                return serial
+    return None
+
+def device_usb_vendor(device):
+    """USB Vendor ID (hex, '239a') устройства, которому принадлежит диск, или None"""
+    if Path("/sys/class/block").is_dir():
+        usb = _sysfs_usb_device(device)
+        if not usb:
+            return None
+        return (usb / "idVendor").read_text().strip().lower()
+
+    # macOS: как в device_serial, idVendor в ioreg - десятичное число
+    if sys.platform == "darwin":
+        disk = re.sub(r's\d+$', '', device)
+        out, _ = run_command(["ioreg", "-r", "-c", "IOUSBHostDevice", "-l", "-w0"])
+        vendor = None
+        for line in (out or '').splitlines():
+            if "<class IOUSBHostDevice" in line:
+                vendor = None
+            match = re.search(r'"idVendor" = (\d+)', line)
+            if match:
+                vendor = f"{int(match.group(1)):04x}"
+            match = re.search(r'"BSD Name" = "([^"]*)"', line)
+            if match and match.group(1) == disk:
+                return vendor
+    return None
+
+class DeviceBackend(abc.ABC):
+    """Платформенные операции с диском bootloader'а.
+
+    Flasher и DriveWatcher работают с устройствами только через этот
+    интерфейс (симулятор подменяет его своим):
+      • for_mount, serial, wait_gone - поиск устройства и ожидание перезагрузки
+      • bootloader_devices - диски bootloader'а, которые никто не смонтировал
+      • is_bootloader - принадлежит ли диск bootloader'у (по USB Vendor ID)
+      • unmount/mount/eject - выполняются помощником от root, возвращают (ok, out, err)
+    """
+
+    name = None
+    for_mount = staticmethod(device_for_mount)
+    wait_gone = staticmethod(wait_device_gone)
+    serial = staticmethod(device_serial)
+    usb_vendor = staticmethod(device_usb_vendor)
+
+    def bootloader_devices(self):
+        return []
+
+    def is_bootloader(self, device):
+        return self.usb_vendor(device) in BOOTLOADER_USB_VENDORS
+
+    @abc.abstractmethod
+    def unmount(self, path, force=False):
+        """Отмонтирование тома: (ok, out, err)"""
+
+    @abc.abstractmethod
+    def mount(self, device, target, uid=None, gid=None):
+        """Монтирование устройства в target: (ok, out, err)"""
+
+    @abc.abstractmethod
+    def eject(self, path):
+        """Извлечение диска: (ok, out, err)"""
+
+    @abc.abstractmethod
+    def mount_hint(self, device, target):
+        """Команда для ручного монтирования (подсказка при ошибке)"""
+
+    @abc.abstractmethod
+    def unmount_hint(self, volume):
+        """Команда для ручного unmount (подсказка при ошибке)"""
+
+class MacDevices(DeviceBackend):
+    """macOS: diskutil и mount_msdos (диск сам монтируется в /Volumes)"""
+
+    name = 'macos'
+
+    def unmount(self, path, force=False):
+        return _run_tool(["diskutil", "unmount"] + (["force"] if force else []) + [path])
+
+    def mount(self, device, target, uid=None, gid=None):
+        return _run_tool(["mount", "-t", "msdos", "-o", "rw,auto,nobrowse", device, target])
+
+    def eject(self, path):
+        return _run_tool(["diskutil", "eject", path])
+
+    def mount_hint(self, device, target):
+        return f"sudo mount -t msdos /dev/{device} {target}"
+
+    def unmount_hint(self, volume):
+        return f"sudo diskutil unmount force {volume}"
+
+class LinuxDevices(DeviceBackend):
+    """Linux: sysfs, /proc/self/mountinfo и системные вызовы mount(2)/umount2(2).
+
+    Диск bootloader'а находится по USB Vendor ID в sysfs, поэтому станция
+    без автомонтирования тоже его видит: такой диск приходит как /dev/sdX,
+    unmount для него - пустая операция. Внешние утилиты не запускаются;
+    длительность вызовов попадает в отчет --profile как "mount(2)"/"umount2(2)".
+    """
+
+    name = 'linux'
+    MS_NOSUID = 2
+    MS_NODEV = 4
+    MS_NOEXEC = 8
+    MNT_DETACH = 2
+
+    def __init__(self):
+        self._libc = None
+
+    def _syscall(self, name, *args):
+        """Вызов функции libc с учетом в EXECUTOR: (ok, out, err)"""
+        if self._libc is None:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        start = time.monotonic()
+        rc = getattr(self._libc, name)(*args)
+        err = os.strerror(ctypes.get_errno()) if rc != 0 else ''
+        EXECUTOR.record(f"{name}(2)", (time.monotonic() - start) * 1000, rc)
+        return rc == 0, '', err
+
+    @staticmethod
+    def mount_points(device):
+        """Точки монтирования устройства /dev/<device> по mountinfo"""
+        points = []
+        for line in Path("/proc/self/mountinfo").read_text().splitlines():
+            fields = line.split()
+            if len(fields) > 4 and fields[fields.index('-') + 2] == f"/dev/{device}":
+                points.append(_unescape_mountinfo(fields[4]))
+        return points
+
+    def for_mount(self, path):
+        path = str(path)
+        if path.startswith("/dev/"):
+            device = path[len("/dev/"):]
+            return device if (Path("/sys/class/block") / device).exists() else None
+        return device_for_mount(path)
+
+    def bootloader_devices(self):
+        found = []
+        block = Path("/sys/class/block")
+        if not block.is_dir():
+            return found
+        for entry in block.iterdir():
+            # У nice!nano ФС на всем диске, без таблицы разделов
+            if (entry / "partition").exists() or any(entry.glob(f"{entry.name}*[0-9]")):
+                continue
+            try:
+                if int((entry / "size").read_text()) == 0:
+                    continue
+            except (OSError, ValueError):
+                continue
+            if not self.is_bootloader(entry.name):
+                continue
+            if not self.mount_points(entry.name):
+                found.append(entry.name)
+        return sorted(found)
+
+    def unmount(self, path, force=False):
+        # Для /dev/sdX снимаются все его точки монтирования (обычно ни одной)
+        targets = self.mount_points(path[len("/dev/"):]) if path.startswith("/dev/") else [path]
+        ok, out, err = True, '', ''
+        for target in targets:
+            ok, out, err = self._syscall("umount2", target.encode(), self.MNT_DETACH if force else 0)
+            if not ok:
+                break
+        return ok, out, err
+
+    def mount(self, device, target, uid=None, gid=None):
+        # flush - vfat сбрасывает данные на диск сразу, а не при unmount
+        options = "flush" + (f",uid={uid}" if uid is not None else '') + (f",gid={gid}" if gid is not None else '')
+        return self._syscall("mount", device.encode(), str(target).encode(), b"vfat",
+                             ctypes.c_ulong(self.MS_NOSUID | self.MS_NODEV | self.MS_NOEXEC),
+                             options.encode())
+
+    def eject(self, path):
+        # Отдельного eject нет: unmount дописывает FAT, bootloader перезагружается сам
+        return self.unmount(path)
+
+    def mount_hint(self, device, target):
+        return f"sudo mount -t vfat -o uid={os.getuid()},flush /dev/{device} {target}"
+
+    def unmount_hint(self, volume):
+        return f"sudo umount -l {volume}"
+
+HOST_DEVICES = LinuxDevices() if sys.platform.startswith("linux") else MacDevices()
+
+# ===== Телеметрия =====
+class Telemetry:
+    """Замеры фаз (спаны) сессий прошивки и скачивания.
+
+    Спан - {'session', 'command', 'name', 'start', 'seconds', 'outcome', ...атрибуты}.
+    В конце сессии спаны дописываются в SPANS_FILE (JSON lines); с опцией
+    --metrics FILE сводка по всем сессиям сохраняется в формате OpenMetrics.
+    Команда stats показывает p50/p95/p99 по фазам.
+    """
+
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, path=SPANS_FILE):
+        self.path = Path(path)
+        self.session = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.command = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, outcome='ok', start=None, **attrs):
+        """Спан по уже измеренной длительности"""
+        span = {
+            'session': self.session,
+            'command': self.command,
+            'name': name,
+            'start': start if start is not None else time.time() - seconds,
+            'seconds': round(seconds, 6),
+            'outcome': outcome
+        }
+        span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Замер блока кода. Блок может изменить attrs (например, attrs['outcome'])"""
+        start = time.time()
+        started = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield attrs
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            attrs.setdefault('outcome', outcome)
+            self.record(name, time.monotonic() - started, start=start, **attrs)
+
+    def flush(self):
+        """Запись спанов сессии в журнал и (с --metrics) экспорт OpenMetrics"""
+        with self._lock:
+            spans, self.spans = self.spans, []
+        if spans:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as f:
+                for span in spans:
+                    f.write(json.dumps(span, ensure_ascii=False) + "\n")
+            self._trim()
+
+        metrics_file = get_option('--metrics')
+        if metrics_file:
+            Path(metrics_file).write_text(self.openmetrics(self.load()))
+
+    def _trim(self):
+        """Ограничение размера журнала: остается свежая половина"""
+        if self.path.stat().st_size <= SPANS_MAX_BYTES:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(-SPANS_MAX_BYTES // 2, os.SEEK_END)
+            tail = f.read()
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_bytes(tail[tail.find(b"\n") + 1:])
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """Все спаны из журнала (поврежденные строки пропускаются)"""
+        spans = []
+        if not self.path.exists():
+            return spans
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+        return spans
+
+    @classmethod
+    def aggregate(cls, spans):
+        """Сводка по фазам: {name: {'count', 'errors', 'sum', 'p50', 'p95', 'p99'}}"""
+        by_name = {}
+        for span in spans:
+            by_name.setdefault(span['name'], []).append(span)
+        summary = {}
+        for name, items in sorted(by_name.items()):
+            durations = [span['seconds'] for span in items]
+            stats = {
+                'count': len(items),
+                'errors': sum(1 for span in items if span['outcome'] != 'ok'),
+                'sum': sum(durations)
+            }
+            for q in cls.QUANTILES:
+                stats[f"p{q}"] = percentile(durations, q)
+            summary[name] = stats
+        return summary
+
+    @classmethod
+    def openmetrics(cls, spans):
+        """Сводка в текстовом формате OpenMetrics"""
+        lines = [
+            "# TYPE sofle_phase_seconds summary",
+            "# UNIT sofle_phase_seconds seconds",
+            "# HELP sofle_phase_seconds Duration of flash/download phases."
+        ]
+        summary = cls.aggregate(spans)
+        for name, stats in summary.items():
+            for q in cls.QUANTILES:
+                lines.append(f'sofle_phase_seconds{{phase="{name}",quantile="{q / 100}"}} {stats[f"p{q}"]:.6f}')
+            lines.append(f'sofle_phase_seconds_sum{{phase="{name}"}} {stats["sum"]:.6f}')
+            lines.append(f'sofle_phase_seconds_count{{phase="{name}"}} {stats["count"]}')
+        lines.append("# TYPE sofle_phase_errors counter")
+        lines.append("# HELP sofle_phase_errors Phases that ended with an error.")
+        for name, stats in summary.items():
+            lines.append(f'sofle_phase_errors_total{{phase="{name}"}} {stats["errors"]}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def print_stats(self):
+        """Команда stats: перцентили по фазам за все сессии"""
+        spans = self.load()
+        if not spans:
+            print_color(f"ℹ️  Замеров пока нет ({self.path})", Colors.BLUE)
+            return
+        sessions = {span['session'] for span in spans}
+        print("━" * 80)
+        print_color(f"📊 ФАЗЫ: {len(spans)} замеров, {len(sessions)} сессий", Colors.BLUE)
+        print("━" * 80)
+        print(f"{'Фаза':<22} {'N':>6} {'Ошибок':>7} {'p50, с':>9} {'p95, с':>9} {'p99, с':>9} {'Всего, с':>10}")
+        for name, stats in self.aggregate(spans).items():
+            print(f"{name:<22} {stats['count']:>6} {stats['errors']:>7} {stats['p50']:>9.3f} "
+                  f"{stats['p95']:>9.3f} {stats['p99']:>9.3f} {stats['sum']:>10.1f}")
+        print()
+        print(f"💾 Журнал: {self.path}")
+
+TELEMETRY = Telemetry()
 
 # ===== Управление паролем sudo =====
 class SudoManager:
     def __init__(self):
         self.password = None
+        self.helper = None
 
     def load_password(self):
         """Загрузка пароля из файла или запрос у пользователя"""
@@ -107,465 +690,4707 @@ class SudoManager:
         return True
 
     def _verify_password(self):
-        """Проверка пароля sudo"""
-        result, _ = run_command(f"echo '{self.password}' | sudo -S -v", check=False)
-        return result is not None
+        """Проверка пароля sudo: запуск помощника на всю сессию"""
+        if self.helper:
+            self.helper.stop()
+        self.helper = PrivilegedHelper()
+        if self.helper.start(self.password):
+            return True
+        self.helper = None
+        return False
+
+    def batch(self, ops, stop_on_error=False):
+        """Пакет привилегированных операций через помощника"""
+        results = self.helper.batch(ops, stop_on_error=stop_on_error)
+        for result in results:
+            EXECUTOR.record(f"helper {result['op']}", result['ms'], 0 if result['ok'] else 1,
+                            len(result['out']) + len(result['err']))
+        return results
+
+    def call(self, op, **params):
+        """Одна привилегированная операция через помощника"""
+        return self.batch([dict(params, op=op)])[0]
+
+# ===== Привилегированный помощник =====
+def _run_tool(argv):
+    """Запуск системной утилиты без shell: (ok, out, err)"""
+    result = EXECUTOR.run(argv)
+    return result.returncode == 0, result.stdout.strip(), result.stderr.strip()
+
+def _helper_mount_dir_path(path, mount_dir):
+    """Путь внутри каталога монтирования (разрешенный) или None"""
+    resolved = Path(os.path.realpath(path))
+    return resolved if resolved == mount_dir or mount_dir in resolved.parents else None
+
+def _helper_bootloader_device(path):
+    """Имя диска bootloader'а по /dev/<диск>; PermissionError для любого другого устройства"""
+    resolved = Path(os.path.realpath(path))
+    if resolved.parent != Path("/dev") or not HOST_DEVICES.is_bootloader(resolved.name):
+        raise PermissionError(f"{path}: не диск bootloader'а")
+    return resolved
+
+def _helper_volume(path, mount_dir):
+    """Путь для unmount/eject: каталог монтирования, том NICENANO или сам диск bootloader'а"""
+    inside = _helper_mount_dir_path(path, mount_dir)
+    if inside:
+        return str(inside)
+    resolved = Path(os.path.realpath(path))
+    if resolved.parent == Path("/dev"):
+        return str(_helper_bootloader_device(resolved))
+    device = HOST_DEVICES.for_mount(resolved) if BOOTLOADER_LABEL in resolved.name.upper() else None
+    if not device or not HOST_DEVICES.is_bootloader(device):
+        raise PermissionError(f"{path}: не том bootloader'а и не каталог {mount_dir}")
+    return str(resolved)
+
+def _helper_execute(request, mount_dir):
+    """Выполнение одной операции помощника (от root).
+
+    Работает только с дисками bootloader'а (по USB Vendor ID) и путями
+    внутри mount_dir или на томе NICENANO - остальное отклоняется.
+    """
+    op = request.get('op')
+    start = time.monotonic()
+    ok, out, err = False, '', ''
+    try:
+        if op == 'unmount':
+            ok, out, err = HOST_DEVICES.unmount(_helper_volume(request['path'], mount_dir),
+                                                force=bool(request.get('force', False)))
+        elif op == 'mount':
+            device = _helper_bootloader_device(request['device'])
+            target = _helper_mount_dir_path(request['target'], mount_dir)
+            if not target:
+                raise PermissionError(f"{request['target']}: монтирование только в {mount_dir}")
+            uid, gid = request.get('uid'), request.get('gid')
+            ok, out, err = HOST_DEVICES.mount(str(device), str(target),
+                                              uid=None if uid is None else int(uid),
+                                              gid=None if gid is None else int(gid))
+        elif op == 'eject':
+            ok, out, err = HOST_DEVICES.eject(_helper_volume(request['path'], mount_dir))
+        elif op == 'ping':
+            ok, out = True, 'pong'
+        else:
+            err = f"неизвестная операция: {op}"
+    except Exception as e:
+        ok, err = False, str(e)
+    return {
+        'op': op,
+        'ok': ok,
+        'out': out,
+        'err': err,
+        'ms': (time.monotonic() - start) * 1000
+    }
+
+class _HelperRequestHandler(socketserver.StreamRequestHandler):
+    """Обработка пакетов операций: одна JSON-строка - один пакет.
+
+    Первое соединение - управляющее (его открывает PrivilegedHelper.start):
+    когда оно закрывается, помощник завершается. Отдельной команды
+    остановки нет, остальные соединения могут только выполнять операции.
+    """
+
+    def handle(self):
+        with self.server.owner_lock:
+            if self.server.owner is None:
+                self.server.owner = self
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                results = []
+                for op in request.get('ops', []):
+                    result = _helper_execute(op, self.server.mount_dir)
+                    results.append(result)
+                    if request.get('stop_on_error') and not result['ok']:
+                        break
+                self.wfile.write(json.dumps({'results': results}).encode() + b"\n")
+                self.wfile.flush()
+        except (OSError, ValueError):
+            pass  # оборванное соединение или не JSON - соединение просто закрывается
+        finally:
+            if self.server.owner is self:
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+def run_privileged_helper(sock_path, parent_pid, owner_uid, mount_dir):
+    """Точка входа помощника (запускается через sudo)"""
+    server = socketserver.ThreadingUnixStreamServer(sock_path, _HelperRequestHandler)
+    server.daemon_threads = True
+    server.owner = None
+    server.owner_lock = threading.Lock()
+    # Разрешается при запуске: подмена симлинка потом не расширит доступ
+    server.mount_dir = Path(os.path.realpath(mount_dir))
+    os.chown(sock_path, owner_uid, -1)
+    os.chmod(sock_path, 0o600)
+
+    # Помощник не переживает основной процесс
+    def watch_parent():
+        while True:
+            try:
+                os.kill(parent_pid, 0)
+            except ProcessLookupError:
+                server.shutdown()
+                return
+            time.sleep(1)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        Path(sock_path).unlink(missing_ok=True)
+
+class PrivilegedHelper:
+    """Клиент помощника, запущенного через sudo один раз за сессию.
+
+    Помощник слушает Unix-сокет в приватном каталоге (0700) и выполняет
+    пакеты операций mount/unmount/eject, возвращая для каждой
+    {'op', 'ok', 'out', 'err', 'ms'}. Пароль передается sudo один раз.
+    Монтировать можно только диски bootloader'а и только внутри mount_dir.
+    У каждого потока свое соединение - пакеты разных потоков идут параллельно.
+    Помощник завершается, когда закрыто соединение, открытое при запуске.
+    """
+
+    def __init__(self, mount_dir=MOUNT_DIR):
+        self.mount_dir = Path(mount_dir)
+        self.proc = None
+        self.sock_path = None
+        self.sock_dir = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.sock_path))
+        except OSError:
+            sock.close()
+            raise
+        conn = (sock, sock.makefile('rb'))
+        with self._lock:
+            self._connections.append(conn)
+        self._local.conn = conn
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        return conn if conn else self._connect()
+
+    def start(self, password):
+        """Запуск помощника; False если sudo отклонил пароль"""
+        self.sock_dir = Path(tempfile.mkdtemp(prefix="sofle-helper-"))
+        self.sock_path = self.sock_dir / "helper.sock"
+        HELPER_LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(HELPER_LOG_FILE, 'ab') as log:
+            self.proc = subprocess.Popen(
+                ["sudo", "-S", "-p", "", sys.executable, str(Path(__file__).resolve()),
+                 "--privileged-helper", str(self.sock_path), str(os.getpid()), str(os.getuid()),
+                 str(self.mount_dir)],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=log
+            )
+        try:
+            self.proc.stdin.write(f"{password}\n".encode())
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        start = time.monotonic()
+        deadline = start + HELPER_START_TIMEOUT
+        while time.monotonic() < deadline and self.proc.poll() is None:
+            if self.sock_path.exists():
+                try:
+                    self._connect()
+                    atexit.register(self.stop)
+                    EXECUTOR.record("sudo (helper start)", (time.monotonic() - start) * 1000, 0)
+                    return True
+                except OSError:
+                    pass
+            time.sleep(0.02)
+
+        self.stop()
+        return False
+
+    def batch(self, ops, stop_on_error=False):
+        """Выполнение пакета операций, возвращает список результатов"""
+        request = json.dumps({'ops': ops, 'stop_on_error': stop_on_error}).encode() + b"\n"
+        sock, reader = self._connection()
+        sock.sendall(request)
+        response = reader.readline()
+        if not response:
+            raise RuntimeError("привилегированный помощник завершился")
+        return json.loads(response)['results']
 
-    def run_sudo(self, cmd):
-        """Выполнение команды с sudo"""
-        full_cmd = f"echo '{self.password}' | sudo -S {cmd}"
-        return run_command(full_cmd, capture=True, check=False)
+    def stop(self):
+        """Остановка помощника"""
+        # Закрытие управляющего соединения завершает помощника
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for sock, reader in connections:
+            reader.close()
+            sock.close()
+        if self.proc and self.proc.poll() is None:
+            try:
+                self.proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.sock_dir:
+            shutil.rmtree(self.sock_dir, ignore_errors=True)
+            self.sock_dir = None
+
+# ===== Локальное хранилище прошивок =====
+class FirmwareStore:
+    """Хранилище сборок с адресацией по содержимому.
+
+    Структура DOWNLOADS:
+      objects/<sha256>.uf2          - уникальные образы
+      builds/<commit>-<run_id>/     - hardlink'и на objects + build.json
+      current -> builds/<...>       - симлинк на активную сборку
+      .version.json                 - описание активной сборки
+    Переключение сборок (откат, A/B) - это только смена симлинка.
+    Старые сборки вытесняются по LRU (STORE_MAX_BUILDS).
+    """
+
+    def __init__(self, root=DOWNLOADS, max_builds=STORE_MAX_BUILDS):
+        self.root = Path(root)
+        self.history = HISTORY if self.root == DOWNLOADS else HistoryDB(self.root / HISTORY_DB.name,
+                                                                         ledger_file=None)
+        self.objects_dir = self.root / "objects"
+        self.builds_dir = self.root / "builds"
+        self.current_link = self.root / "current"
+        self.version_file = self.root / VERSION_FILE.name
+        self.max_builds = max_builds
+
+    @staticmethod
+    def build_key(info):
+        """Ключ сборки: коммит + run ID"""
+        return f"{info['commit'][:12]}-{info['run_id']}"
+
+    def has_build(self, key):
+        return (self.builds_dir / key / "build.json").exists()
+
+    def current_key(self):
+        """Ключ активной сборки или None"""
+        if not self.current_link.is_symlink():
+            return None
+        key = Path(os.readlink(self.current_link)).name
+        return key if self.has_build(key) else None
+
+    def current_dir(self):
+        key = self.current_key()
+        return self.builds_dir / key if key else None
+
+    def build_info(self, key):
+        return json.loads((self.builds_dir / key / "build.json").read_text())
+
+    def _save_info(self, key, info):
+        path = self.builds_dir / key / "build.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(info, indent=2))
+        os.replace(tmp, path)
+
+    def _add_object(self, src, digest=None):
+        """Перемещение файла в objects/ (если такого образа еще нет)"""
+        if digest is None:
+            digest = file_sha256(src)
+        obj = self.objects_dir / f"{digest}.uf2"
+        if obj.exists():
+            Path(src).unlink()
+        else:
+            os.replace(src, obj)
+        return digest, obj
+
+    def ingest(self, info, files, digests=None):
+        """Добавление сборки из списка .uf2 файлов (файлы перемещаются).
+
+        digests - уже посчитанные SHA-256 по имени файла (при потоковом
+        скачивании), чтобы не читать файлы повторно.
+        """
+        known = digests or {}
+        key = self.build_key(info)
+        build_dir = self.builds_dir / key
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        if build_dir.exists():
+            shutil.rmtree(build_dir)
+        build_dir.mkdir(parents=True)
+
+        digests = {}
+        for src in files:
+            src = Path(src)
+            name = src.name
+            digest, obj = self._add_object(src, known.get(name))
+            try:
+                os.link(obj, build_dir / name)
+            except OSError:
+                shutil.copy2(obj, build_dir / name)
+            digests[name] = digest
+
+        info = dict(info, files=digests, last_used=time.time())
+        self._save_info(key, info)
+        self.history.record_build(key, info, digests)
+        return key
+
+    def activate(self, key):
+        """Сделать сборку текущей (атомарная замена симлинка)"""
+        info = self.build_info(key)
+        info['last_used'] = time.time()
+        self._save_info(key, info)
+
+        tmp_link = self.root / ".current.tmp"
+        if tmp_link.is_symlink() or tmp_link.exists():
+            tmp_link.unlink()
+        os.symlink(Path("builds") / key, tmp_link)
+        os.replace(tmp_link, self.current_link)
+
+        # .version.json описывает активную сборку
+        self.version_file.write_text(json.dumps(
+            {k: v for k, v in info.items() if k not in ('files', 'last_used')}, indent=2))
+        self.evict()
+        return info
+
+    def list_builds(self):
+        """Сборки от недавно использованных к старым"""
+        if not self.builds_dir.exists():
+            return []
+        builds = []
+        for d in self.builds_dir.iterdir():
+            if (d / "build.json").exists():
+                builds.append((d.name, self.build_info(d.name)))
+        builds.sort(key=lambda item: item[1].get('last_used', 0), reverse=True)
+        return builds
+
+    def find(self, ref):
+        """Поиск сборки по тегу, коммиту (префиксу), run ID или ключу"""
+        for key, info in self.list_builds():
+            if ref in (key, info.get('tag'), str(info.get('run_id'))) or \
+                    info.get('commit', '').startswith(ref):
+                return key
+        return None
+
+    def evict(self):
+        """LRU-вытеснение старых сборок и неиспользуемых образов"""
+        current = self.current_key()
+        builds = [key for key, _ in self.list_builds() if key != current]
+        keep = self.max_builds - (1 if current else 0)
+        for key in builds[max(keep, 0):]:
+            shutil.rmtree(self.builds_dir / key)
+
+        # Образ без hardlink'ов из builds/ больше не нужен
+        if self.objects_dir.exists():
+            for obj in self.objects_dir.glob("*.uf2"):
+                if obj.stat().st_nlink == 1:
+                    obj.unlink()
+
+# ===== История скачиваний и прошивок =====
+def version_number(tag):
+    """Тег v1.2.3 как число для сравнения в SQL (1002003) или None без версии"""
+    numbers = [int(n) for n in re.findall(r'\d+', tag or '')[:3]]
+    if not numbers:
+        return None
+    numbers += [0] * (3 - len(numbers))
+    return numbers[0] * 1_000_000 + numbers[1] * 1_000 + numbers[2]
+
+class HistoryDB:
+    """Локальная история сборок и прошивок (SQLite в DOWNLOADS).
+
+    Таблицы:
+      builds  - сборки (GitHub и локальные) с тегом и его числовой версией
+      images  - какие образы (sha256) входят в какую сборку
+      flashes - каждая запись образа на контроллер: время, контроллер
+                (идентификатор журнала прошивок), половинка, длительность
+    Индексы по коммиту, тегу, контроллеру и времени. flashes - единственный
+    источник состояния прошивок: FlashLedger читает из нее, каждая
+    прошивка пишется своей транзакцией сразу после записи половинки.
+    При создании базы в нее переносятся сборки хранилища и прежний
+    JSON-журнал прошивок (ledger_file), после переноса файл удаляется.
+    """
+
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS builds (
+            key TEXT PRIMARY KEY, run_id TEXT, commit_sha TEXT, tag TEXT, version INTEGER,
+            branch TEXT, build_date TEXT, downloaded REAL, source TEXT, message TEXT);
+        CREATE TABLE IF NOT EXISTS images (
+            digest TEXT, build_key TEXT, name TEXT, PRIMARY KEY (digest, build_key));
+        CREATE TABLE IF NOT EXISTS flashes (
+            id INTEGER PRIMARY KEY, time REAL, device TEXT, target TEXT, half TEXT,
+            digest TEXT, file TEXT, seconds REAL, ok INTEGER, error TEXT);
+        CREATE INDEX IF NOT EXISTS builds_commit ON builds (commit_sha);
+        CREATE INDEX IF NOT EXISTS builds_tag ON builds (tag);
+        CREATE INDEX IF NOT EXISTS flashes_device ON flashes (device, time);
+        CREATE INDEX IF NOT EXISTS flashes_time ON flashes (time);
+    """
+
+    # Последняя успешная прошивка каждого контроллера
+    LATEST_CTE = """
+        WITH latest AS (
+            SELECT device, half, target, digest, file, MAX(time) AS time
+            FROM flashes WHERE ok = 1 AND device IS NOT NULL GROUP BY device)
+    """
+    # ... и самая новая сборка с этим образом
+    LATEST_SQL = LATEST_CTE + """
+        SELECT l.device, l.half, l.target, l.file, l.time, MAX(b.version) AS version,
+               b.tag, b.commit_sha, b.key
+        FROM latest l
+        LEFT JOIN images i ON i.digest = l.digest
+        LEFT JOIN builds b ON b.key = i.build_key
+        GROUP BY l.device
+    """
+
+    def __init__(self, path=HISTORY_DB, ledger_file=FLASH_LEDGER_FILE):
+        self.path = Path(path)
+        # None - без переноса JSON-журнала (базы хранилищ вне DOWNLOADS)
+        self.ledger_file = Path(ledger_file) if ledger_file else None
+        self._db = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Соединение с базой (создается при первом обращении)"""
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version < self.SCHEMA_VERSION:
+                with self._db:
+                    self._db.executescript(self.SCHEMA)
+                    imported = self._import_existing()
+                    self._db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                # Журнал перенесен и закоммичен - дальше только база
+                if imported:
+                    self.ledger_file.unlink(missing_ok=True)
+        return self._db
+
+    def _import_existing(self):
+        """Перенос того, что было известно до появления базы; True - перенесен JSON-журнал"""
+        store = FirmwareStore(self.path.parent)
+        for key, info in store.list_builds():
+            self._insert_build(key, info, info.get('files', {}))
+        if self.ledger_file is None:
+            return False
+        try:
+            entries = json.loads(self.ledger_file.read_text())
+        except (OSError, ValueError):
+            return False
+        for identity, entry in entries.items():
+            try:
+                when = datetime.fromisoformat(entry['time']).timestamp()
+            except (KeyError, ValueError):
+                continue
+            self._db.execute(
+                "INSERT INTO flashes (time, device, target, half, digest, file, ok) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                (when, identity, entry.get('target'), entry.get('half'), entry.get('digest'), entry.get('file')))
+        return True
+
+    def _insert_build(self, key, info, digests):
+        downloaded = info.get('download_date')
+        self._db.execute(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, str(info.get('run_id')), info.get('commit'), info.get('tag', '-'),
+             version_number(info.get('tag')), info.get('branch'), info.get('build_date'),
+             datetime.fromisoformat(downloaded).timestamp() if downloaded else time.time(),
+             info.get('source', 'github'), info.get('commit_message')))
+        self._db.executemany(
+            "INSERT OR IGNORE INTO images VALUES (?, ?, ?)",
+            [(digest, key, name) for name, digest in digests.items()])
+
+    def record_build(self, key, info, digests):
+        """Сборка и ее образы - одной транзакцией"""
+        with self._lock:
+            db = self.connect()
+            with db:
+                self._insert_build(key, info, digests)
+
+    def add_flash(self, device, target, half, digest, fw_file, seconds, ok, error=None):
+        """Прошивка половинки - своей транзакцией, сразу"""
+        with self._lock:
+            db = self.connect()
+            with db:
+                db.execute(
+                    "INSERT INTO flashes (time, device, target, half, digest, file, seconds, ok, error) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), device, target, half, digest, Path(fw_file).name, seconds, int(ok), error))
+
+    def last_flash(self, device):
+        """Последняя успешная прошивка контроллера или None"""
+        with self._lock:
+            return self.connect().execute(
+                "SELECT * FROM flashes WHERE device = ? AND ok = 1 ORDER BY time DESC LIMIT 1",
+                (device,)).fetchone()
+
+    def devices_with_half(self, half):
+        """Последние прошивки контроллеров, известных как половинка half"""
+        with self._lock:
+            return self.connect().execute(
+                self.LATEST_CTE + "SELECT * FROM latest WHERE half = ? ORDER BY time", (half,)).fetchall()
+
+    def flashes(self, device=None, limit=20):
+        """Последние прошивки (device - идентификатор или серийный номер)"""
+        sql = ("SELECT f.*, (SELECT b.tag FROM images i JOIN builds b ON b.key = i.build_key "
+               "WHERE i.digest = f.digest ORDER BY b.version DESC LIMIT 1) AS tag FROM flashes f")
+        params = []
+        if device:
+            sql += " WHERE f.device = ? OR f.device LIKE ?"
+            params += [device, f"%:{device}"]
+        sql += " ORDER BY f.time DESC LIMIT ?"
+        with self._lock:
+            return self.connect().execute(sql, params + [limit]).fetchall()
+
+    def older_than(self, tag):
+        """Контроллеры, последняя прошивка которых старше тега (или сборка неизвестна)"""
+        with self._lock:
+            return self.connect().execute(
+                f"SELECT * FROM ({self.LATEST_SQL}) WHERE version IS NULL OR version < ? ORDER BY time",
+                (version_number(tag),)).fetchall()
+
+    def devices_on_build(self, key):
+        """Контроллеры, на которых сейчас стоит сборка key"""
+        with self._lock:
+            return self.connect().execute(
+                self.LATEST_CTE + "SELECT l.* FROM latest l JOIN images i ON i.digest = l.digest "
+                                  "WHERE i.build_key = ? ORDER BY l.time", (key,)).fetchall()
+
+    def print_history(self, device=None, limit=20, older_than=None):
+        """Команда history"""
+        start = time.monotonic()
+        if older_than:
+            if version_number(older_than) is None:
+                print_color(f"❌ Не версия: {older_than} (нужно vX.Y.Z)", Colors.RED)
+                return False
+            rows = self.older_than(older_than)
+            elapsed = (time.monotonic() - start) * 1000
+            print(f"📋 Контроллеры со сборкой старше {older_than}:")
+            for row in rows:
+                build = row['tag'] if row['key'] else "неизвестная сборка"
+                print(f"   {row['device']:<40} {row['half'] or '-':<6} {build:<10} "
+                      f"{datetime.fromtimestamp(row['time']):%Y-%m-%d %H:%M}  {row['file']}")
+            if not rows:
+                print_color("   ✅ Таких нет", Colors.GREEN)
+        else:
+            rows = self.flashes(device, limit)
+            elapsed = (time.monotonic() - start) * 1000
+            print("📋 Последние прошивки:")
+            for row in rows:
+                status = "✅" if row['ok'] else f"❌ {row['error']}"
+                seconds = f"{row['seconds']:.1f} с" if row['seconds'] is not None else "-"
+                print(f"   {datetime.fromtimestamp(row['time']):%Y-%m-%d %H:%M}  {row['target'] or '-':<6} "
+                      f"{row['tag'] or '-':<10} {seconds:>7}  {row['device'] or '-'}  {status}")
+            if not rows:
+                print_color("   ℹ️  Прошивок пока нет", Colors.BLUE)
+        print(f"   ({len(rows)} строк, запрос {elapsed:.1f} мс, {self.path})")
+        return True
+
+HISTORY = HistoryDB()
+
+# ===== GitHub API клиент =====
+class GitHubClient:
+    """Клиент GitHub REST API без запуска gh на каждый запрос.
+
+    • пул keep-alive соединений (одно TLS-рукопожатие на соединение)
+    • условные запросы: ETag сохраняется в API_CACHE_FILE, неизменившийся
+      ответ стоит одного 304 без тела
+    • потокобезопасен - независимые запросы можно делать параллельно
+    base_url можно направить на локальный тестовый сервер (SOFLE_GITHUB_API).
+    """
+
+    RETRY_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+    def __init__(self, token=None, base_url=GITHUB_API, cache_file=API_CACHE_FILE):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.base_path = parsed.path.rstrip('/')
+        self.token = token
+        self.cache_file = Path(cache_file) if cache_file else None
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._cache_dirty = False
+        # Остаток лимита запросов и время его сброса (epoch) из последнего ответа
+        self.rate_remaining = None
+        self.rate_reset = None
+        self.cache = {}
+        if self.cache_file and self.cache_file.exists():
+            try:
+                self.cache = json.loads(self.cache_file.read_text())
+            except ValueError:
+                self.cache = {}
+
+    def _new_connection(self):
+        if self.scheme == "http":
+            return http.client.HTTPConnection(self.host, timeout=30)
+        return http.client.HTTPSConnection(self.host, timeout=30)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _release(self, conn):
+        self._pool.put(conn)
+
+    def url(self, path, params=None):
+        """Путь запроса относительно base_url"""
+        url = path if path.startswith(self.base_path + "/") else self.base_path + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        return url
+
+    def request(self, method, url, headers=None):
+        """HTTP-запрос через пул: (status, headers, body)"""
+        all_headers = {
+            'Accept': 'application/vnd.github+json',
+            'User-Agent': 'sofle-flash-utility',
+            'X-GitHub-Api-Version': '2022-11-28'
+        }
+        if self.token:
+            all_headers['Authorization'] = f"Bearer {self.token}"
+        all_headers.update(headers or {})
+
+        with TELEMETRY.span("api.request", method=method, path=url.split('?')[0]) as span:
+            for attempt in range(2):
+                conn = self._acquire()
+                try:
+                    conn.request(method, url, headers=all_headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except self.RETRY_ERRORS:
+                    # Сервер закрыл простаивающее keep-alive соединение - повторяем на новом
+                    conn.close()
+                    if attempt:
+                        raise
+                    continue
+                except Exception:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                span.update(status=response.status, bytes=len(body), retried=bool(attempt))
+                if response.status >= 400:
+                    span['outcome'] = f"http_{response.status}"
+                resp_headers = {k.lower(): v for k, v in response.getheaders()}
+                if 'x-ratelimit-remaining' in resp_headers:
+                    with self._lock:
+                        self.rate_remaining = int(resp_headers['x-ratelimit-remaining'])
+                        self.rate_reset = int(resp_headers.get('x-ratelimit-reset', 0))
+                return response.status, resp_headers, body
+
+    @staticmethod
+    def _next_page(link_header):
+        """Путь следующей страницы из заголовка Link"""
+        match = re.search(r'<([^>]+)>;\s*rel="next"', link_header or '')
+        if not match:
+            return None
+        parsed = urllib.parse.urlsplit(match.group(1))
+        return parsed.path + (f"?{parsed.query}" if parsed.query else "")
+
+    def get_page(self, path, params=None):
+        """GET с ETag-кешем. Возвращает (data, not_modified, next_page_path)"""
+        url = self.url(path, params)
+        with self._lock:
+            cached = self.cache.get(url)
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+
+        status, resp_headers, body = self.request("GET", url, headers)
+        if status == 304 and cached:
+            return cached['data'], True, cached.get('next')
+        if status != 200:
+            raise RuntimeError(f"GitHub API {url}: HTTP {status} {body[:200].decode(errors='replace')}")
+
+        data = json.loads(body)
+        next_page = self._next_page(resp_headers.get('link'))
+        if 'etag' in resp_headers:
+            with self._lock:
+                self.cache[url] = {'etag': resp_headers['etag'], 'data': data, 'next': next_page}
+                self._cache_dirty = True
+        return data, False, next_page
+
+    def get_json(self, path, params=None):
+        """GET с ETag-кешем. Возвращает (data, not_modified)"""
+        data, not_modified, _ = self.get_page(path, params)
+        return data, not_modified
+
+    def save_cache(self):
+        """Сохранение ETag-кеша на диск"""
+        with self._lock:
+            if not self.cache_file or not self._cache_dirty:
+                return
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.cache))
+            os.replace(tmp, self.cache_file)
+            self._cache_dirty = False
+
+    @contextlib.contextmanager
+    def stream(self, path, max_redirects=3):
+        """Потоковый GET (архивы артефактов): дает HTTP-ответ, тело не читается.
+
+        Отдельное соединение на каждый поток, чтобы параллельные загрузки
+        не занимали пул API. Перенаправления на другой хост (хранилище
+        артефактов) идут без токена.
+        """
+        scheme, host, url = self.scheme, self.host, self.url(path)
+        headers = {'User-Agent': 'sofle-flash-utility'}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        with TELEMETRY.span("api.download", path=url.split('?')[0]) as span:
+            for _ in range(max_redirects + 1):
+                conn = (http.client.HTTPConnection if scheme == "http" else http.client.HTTPSConnection)(host, timeout=60)
+                try:
+                    conn.request("GET", url, headers=headers)
+                    response = conn.getresponse()
+                    if response.status in (301, 302, 303, 307, 308):
+                        location = urllib.parse.urlsplit(urllib.parse.urljoin(
+                            f"{scheme}://{host}{url}", response.getheader('location', '')))
+                        if location.netloc != host:
+                            headers.pop('Authorization', None)
+                        scheme, host = location.scheme, location.netloc
+                        url = location.path + (f"?{location.query}" if location.query else "")
+                        span['redirected'] = True
+                        continue
+                    span['status'] = response.status
+                    if response.status != 200:
+                        span['outcome'] = f"http_{response.status}"
+                        raise RuntimeError(f"GET {path}: HTTP {response.status}")
+                    yield response
+                    return
+                finally:
+                    conn.close()
+            span['outcome'] = 'redirects'
+            raise RuntimeError(f"GET {path}: слишком много перенаправлений")
+
+    def close(self):
+        self.save_cache()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+# ===== Потоковая распаковка артефактов =====
+class ZipStreamError(ValueError):
+    """Архив нельзя разобрать последовательным чтением"""
+
+class _StreamReader:
+    """Последовательное чтение из HTTP-ответа с возвратом лишних байт"""
+
+    CHUNK = 256 * 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+
+    def read(self, size=CHUNK):
+        """До size байт (меньше только в конце потока)"""
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+    def read_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ZipStreamError("архив оборван")
+            data += chunk
+        return bytes(data)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+def extract_uf2_stream(stream, dest_dir, wanted=lambda name: name.endswith('.uf2')):
+    """Извлечение нужных файлов из zip по мере чтения потока.
+
+    Локальные заголовки zip читаются подряд, без центрального каталога
+    и без сохранения архива на диск. Для каждого нужного файла в том же
+    проходе считаются CRC-32 (проверка архива) и SHA-256 (ключ
+    FirmwareStore); файл пишется во временный и переименовывается
+    атомарно. Остальные элементы распаковываются вхолостую только для
+    того, чтобы найти их конец. Возвращает {имя: (путь, sha256)}.
+    """
+    reader = _StreamReader(stream)
+    dest_dir = Path(dest_dir)
+    extracted = {}
+    while True:
+        signature = reader.read_exact(4)
+        if signature in (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06"):
+            break  # центральный каталог: все файлы уже прочитаны
+        if signature != b"PK\x03\x04":
+            raise ZipStreamError(f"неожиданная сигнатура {signature!r}")
+        (_, flags, method, _, _, crc, compressed, size,
+         name_len, extra_len) = struct.unpack("<5H3I2H", reader.read_exact(26))
+        name = reader.read_exact(name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read_exact(extra_len)
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            tag, length = struct.unpack_from("<2H", extra, offset)
+            if tag == 0x0001:
+                zip64 = True
+                values = iter(struct.unpack_from(f"<{length // 8}Q", extra, offset + 4))
+                if size == 0xFFFFFFFF:
+                    size = next(values)
+                if compressed == 0xFFFFFFFF:
+                    compressed = next(values)
+            offset += 4 + length
+        if flags & 0x1:
+            raise ZipStreamError(f"{name}: зашифрованные архивы не поддерживаются")
+        if method not in (0, 8):
+            raise ZipStreamError(f"{name}: метод сжатия {method} не поддерживается")
+        descriptor = bool(flags & 0x8)
+        if method == 0 and descriptor and compressed == 0:
+            raise ZipStreamError(f"{name}: несжатый элемент без размера")
+
+        base = name.rsplit('/', 1)[-1]
+        keep = bool(base) and wanted(base) and base not in extracted
+        out = tempfile.NamedTemporaryFile(dir=dest_dir, prefix=".part-", delete=False) if keep else None
+        digest = hashlib.sha256()
+        actual_crc = 0
+        written = 0
+        try:
+            if method == 8:
+                inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                while not inflater.eof:
+                    chunk = reader.read()
+                    if not chunk:
+                        raise ZipStreamError(f"{name}: архив оборван")
+                    data = inflater.decompress(chunk)
+                    if inflater.unused_data:
+                        reader.unread(inflater.unused_data)
+                    if keep and data:
+                        out.write(data)
+                        digest.update(data)
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    written += len(data)
+            else:
+                remaining = compressed
+                while remaining:
+                    data = reader.read(min(remaining, _StreamReader.CHUNK))
+                    if not data:
+                        raise ZipStreamError(f"{name}: архив оборван")
+                    remaining -= len(data)
+                    if keep:
+                        out.write(data)
+                        digest.update(data)
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    written += len(data)
+
+            if descriptor:
+                # Дескриптор после данных: [PK\x07\x08] crc сжатый размер размер
+                head = reader.read_exact(4)
+                crc = struct.unpack("<I", head if head != b"PK\x07\x08" else reader.read_exact(4))[0]
+                reader.read_exact(16 if zip64 else 8)
+            if actual_crc != crc:
+                raise ZipStreamError(f"{name}: CRC не совпадает")
+            if keep:
+                out.close()
+                target = dest_dir / base
+                os.replace(out.name, target)
+                extracted[base] = (target, digest.hexdigest())
+                out = None
+        finally:
+            if out is not None:
+                out.close()
+                os.unlink(out.name)
+    return extracted
+
+# ===== Индекс тегов =====
+class TagIndex:
+    """Локальный индекс тегов репозитория: tag → SHA и SHA → теги.
+
+    Хранится в TAG_INDEX_FILE и обновляется инкрементально: /tags
+    упорядочен по имени, а не по дате, поэтому новый тег может оказаться
+    на любой странице и сдвинуть следующие. Читаются все страницы, но
+    условными запросами - неизменившаяся страница стоит одного 304 без
+    тела и берется из ETag-кеша клиента. Полный проход заодно показывает,
+    какие теги удалены в репозитории: их индекс забывает.
+    """
+
+    PER_PAGE = 100
+
+    def __init__(self, path=TAG_INDEX_FILE):
+        self.path = Path(path)
+        self.tags = {}
+        self.commits = {}
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text())
+                self.tags = data.get('tags', {})
+                self.commits = data.get('commits', {})
+            except ValueError:
+                pass
+
+    def tag_for(self, commit):
+        """Тег коммита или None (последний по версии, если тегов несколько)"""
+        names = self.commits.get(commit)
+        return names[-1] if names else None
+
+    def sha_for(self, tag):
+        return self.tags.get(tag)
+
+    def _remove(self, name):
+        old_sha = self.tags.pop(name, None)
+        if old_sha and name in self.commits.get(old_sha, []):
+            self.commits[old_sha].remove(name)
+            if not self.commits[old_sha]:
+                del self.commits[old_sha]
+
+    def _add(self, name, sha):
+        if self.tags.get(name) == sha:
+            return False
+        self._remove(name)
+        self.tags[name] = sha
+        names = self.commits.setdefault(sha, [])
+        names.append(name)
+        names.sort(key=version_key)
+        return True
+
+    def refresh(self, client, full=False):
+        """Обновление индекса; возвращает число новых, изменившихся и удаленных тегов"""
+        if full:
+            self.tags, self.commits = {}, {}
+
+        changed = 0
+        seen = set()
+        path, params = f"/repos/{REPO}/tags", {'per_page': self.PER_PAGE}
+        while path:
+            page, _, next_page = client.get_page(path, params)
+            changed += sum(self._add(t['name'], t['commit']['sha']) for t in page)
+            seen.update(t['name'] for t in page)
+            path, params = next_page, None
+
+        # Все страницы прочитаны: тегов, которых не было ни на одной, больше нет
+        for name in set(self.tags) - seen:
+            self._remove(name)
+            changed += 1
+
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({'tags': self.tags, 'commits': self.commits}))
+        os.replace(tmp, self.path)
 
 # ===== GitHub интеграция =====
+class FirmwareError(Exception):
+    """Сборку CI получить нельзя: нет gh/токена или успешного run'а.
+
+    hint - подсказка, что сделать. Команды CLI печатают ошибку и выходят
+    с кодом 1, фоновая проверка обновления сохраняет ее в error.
+    """
+
+    def __init__(self, message, hint=None):
+        super().__init__(message)
+        self.hint = hint
+
 class GitHubFirmware:
     @staticmethod
     def check_gh_cli():
-        """Проверка наличия GitHub CLI"""
-        result, _ = run_command("command -v gh", check=False)
-        if not result:
-            print_color("❌ GitHub CLI (gh) не установлен", Colors.RED)
-            print_color("   Установка: brew install gh", Colors.BLUE)
-            sys.exit(1)
+        """Проверка GitHub CLI, возвращает токен для API"""
+        token = os.environ.get("GH_TOKEN") or os.environ.get("GITHUB_TOKEN")
+        if token:
+            return token
 
-        result, _ = run_command("gh auth status", check=False)
-        if not result:
-            print_color("❌ Не авторизован в GitHub CLI", Colors.RED)
-            print_color("   Выполни: gh auth login", Colors.BLUE)
-            sys.exit(1)
+        if not shutil.which("gh"):
+            raise FirmwareError("GitHub CLI (gh) не установлен", "Установка: brew install gh")
+
+        # Один запуск gh: он же проверяет авторизацию
+        token, _ = run_command(["gh", "auth", "token"], check=True)
+        if not token:
+            raise FirmwareError("Не авторизован в GitHub CLI", "Выполни: gh auth login")
+        return token
+
+    @staticmethod
+    def fetch_artifacts(client, run_id, dest):
+        """Потоковое скачивание артефактов run'а: только .uf2, параллельно.
+
+        Берутся артефакты целей из FIRMWARE_TARGETS (если таких нет - все).
+        Возвращает {имя файла: (путь, sha256)}.
+        """
+        data, _ = client.get_json(f"/repos/{REPO}/actions/runs/{run_id}/artifacts", {'per_page': 100})
+        artifacts = [a for a in data.get('artifacts', []) if not a.get('expired')]
+        selected = [a for a in artifacts if a['name'].startswith(tuple(FIRMWARE_TARGETS.values()))] or artifacts
+        if not selected:
+            raise RuntimeError(f"у run {run_id} нет доступных артефактов")
+
+        def fetch(artifact):
+            url = urllib.parse.urlsplit(artifact['archive_download_url'])
+            with client.stream(url.path + (f"?{url.query}" if url.query else "")) as response:
+                return extract_uf2_stream(response, dest)
+
+        files = {}
+        with ThreadPoolExecutor(max_workers=len(selected)) as pool:
+            for extracted in pool.map(fetch, selected):
+                for name, item in extracted.items():
+                    files.setdefault(name, item)
+        return files
 
     @staticmethod
-    def fetch_remote_version():
+    def fetch_remote_version(client, full_tags=False):
         """Получение информации о последней прошивке"""
-        cmd = f'gh run list --repo {REPO} --workflow build.yml --status success --limit 1 --json databaseId,headSha,createdAt,headBranch,displayTitle'
-        output, error = run_command(cmd)
+        tag_index = TagIndex()
 
-        if not output:
-            print_color("❌ Не найден успешный workflow run", Colors.RED)
-            sys.exit(1)
+        # Последний успешный run и обновление индекса тегов не зависят друг от друга
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            runs_future = pool.submit(
+                client.get_json,
+                f"/repos/{REPO}/actions/workflows/build.yml/runs",
+                {'status': 'success', 'per_page': 1}
+            )
+            tags_future = pool.submit(tag_index.refresh, client, full_tags)
+            runs, _ = runs_future.result()
+            tags_future.result()
 
-        run_info = json.loads(output)[0]
-        commit_sha = run_info['headSha']
+        if not runs.get('workflow_runs'):
+            raise FirmwareError("Не найден успешный workflow run")
+
+        run_info = runs['workflow_runs'][0]
+        return GitHubFirmware.describe_run(run_info, tag_index)
+
+    @staticmethod
+    def describe_run(run_info, tag_index):
+        """Описание сборки (как в .version.json) по workflow run"""
+        commit_sha = run_info['head_sha']
 
         # Получаем тег для коммита
-        tag_cmd = f'gh api repos/{REPO}/tags --jq ".[] | select(.commit.sha == \\"{commit_sha}\\") | .name"'
-        tag, _ = run_command(tag_cmd, check=False)
+        tag = tag_index.tag_for(commit_sha)
+
+        return {
+            'run_id': run_info['id'],
+            'commit': commit_sha,
+            'commit_short': commit_sha[:7],
+            'branch': run_info['head_branch'],
+            'build_date': run_info['created_at'],
+            'commit_message': run_info['display_title'],
+            'tag': tag if tag else '-'
+        }
+
+    @staticmethod
+    def download_firmware(force=False):
+        """Скачивание прошивки из GitHub Actions"""
+        print(f"{timestamp()} - 📥 Скачивание последней прошивки из GitHub Actions...")
+
+        client = GitHubClient(token=GitHubFirmware.check_gh_cli())
+        try:
+            with TELEMETRY.span("download.resolve", full_tags=force):
+                remote = GitHubFirmware.fetch_remote_version(client, full_tags=force)
+
+            print_color("✅ Найден run: " + str(remote['run_id']), Colors.GREEN)
+            print(f"   Version: {remote['tag']}")
+            print(f"   Commit:  {remote['commit_short']} ({remote['commit_message']})")
+            print(f"   Branch:  {remote['branch']}")
+            print(f"   Date:    {remote['build_date']}")
+            print()
+
+            # Проверяем, нет ли уже этой сборки в локальном хранилище
+            store = FirmwareStore()
+            key = FirmwareStore.build_key(remote)
+            if store.has_build(key) and not force:
+                local = store.build_info(key)
+                if store.current_key() == key:
+                    print_color("ℹ️  Эта версия уже скачана локально!", Colors.BLUE)
+                    print()
+                    print("💾 Локальная версия:")
+                    print(f"   Version: {local.get('tag', '-')}")
+                    print(f"   Commit:  {local['commit_short']}")
+                    print(f"   Build:   {local['build_date']}")
+                    print()
+                    print_color("✅ Прошивка актуальна, скачивание не требуется", Colors.GREEN)
+                    print()
+                    print("💡 Для принудительной загрузки используй: ./flash_sofle.py download --force")
+                    return
 
+                store.activate(key)
+                print_color("✅ Сборка уже есть в локальном хранилище - переключено без скачивания", Colors.GREEN)
+                print()
+                GitHubFirmware.show_version(store)
+                return
+
+            # Скачиваем артефакты во временный каталог
+            print("📦 Скачиваем артефакты...")
+            key = GitHubFirmware.fetch_build(client, remote, store)
+
+            store.activate(key)
+
+            print_color(f"✅ Прошивки скачаны в {store.builds_dir / key}:", Colors.GREEN)
+            for uf2 in sorted((store.builds_dir / key).glob("*.uf2")):
+                print(f"   {uf2.name}")
+            print()
+
+            GitHubFirmware.show_version(store)
+        finally:
+            client.close()
+
+    @staticmethod
+    def fetch_build(client, remote, store):
+        """Скачивание артефактов run'а в хранилище; возвращает ключ сборки"""
+        incoming = DOWNLOADS / f".incoming-{remote['run_id']}"
+        if incoming.exists():
+            shutil.rmtree(incoming)
+        incoming.mkdir(parents=True)
+        try:
+            with TELEMETRY.span("download.artifact", run_id=remote['run_id']) as span:
+                extracted = GitHubFirmware.fetch_artifacts(client, remote['run_id'], incoming)
+                files = [path for path, _ in extracted.values()]
+                span.update(files=len(files), bytes=sum(f.stat().st_size for f in files))
+            if not files:
+                raise RuntimeError("в артефактах нет .uf2 файлов")
+
+            # Сохраняем информацию о версии
+            remote['download_date'] = datetime.now().isoformat()
+            with TELEMETRY.span("download.ingest"):
+                return store.ingest(remote, files, {name: digest for name, (_, digest) in extracted.items()})
+        finally:
+            shutil.rmtree(incoming, ignore_errors=True)
+
+    @staticmethod
+    def verify_build(store, key):
+        """Проверка всех UF2 сборки (validate_uf2 с целью по префиксу файла): отчеты с ошибками"""
+        failed = []
+        for uf2 in sorted((store.builds_dir / key).glob("*.uf2")):
+            target = next((t for t, prefix in FIRMWARE_TARGETS.items() if uf2.name.startswith(prefix)), None)
+            report = validate_uf2(uf2, target)
+            if report['errors']:
+                failed.append(report)
+        return failed
+
+    @staticmethod
+    def watch(interval=WATCH_IDLE_INTERVAL):
+        """download --watch: ждать новые сборки CI и скачивать их сразу"""
+        client = GitHubClient(token=GitHubFirmware.check_gh_cli())
+        print(f"{timestamp()} - 👀 Слежу за сборками {REPO} (Ctrl+C - выход)")
+        try:
+            BuildWatcher(client, idle_interval=interval).run()
+        except KeyboardInterrupt:
+            print()
+            print_color("⏹️  Наблюдение остановлено", Colors.YELLOW)
+        finally:
+            client.close()
+
+    @staticmethod
+    def show_version(store=None):
+        """Показать текущую версию прошивки (активную сборку хранилища)"""
+        store = store or FirmwareStore()
+        if not store.version_file.exists():
+            print_color("❌ Версия не найдена. Сначала выполни: ./flash_sofle.py download", Colors.RED)
+            return False
+
+        info = json.loads(store.version_file.read_text())
+        # Тег мог появиться уже после скачивания
+        tag = info.get('tag', '-')
+        if tag == '-':
+            tag = TagIndex().tag_for(info['commit']) or '-'
+        print("📋 Версия прошивки:")
+        print(f"   Version: {tag}")
+        print(f"   Commit:  {info['commit_short']} ({info['commit_message']})")
+        print(f"   Branch:  {info['branch']}")
+        print(f"   Build:   {info['build_date']}")
+        print(f"   Run ID:  {info['run_id']}")
+        devices = store.history.devices_on_build(FirmwareStore.build_key(info))
+        if devices:
+            halves = Counter(row['half'] or '?' for row in devices)
+            print(f"   Прошита: {len(devices)} контроллер(ов) "
+                  f"({', '.join(f'{half}: {n}' for half, n in sorted(halves.items()))})")
+        return True
+
+    @staticmethod
+    def list_builds():
+        """Список сборок в локальном хранилище"""
+        store = FirmwareStore()
+        builds = store.list_builds()
+        if not builds:
+            print_color("❌ Локальных сборок нет. Сначала выполни: ./flash_sofle.py download", Colors.RED)
+            return False
+
+        current = store.current_key()
+        print("📦 Локальные сборки (от недавно использованных):")
+        for key, info in builds:
+            marker = "→" if key == current else " "
+            print(f" {marker} {info.get('tag', '-'):<10} {info['commit_short']}  run {info['run_id']}  "
+                  f"{info['build_date']}  {info.get('commit_message', '')}")
+        return True
+
+    @staticmethod
+    def use_build(ref):
+        """Переключение на сборку из локального хранилища (без сети)"""
+        store = FirmwareStore()
+        key = store.find(ref)
+        if not key:
+            print_color(f"❌ Сборка '{ref}' не найдена локально", Colors.RED)
+            print("💡 Список сборок: ./flash_sofle.py builds")
+            return False
+        store.activate(key)
+        print_color(f"✅ Активная сборка: {key}", Colors.GREEN)
+        print()
+        return GitHubFirmware.show_version(store)
+
+# ===== Наблюдение за сборками CI =====
+class BuildWatcher:
+    """Режим download --watch: новые сборки CI скачиваются сразу по готовности.
+
+    Опрашивает последние run'ы workflow build.yml условными запросами
+    (неизменившийся список стоит одного 304). Пока есть незавершенная
+    сборка, опрос идет каждые active_interval секунд; без активных сборок
+    интервал растет от idle_interval в WATCH_BACKOFF раз после каждого
+    опроса без изменений (до max_interval) и сбрасывается при изменении.
+    Когда близок лимит запросов API, ждет его сброса. Новая успешная
+    сборка скачивается, проверяется (validate_uf2) и становится активной.
+    sleep/clock подменяются в тестах.
+    """
+
+    def __init__(self, client, store=None, idle_interval=WATCH_IDLE_INTERVAL,
+                 active_interval=WATCH_ACTIVE_INTERVAL, max_interval=WATCH_MAX_INTERVAL,
+                 sleep=time.sleep, clock=time.time, log=print_color):
+        self.client = client
+        self.store = store or FirmwareStore()
+        self.idle_interval = idle_interval
+        self.active_interval = min(active_interval, idle_interval)
+        self.max_interval = max(max_interval, idle_interval)
+        self.interval = idle_interval
+        self.sleep = sleep
+        self.clock = clock
+        self.log = log
+        self.tag_index = TagIndex()
+        self.active = {}
+        self.handled = set()  # run'ы, которые уже скачаны или отвергнуты
+        self.downloaded = []
+        self.polls = 0
+
+    def _runs(self):
+        data, not_modified = self.client.get_json(
+            f"/repos/{REPO}/actions/workflows/build.yml/runs", {'per_page': 10})
+        return data.get('workflow_runs', []), not_modified
+
+    def poll(self):
+        """Один опрос; True - список run'ов изменился"""
+        self.polls += 1
+        with TELEMETRY.span("watch.poll") as span:
+            runs, not_modified = self._runs()
+            span['not_modified'] = not_modified
+        # Первый опрос разбирается всегда: 304 мог прийти на ETag прошлого запуска
+        if not_modified and not self.active and self.polls > 1:
+            return False
+
+        active = {run['id']: run for run in runs if run.get('status') != 'completed'}
+        for run_id in active.keys() - self.active.keys():
+            run = active[run_id]
+            self.log(f"{timestamp()} - 🔨 Идет сборка run {run_id}: {run['head_sha'][:7]} "
+                     f"({run.get('display_title', '')})", Colors.BLUE)
+        for run_id in self.active.keys() - active.keys():
+            run = next((r for r in runs if r['id'] == run_id), None)
+            if run and run.get('conclusion') != 'success':
+                self.log(f"{timestamp()} - ❌ Сборка run {run_id} завершилась: {run.get('conclusion')}", Colors.RED)
+        self.active = active
+
+        latest = next((r for r in runs if r.get('status') == 'completed' and r.get('conclusion') == 'success'), None)
+        if latest and latest['id'] not in self.handled:
+            self.handled.add(latest['id'])
+            self._take(latest)
+        return not not_modified
+
+    def _take(self, run):
+        """Скачивание, проверка и активация успешной сборки"""
+        self.tag_index.refresh(self.client)
+        remote = GitHubFirmware.describe_run(run, self.tag_index)
+        key = FirmwareStore.build_key(remote)
+        if self.store.current_key() == key:
+            self.log(f"{timestamp()} - ✅ Активна последняя сборка: run {run['id']} ({remote['tag']})", Colors.GREEN)
+            return
+        if not self.store.has_build(key):
+            self.log(f"{timestamp()} - 📦 Сборка run {run['id']} готова, скачиваю...", Colors.BLUE)
+            key = GitHubFirmware.fetch_build(self.client, remote, self.store)
+        failed = GitHubFirmware.verify_build(self.store, key)
+        if failed:
+            for report in failed:
+                print_uf2_errors(report)
+            self.log(f"{timestamp()} - ❌ Сборка run {run['id']} не прошла проверку и не активирована", Colors.RED)
+            return
+        self.store.activate(key)
+        self.downloaded.append(key)
+        self.log(f"{timestamp()} - ✅ Новая прошивка готова: {remote['tag']} {remote['commit_short']} "
+                 f"({remote['commit_message']})", Colors.GREEN)
+
+    def next_interval(self, changed):
+        """Пауза до следующего опроса"""
+        if self.active:
+            self.interval = self.idle_interval
+            wait = self.active_interval
+        else:
+            self.interval = self.idle_interval if changed else min(self.interval * WATCH_BACKOFF, self.max_interval)
+            wait = self.interval
+        remaining, reset = self.client.rate_remaining, self.client.rate_reset
+        if remaining is not None and remaining < WATCH_RATE_RESERVE and reset:
+            wait = max(wait, reset - self.clock())
+        return wait
+
+    def run(self, max_polls=None):
+        """Цикл опроса (max_polls - для тестов)"""
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                changed = self.poll()
+            except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+                self.log(f"{timestamp()} - ⚠️  Ошибка опроса: {e}", Colors.YELLOW)
+                changed = False
+            self.client.save_cache()
+            if max_polls is None or polls < max_polls:
+                self.sleep(self.next_interval(changed))
+        return self.downloaded
+
+class UpdatePrefetch:
+    """Фоновая проверка обновления для команд прошивки (--update).
+
+    Запускается при старте команды и идет, пока человек подключает
+    контроллер и жмет RESET: узнает последнюю успешную сборку CI и, если
+    она новее активной, скачивает и проверяет ее (не активируя).
+    Flasher подхватывает ее перед первой записью сессии. Поток - daemon:
+    незавершенная проверка не задерживает выход. Ошибки не прерывают
+    прошивку - остаются в error.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or FirmwareStore()
+        self.key = None
+        self.remote = None
+        self.error = None
+        self.applied = False
+        self._done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def done(self):
+        return self._done.is_set()
+
+    def ready_key(self):
+        """Ключ скачанной новой сборки, если проверка уже завершилась"""
+        return self.key if self.done() else None
+
+    def _run(self):
+        try:
+            client = GitHubClient(token=GitHubFirmware.check_gh_cli())
+            try:
+                with TELEMETRY.span("update.check") as span:
+                    remote = GitHubFirmware.fetch_remote_version(client)
+                    current = self.store.current_key()
+                    key = FirmwareStore.build_key(remote)
+                    if current and (key == current or
+                                    remote['build_date'] <= self.store.build_info(current).get('build_date', '')):
+                        span['outcome'] = 'current'
+                        return
+                    if not self.store.has_build(key):
+                        key = GitHubFirmware.fetch_build(client, remote, self.store)
+                    if GitHubFirmware.verify_build(self.store, key):
+                        span['outcome'] = 'invalid'
+                        self.error = f"сборка run {remote['run_id']} не прошла проверку UF2"
+                        return
+                    self.key, self.remote = key, remote
+            finally:
+                client.close()
+        except (FirmwareError, OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+            self.error = str(e)
+        finally:
+            self._done.set()
+
+    def print_summary(self):
+        """Итог в конце команды, если сборка не успела к записи"""
+        if self.applied:
+            return
+        if self.key:
+            print_color(f"ℹ️  Новая сборка {self.remote['tag']} {self.remote['commit_short']} скачана уже после "
+                        f"начала записи. Переключиться: ./flash_sofle.py use {self.remote['run_id']}", Colors.BLUE)
+        elif self.error:
+            print_color(f"⚠️  Проверка обновления: {self.error}", Colors.YELLOW)
+
+# ===== Локальная сборка =====
+def parse_build_matrix(path=BUILD_MATRIX_FILE):
+    """Матрица сборки из build.yaml: [{'board', 'shield', 'cmake-args', 'artifact-name'}].
+
+    Понимает то подмножество YAML, которое использует шаблон zmk-config:
+    списки board/shield (в виде [a, b] или '- a') и include со словарями.
+    """
+    lists = {}
+    include = []
+    section = None
+    for raw in Path(path).read_text().splitlines():
+        line = raw.split(' #', 1)[0].rstrip() if not raw.lstrip().startswith('#') else ''
+        if not line.strip() or line.strip() == '---':
+            continue
+        indent = len(line) - len(line.lstrip())
+        text = line.strip()
+        if indent == 0:
+            key, _, value = text.partition(':')
+            section = key.strip()
+            value = value.strip()
+            if value.startswith('['):
+                lists[section] = [v.strip().strip('"\'') for v in value.strip('[]').split(',') if v.strip()]
+            elif value:
+                lists[section] = [value.strip('"\'')]
+            continue
+        item = text.startswith('- ')
+        if item:
+            text = text[2:].strip()
+        if section == 'include':
+            if item:
+                include.append({})
+            if not include:
+                raise ValueError(f"{path}: неверная строка: {raw.strip()}")
+            key, _, value = text.partition(':')
+            include[-1][key.strip()] = value.strip().strip('"\'')
+        elif section and item:
+            lists.setdefault(section, []).append(text.strip('"\''))
+
+    entries = [{'board': board, 'shield': shield}
+               for board in lists.get('board', []) for shield in lists.get('shield', [None])]
+    entries += include
+    for entry in entries:
+        if not entry.get('board'):
+            raise ValueError(f"{path}: у элемента матрицы нет board: {entry}")
+        entry.setdefault('shield', None)
+        entry.setdefault('cmake-args', '')
+        # Имя как у артефактов GitHub Actions: <shield>-<board>-zmk
+        entry.setdefault('artifact-name', '-'.join(filter(None, (entry['shield'], entry['board'], 'zmk'))))
+    return entries
+
+def _build_task(argv, cwd, log_path):
+    """Сборка одного элемента матрицы (в процессе пула); (код возврата, сек)"""
+    start = time.monotonic()
+    with open(log_path, 'w') as log:
+        try:
+            returncode = subprocess.run(argv, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                                        stdin=subprocess.DEVNULL).returncode
+        except OSError as e:
+            log.write(f"{e}\n")
+            returncode = 127
+    return returncode, time.monotonic() - start
+
+class LocalBuilder:
+    """Сборка матрицы build.yaml на этой машине вместо GitHub Actions.
+
+    Каждый элемент матрицы собирается внешней командой (шаблон
+    LOCAL_BUILD_COMMAND или --build-cmd / SOFLE_BUILD_CMD) в своем процессе
+    пула. Результат кэшируется в BUILD_CACHE_DIR по хэшу входов элемента:
+    west.yml, keymap/conf его shield'а и платы, параметры матрицы и
+    команда. Поэтому правка keymap пересобирает только половинки, а
+    settings_reset берется из кэша. Готовые образы попадают в
+    FirmwareStore как обычная сборка - их сразу находит find_firmware.
+    """
+
+    def __init__(self, command=None, workers=None, config_dir=CONFIG_DIR, cache_dir=BUILD_CACHE_DIR):
+        self.command = command or os.environ.get("SOFLE_BUILD_CMD") or LOCAL_BUILD_COMMAND
+        self.workers = workers or os.cpu_count() or 1
+        self.config_dir = Path(config_dir)
+        self.cache_dir = Path(cache_dir)
+        self.root = self.config_dir.parent
+
+    def inputs(self, entry):
+        """Файлы config/, от которых зависит элемент матрицы (как их ищет ZMK)"""
+        names = ['west.yml']
+        if entry['shield']:
+            # sofle_left/sofle_right используют sofle.keymap и sofle.conf
+            base = re.sub(r'_(left|right)$', '', entry['shield'])
+            names += [f"{base}.keymap", f"{base}.conf"]
+        names += [f"{entry['board']}.keymap", f"{entry['board']}.conf"]
+        return [self.config_dir / name for name in names if (self.config_dir / name).exists()]
+
+    def entry_hash(self, entry):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([entry, self.command], sort_keys=True).encode())
+        for path in self.inputs(entry):
+            digest.update(path.name.encode() + b"\0" + path.read_bytes() + b"\0")
+        return digest.hexdigest()
+
+    def _argv(self, entry, build_dir, output):
+        values = {
+            'board': entry['board'], 'shield': entry['shield'] or '', 'cmake_args': entry['cmake-args'],
+            'config': self.config_dir, 'build_dir': build_dir, 'output': output
+        }
+        # cmake_args подставляется как есть - это уже набор аргументов
+        return shlex.split(self.command.format(
+            **{k: shlex.quote(str(v)) if k != 'cmake_args' else v for k, v in values.items()}))
+
+    @staticmethod
+    def _git(*args):
+        out, _ = run_command(["git", *args])
+        return out or ''
+
+    def build_info(self, digests):
+        """Описание локальной сборки для FirmwareStore (как у сборок из GitHub)"""
+        commit = self._git("rev-parse", "HEAD") or '0' * 40
+        dirty = bool(self._git("status", "--porcelain", "--", str(self.config_dir), "build.yaml"))
+        combined = hashlib.sha256("".join(sorted(digests)).encode()).hexdigest()
+        return {
+            'run_id': f"local-{combined[:10]}",
+            'commit': commit,
+            'commit_short': commit[:7],
+            'branch': self._git("rev-parse", "--abbrev-ref", "HEAD") or '-',
+            'build_date': datetime.now().isoformat(timespec='seconds'),
+            'commit_message': (self._git("log", "-1", "--format=%s") or '-') +
+                              (" (+ локальные изменения)" if dirty else ""),
+            'tag': '-',
+            'source': 'local'
+        }
+
+    def run(self, entries, force=False, log=print_color):
+        """Сборка матрицы; возвращает ключ сборки в FirmwareStore или None"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        jobs = []
+        outputs = {}
+        for entry in entries:
+            digest = self.entry_hash(entry)
+            cached = self.cache_dir / f"{digest}.uf2"
+            outputs[entry['artifact-name']] = (digest, cached)
+            if cached.exists() and not force:
+                log(f"♻️  {entry['artifact-name']}: без изменений, из кэша", Colors.BLUE)
+            else:
+                jobs.append((entry, digest, cached))
+
+        failed = []
+        if jobs:
+            log(f"🔨 Собираем {len(jobs)} из {len(entries)} ({min(self.workers, len(jobs))} параллельно)...",
+                Colors.BLUE)
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+                futures = {}
+                for entry, digest, cached in jobs:
+                    build_dir = self.cache_dir / "work" / entry['artifact-name']
+                    build_dir.mkdir(parents=True, exist_ok=True)
+                    output = build_dir / "zmk.uf2"
+                    output.unlink(missing_ok=True)
+                    argv = self._argv(entry, build_dir, output)
+                    future = pool.submit(_build_task, argv, str(self.root), str(build_dir / "build.log"))
+                    futures[future] = (entry, cached, build_dir, output, argv)
+                for future in as_completed(futures):
+                    entry, cached, build_dir, output, argv = futures[future]
+                    name = entry['artifact-name']
+                    returncode, seconds = future.result()
+                    EXECUTOR.record(EXECUTOR.command_name(argv), seconds * 1000, returncode)
+                    # Команда может писать в {output} или оставить образ там же, где west build
+                    produced = next((p for p in (output, build_dir / "zephyr" / "zmk.uf2") if p.exists()), None)
+                    ok = returncode == 0 and produced is not None
+                    TELEMETRY.record("build.target", seconds, 'ok' if ok else 'failed', target=name)
+                    if ok:
+                        os.replace(produced, cached)
+                        log(f"✅ {name}: {seconds:.1f} сек", Colors.GREEN)
+                        continue
+                    failed.append(name)
+                    reason = f"код {returncode}" if returncode else "нет zmk.uf2"
+                    log(f"❌ {name}: ошибка сборки ({reason}), лог: {build_dir / 'build.log'}", Colors.RED)
+                    tail = (build_dir / "build.log").read_text(errors='replace').splitlines()[-10:]
+                    for line in tail:
+                        print(f"   {line}")
+        if failed:
+            return None
+
+        # Копии из кэша: ingest перемещает файлы
+        store = FirmwareStore()
+        info = self.build_info([digest for digest, _ in outputs.values()])
+        key = FirmwareStore.build_key(info)
+        if not store.has_build(key):
+            incoming = DOWNLOADS / f".incoming-{info['run_id']}"
+            shutil.rmtree(incoming, ignore_errors=True)
+            incoming.mkdir(parents=True)
+            try:
+                files = []
+                for name, (_, cached) in outputs.items():
+                    files.append(incoming / f"{name}.uf2")
+                    shutil.copyfile(cached, files[-1])
+                store.ingest(info, files)
+            finally:
+                shutil.rmtree(incoming, ignore_errors=True)
+        store.activate(key)
+        return key
+
+# ===== Отслеживание дисков NICENANO =====
+def _unescape_mountinfo(field):
+    """Декодирование octal-экранирования (\\040 и т.п.) из mountinfo"""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+class DriveWatcher:
+    """Отслеживание появления/исчезновения дисков bootloader'а.
+
+    Вместо опроса раз в секунду ждет уведомлений ОС:
+      • Linux, системные диски: изменения /proc/self/mountinfo (poll POLLPRI)
+      • Linux, каталоги-корни: inotify
+      • macOS: kqueue на /Volumes
+    Если уведомления недоступны - опрос с интервалом DRIVE_POLL_INTERVAL.
+    С devices (DeviceBackend) несмонтированные диски bootloader'а тоже
+    считаются появившимися - как /dev/<device> (станции без автомонтирования),
+    если за AUTOMOUNT_GRACE их так никто и не смонтировал.
+    События: ('appeared', path) и ('disappeared', path).
+    """
+
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, label=BOOTLOADER_LABEL, roots=None, ignore=(), poll_interval=DRIVE_POLL_INTERVAL,
+                 devices=None):
+        self.label = label.upper()
+        self.devices = devices
+        self._unmounted_since = {}
+        self.ignore = {Path(p) for p in ignore}
+        self.poll_interval = poll_interval
+        # Без явных корней на Linux источник правды - таблица монтирования
+        self.use_mountinfo = roots is None and sys.platform.startswith("linux") \
+            and Path("/proc/self/mountinfo").exists()
+        self.roots = [Path(r) for r in roots] if roots is not None else self._default_roots()
+        # Для системных корней каталог в /Volumes появляется раньше, чем монтируется ФС
+        self.require_mount = roots is None
+        self.known = set()
+        self._mountinfo = None
+        self._poller = None
+        self._inotify_fd = None
+        self._kqueue = None
+        self._kq_fds = []
+        self._setup_notifications()
+
+    @staticmethod
+    def _default_roots():
+        if sys.platform == "darwin":
+            return [Path("/Volumes")]
+        user = getpass.getuser()
+        return [Path("/media") / user, Path("/run/media") / user, Path("/media"), Path("/mnt")]
+
+    def _setup_notifications(self):
+        """Подписка на уведомления ОС (если доступны)"""
+        if self.use_mountinfo:
+            self._mountinfo = open("/proc/self/mountinfo")
+            self._poller = select.poll()
+            self._poller.register(self._mountinfo.fileno(), select.POLLPRI | select.POLLERR)
+            return
+
+        roots = [r for r in self.roots if r.is_dir()]
+        if not roots:
+            return
+
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+                fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+                if fd < 0:
+                    return
+                mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+                for root in roots:
+                    libc.inotify_add_watch(fd, str(root).encode(), mask)
+                self._inotify_fd = fd
+            except (OSError, AttributeError):
+                self._inotify_fd = None
+        elif hasattr(select, "kqueue"):
+            self._kqueue = select.kqueue()
+            changes = []
+            for root in roots:
+                fd = os.open(root, os.O_RDONLY)
+                self._kq_fds.append(fd)
+                changes.append(select.kevent(
+                    fd,
+                    filter=select.KQ_FILTER_VNODE,
+                    flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                    fflags=select.KQ_NOTE_WRITE
+                ))
+            self._kqueue.control(changes, 0)
+
+    def close(self):
+        """Освобождение дескрипторов"""
+        if self._mountinfo:
+            self._mountinfo.close()
+            self._mountinfo = None
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+        if self._kqueue:
+            self._kqueue.close()
+            self._kqueue = None
+        for fd in self._kq_fds:
+            os.close(fd)
+        self._kq_fds = []
+
+    def _matches(self, path):
+        if any(path == p or p in path.parents for p in self.ignore):
+            return False
+        return self.label in path.name.upper()
+
+    def snapshot(self):
+        """Текущий набор смонтированных дисков bootloader'а"""
+        found = set()
+        if self.devices is not None:
+            now = time.monotonic()
+            names = self.devices.bootloader_devices()
+            self._unmounted_since = {name: self._unmounted_since.get(name, now) for name in names}
+            found.update(Path("/dev") / name for name, since in self._unmounted_since.items()
+                         if now - since >= AUTOMOUNT_GRACE)
+        if self.use_mountinfo:
+            self._mountinfo.seek(0)
+            for line in self._mountinfo.read().splitlines():
+                fields = line.split()
+                if len(fields) > 4:
+                    mount_point = Path(_unescape_mountinfo(fields[4]))
+                    if self._matches(mount_point):
+                        found.add(mount_point)
+            return found
+
+        for root in self.roots:
+            if not root.is_dir():
+                continue
+            for v in root.iterdir():
+                if self._matches(v) and (not self.require_mount or os.path.ismount(v)):
+                    found.add(v)
+        return found
+
+    def _pending_mounts(self):
+        """Есть ли каталоги дисков, которые еще не смонтированы"""
+        if not self.require_mount or self.use_mountinfo:
+            return False
+        return any(
+            self._matches(v) and not os.path.ismount(v)
+            for root in self.roots if root.is_dir()
+            for v in root.iterdir()
+        )
+
+    def _wait_notification(self, timeout):
+        """Ожидание уведомления ОС (или таймаута)"""
+        if self._pending_mounts():
+            timeout = min(timeout, self.poll_interval)
+
+        if self._poller:
+            return bool(self._poller.poll(timeout * 1000))
+        if self._inotify_fd is not None:
+            ready, _, _ = select.select([self._inotify_fd], [], [], timeout)
+            if ready:
+                try:
+                    while os.read(self._inotify_fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            return bool(ready)
+        if self._kqueue:
+            return bool(self._kqueue.control(None, 8, timeout))
+
+        time.sleep(min(timeout, self.poll_interval))
+        return True
+
+    def poll_events(self, timeout):
+        """Ожидание изменений до timeout секунд, возвращает список событий"""
+        self._wait_notification(max(timeout, 0))
+        current = self.snapshot()
+        events = [('appeared', p) for p in sorted(current - self.known)]
+        events += [('disappeared', p) for p in sorted(self.known - current)]
+        self.known = current
+        return events
+
+    def wait_appeared(self, timeout=None, tick=None):
+        """Ожидание диска. Уже подключенный диск считается появившимся сразу.
+
+        tick(remaining) вызывается примерно раз в секунду для обратного отсчета.
+        Возвращает путь к диску или None по таймауту.
+        """
+        self.known = self.snapshot()
+        if self.known:
+            return sorted(self.known)[0]
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            if tick and remaining is not None:
+                tick(remaining)
+            wait = 1.0 if remaining is None else min(1.0, remaining)
+            for kind, path in self.poll_events(wait):
+                if kind == 'appeared':
+                    return path
+
+    def wait_disappeared(self, path=None, timeout=None):
+        """Ожидание исчезновения диска path (или всех дисков, если path=None)"""
+        def gone():
+            return path not in self.known if path is not None else not self.known
+
+        self.known = self.snapshot()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not gone():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.poll_events(1.0 if remaining is None else min(1.0, remaining))
+        return True
+
+# ===== UF2 образы =====
+def validate_uf2(fw_file, target=None):
+    """Проверка UF2 образа перед прошивкой.
+
+    Файл отображается в память и разбирается как массив 32-битных слов:
+    каждое поле заголовка всех блоков берется одним срезом с шагом 128 слов,
+    без цикла по блокам на Python. target - ключ из FIRMWARE_TARGETS.
+    Возвращает {'path', 'size', 'blocks', 'sha256', 'address_range', 'errors'}.
+    """
+    path = Path(fw_file)
+    errors = []
+    report = {
+        'path': str(path),
+        'size': 0,
+        'blocks': 0,
+        'sha256': None,
+        'address_range': None,
+        'errors': errors
+    }
+
+    # Образ должен соответствовать половинке, на которую его пишут
+    if target:
+        expected = FIRMWARE_TARGETS[target]
+        if not path.name.startswith(expected + "-"):
+            other = [k for k, prefix in FIRMWARE_TARGETS.items() if path.name.startswith(prefix + "-")]
+            hint = f" (это образ '{other[0]}')" if other else ""
+            errors.append(f"образ {path.name} не для '{target}', ожидается {expected}-*.uf2{hint}")
+
+    size = path.stat().st_size
+    report['size'] = size
+    if size == 0 or size % UF2_BLOCK_SIZE:
+        errors.append(f"размер {size} байт не кратен {UF2_BLOCK_SIZE} - файл обрезан")
+        return report
+
+    blocks = size // UF2_BLOCK_SIZE
+    stride = UF2_BLOCK_SIZE // 4
+    report['blocks'] = blocks
+
+    # Срезы memoryview читают слова в порядке байт машины, UF2 - little-endian
+    if sys.byteorder != 'little':
+        errors.append("проверка UF2 поддерживается только на little-endian системах")
+        return report
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        report['sha256'] = hashlib.sha256(mm).hexdigest()
+        with memoryview(mm) as raw, raw.cast('I') as words:
+            def column(index):
+                with words[index::stride] as view:
+                    return view.tolist()
+
+            if set(column(0)) != {UF2_MAGIC_START0} or set(column(1)) != {UF2_MAGIC_START1}:
+                errors.append("неверные magic-числа в начале блоков")
+            if set(column(stride - 1)) != {UF2_MAGIC_END}:
+                errors.append("неверное magic-число в конце блоков")
+
+            if set(column(6)) != {blocks}:
+                errors.append(f"поле numBlocks не совпадает с числом блоков в файле ({blocks})")
+            with words[5::stride] as block_numbers:
+                if block_numbers.tobytes() != array('I', range(blocks)).tobytes():
+                    errors.append("нарушена последовательность номеров блоков")
+
+            flags = set(column(2))
+            if not all(flag & UF2_FLAG_FAMILY_ID for flag in flags):
+                errors.append("не у всех блоков указан familyID")
+            elif set(column(7)) != {NRF52840_FAMILY_ID}:
+                errors.append(f"familyID не nRF52840 (0x{NRF52840_FAMILY_ID:08X})")
+
+            payloads = column(4)
+            if min(payloads) == 0 or max(payloads) > UF2_MAX_PAYLOAD:
+                errors.append("недопустимый размер полезной нагрузки блока")
+
+            addresses = column(3)
+            low, high = min(addresses), max(addresses) + max(payloads)
+            report['address_range'] = (low, high)
+            app_start, app_end = NRF52840_APP_RANGE
+            if low < app_start or high > app_end:
+                errors.append(f"адреса 0x{low:08X}-0x{high:08X} вне области приложения "
+                              f"0x{app_start:08X}-0x{app_end:08X}")
+
+    return report
+
+def print_uf2_errors(report):
+    """Вывод ошибок проверки UF2"""
+    print_color(f"❌ Образ не прошел проверку: {report['path']}", Colors.RED)
+    for error in report['errors']:
+        print_color(f"   • {error}", Colors.RED)
+
+# ===== Запись UF2 =====
+def format_size(num_bytes):
+    """Размер в человекочитаемом виде"""
+    if num_bytes < 1024:
+        return f"{num_bytes} Б"
+    if num_bytes < 1024 * 1024:
+        return f"{num_bytes / 1024:.1f} КБ"
+    return f"{num_bytes / 1024 / 1024:.1f} МБ"
+
+def _fsync_durable(fd):
+    """fsync одного файла; на macOS - F_FULLFSYNC (сброс кеша самого устройства)"""
+    if hasattr(fcntl, "F_FULLFSYNC"):
+        try:
+            fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+            return
+        except OSError:
+            pass
+    os.fsync(fd)
+
+def print_write_progress(written, total, elapsed):
+    """Прогресс записи в одну строку"""
+    percent = written * 100 // total if total else 100
+    rate = written / elapsed if elapsed > 0 else 0
+    print(f"\r📝 Запись: {percent:3d}% ({format_size(written)} / {format_size(total)}, {format_size(int(rate))}/с)",
+          end='', flush=True)
+
+def _open_uncached(dest):
+    """Открытие файла для записи мимо страничного кеша: (fd, O_DIRECT включен).
+
+    Linux - O_DIRECT (если ФС его не поддерживает - обычное открытие),
+    macOS - F_NOCACHE. Файл создается одним open без временных файлов
+    и расширенных атрибутов, поэтому на диске не появляется ._* и т.п.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(dest, flags | os.O_DIRECT, 0o644), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    fd = os.open(dest, flags, 0o644)
+    if sys.platform == "darwin":
+        try:
+            fcntl.fcntl(fd, getattr(fcntl, "F_NOCACHE", 48), 1)
+        except OSError:
+            pass
+    return fd, False
+
+def write_uf2(fw_file, dest_dir, progress=None, direct=False):
+    """Потоковая запись UF2 на диск bootloader'а.
+
+    Пишет блоками, кратными 512 байт (UF2-блок), затем fsync только этого
+    файла. direct=True - запись мимо кеша ОС (_open_uncached): буфер
+    выровнен по странице, как требует O_DIRECT. Возвращает статистику:
+    {'bytes', 'seconds', 'sync_seconds', 'throughput', 'uncached'}.
+    """
+    src = Path(fw_file)
+    dest = Path(dest_dir) / src.name
+    total = src.stat().st_size
+    chunk_size = UF2_BLOCK_SIZE * WRITE_CHUNK_BLOCKS
+    buf = mmap.mmap(-1, chunk_size)
+    written = 0
+    start = time.monotonic()
+    sync_start = None
+
+    with open(src, 'rb', buffering=0) as fin:
+        if direct:
+            fd, o_direct = _open_uncached(dest)
+        else:
+            fd, o_direct = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644), False
+        try:
+            while True:
+                n = fin.readinto(buf)
+                if not n:
+                    break
+                if o_direct and n % UF2_BLOCK_SIZE:
+                    # Хвост не кратен блоку - O_DIRECT его не примет
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                    o_direct = False
+                view = memoryview(buf)[:n]
+                while view:
+                    n = os.write(fd, view)
+                    view = view[n:]
+                    written += n
+                if progress:
+                    progress(written, total, time.monotonic() - start)
+            sync_start = time.monotonic()
+            _fsync_durable(fd)
+        except OSError:
+            # Bootloader перезагружается сразу после последнего блока -
+            # ошибка после полной записи не означает неудачу
+            if written < total:
+                raise
+        finally:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    end = time.monotonic()
+    seconds = end - start
+    return {
+        'bytes': written,
+        'seconds': seconds,
+        'sync_seconds': end - sync_start if sync_start is not None else 0.0,
+        'throughput': written / seconds if seconds > 0 else 0,
+        'uncached': direct
+    }
+
+# ===== Журнал прошивок =====
+def read_uf2_info(volume):
+    """Поля INFO_UF2.TXT диска bootloader'а: {'Model': ..., 'Board-ID': ...}"""
+    try:
+        text = (Path(volume) / "INFO_UF2.TXT").read_text(errors='replace')
+    except OSError:
+        return {}
+    info = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            info[key.strip()] = value.strip()
+    return info
+
+def image_digest(path):
+    """SHA-256 образа (ключ журнала прошивок)"""
+    return file_sha256(path)
+
+class FlashLedger:
+    """Журнал: какой образ последним записан на каждый контроллер.
+
+    Контроллер опознается по Board-ID из INFO_UF2.TXT и серийному номеру
+    USB (у nice!nano это уникальный ID чипа). По журналу Flasher
+    пропускает запись образа, который уже стоит на подключенном
+    контроллере, и узнает, какая половинка подключена. Своего файла у
+    журнала нет: это представление таблицы flashes истории (HistoryDB),
+    запись - {'target', 'half', 'digest', 'file', 'time'} последней
+    успешной прошивки, где half - последняя записанная половинка
+    (left/right): reset-образ ее не меняет.
+    """
+
+    def __init__(self, history=None):
+        self.history = history or HISTORY
+
+    @staticmethod
+    def identify(volume, device, devices):
+        """Идентификатор контроллера или None (серийный номер недоступен)"""
+        serial = devices.serial(device) if device else None
+        if not serial:
+            return None
+        return f"{read_uf2_info(volume).get('Board-ID', 'unknown')}:{serial}"
+
+    @staticmethod
+    def _entry(row):
+        return {'target': row['target'], 'half': row['half'], 'digest': row['digest'], 'file': row['file'],
+                'time': datetime.fromtimestamp(row['time']).isoformat(timespec='seconds')}
+
+    def get(self, identity):
+        row = self.history.last_flash(identity) if identity else None
+        return self._entry(row) if row else None
+
+    def holders(self, half):
+        """Контроллеры, известные как половинка half"""
+        return [(row['device'], self._entry(row)) for row in self.history.devices_with_half(half)]
+
+    def record(self, identity, target, digest, fw_file, seconds=None, ok=True, error=None):
+        """Запись образа на контроллер (успешная или нет) - сразу в историю"""
+        previous = self.get(identity)
+        half = target if target in FIRMWARE_HALVES else previous and previous['half']
+        self.history.add_flash(identity, target, half, digest, fw_file, seconds, ok, error)
+
+# ===== Прошивка =====
+class Flasher:
+    def __init__(self, sudo_mgr, force_mode=False, mount_dir=MOUNT_DIR, watcher=None, devices=HOST_DEVICES,
+                 ledger=None, reflash=False, direct=False, history=None, store=None):
+        self.sudo = sudo_mgr
+        self.store = store or FirmwareStore()
+        self.force_mode = force_mode
+        # direct=True - запись прямо на автосмонтированный диск, без unmount/mount/eject и sudo
+        self.direct = direct
+        # reflash=True - писать образ, даже если журнал говорит, что он уже на контроллере
+        self.ledger = ledger or FlashLedger(history)
+        self.history = self.ledger.history
+        self.reflash = reflash
+        self._digests = {}
+        self.mount_dir = Path(mount_dir)
+        self.mount_dir.mkdir(parents=True, exist_ok=True)
+        self.devices = devices
+        # Несмонтированный диск (/dev/<device>) в режиме direct записать некуда
+        self.watcher = watcher or DriveWatcher(ignore=[self.mount_dir], devices=None if direct else devices)
+        self.validator = ThreadPoolExecutor(max_workers=2)
+        self._validations = {}
+        # --update: сборка, скачиваемая в фоне, подменяет образы до первой записи
+        self.update = None
+        self._writes_started = False
+        self._swapped = {}
+
+    @staticmethod
+    def _firmware_files(source):
+        """Образы каталога по целям: {'left': [пути], ...}"""
+        return {
+            key: sorted(source.glob(f"{prefix}-*.uf2"))
+            for key, prefix in FIRMWARE_TARGETS.items()
+        }
+
+    def find_firmware(self):
+        """Поиск файлов прошивки (активная сборка хранилища или DOWNLOADS)"""
+        source = self.store.current_dir() or DOWNLOADS
+        files = self._firmware_files(source)
+
+        if not files['left'] or not files['right']:
+            print_color(f"❌ Не найдены прошивки в {source}", Colors.RED)
+            sys.exit(1)
+
+        firmware = {
+            'left': str(files['left'][0]),
+            'right': str(files['right'][0]),
+            'reset': str(files['reset'][0]) if files['reset'] else None
+        }
+
+        # Показываем версию
+        if self.store.version_file.exists():
+            GitHubFirmware.show_version(self.store)
+            print()
+
+        print_color("✅ Найдены прошивки:", Colors.GREEN)
+        print(f"   Левая  = {firmware['left']}")
+        print(f"   Правая = {firmware['right']}")
+        if firmware['reset']:
+            print(f"   Reset  = {firmware['reset']}")
+
+        return firmware
+
+    def image_for_write(self, fw_file):
+        """Образ для записи. Перед первой записью сессии подхватывает
+        сборку, которую успел скачать UpdatePrefetch (позже - нет,
+        чтобы половинки не оказались с разными сборками)."""
+        if self.update is not None and not self._writes_started:
+            key = self.update.ready_key()
+            if key:
+                self._swap_in(key)
+        self._writes_started = True
+        return self._swapped.get(str(fw_file), fw_file)
+
+    def _swap_in(self, key):
+        """Активация скачанной в фоне сборки и замена путей образов"""
+        store = self.update.store
+        old = self._firmware_files(store.current_dir() or DOWNLOADS)
+        store.activate(key)
+        new = self._firmware_files(store.current_dir())
+        self._swapped = {
+            str(path): str(new[target][0])
+            for target, paths in old.items() if new[target]
+            for path in paths
+        }
+        self.update.applied = True
+        remote = self.update.remote
+        print()
+        print_color(f"🔄 Пока ждали диск, скачана новая сборка {remote['tag']} {remote['commit_short']} "
+                    f"({remote['commit_message']}) - прошиваем ее", Colors.GREEN)
+
+    def image_digest(self, fw_file):
+        """SHA-256 образа (один раз на файл)"""
+        key = str(fw_file)
+        if key not in self._digests:
+            self._digests[key] = image_digest(fw_file)
+        return self._digests[key]
+
+    def _validate_async(self, fw_file, target):
+        """Фоновая проверка образа; результат кешируется по (файл, target)"""
+        key = (str(fw_file), target)
+        if key not in self._validations:
+            self._validations[key] = self.validator.submit(validate_uf2, fw_file, target)
+        return self._validations[key]
+
+    @staticmethod
+    def _check_validation(validation, wait=False):
+        """Выход с ошибкой, если образ не прошел проверку"""
+        if not wait and not validation.done():
+            return
+        report = validation.result()
+        if report['errors']:
+            print()
+            print_uf2_errors(report)
+            sys.exit(1)
+
+    @staticmethod
+    def _print_instructions(half_name):
+        """Что сделать перед прошивкой половинки"""
+        print()
+        print("━" * 60)
+        print_color(f"⚠️  ПРОШИВКА: {half_name}", Colors.YELLOW)
+        print("━" * 60)
+        print()
+        print("📋 Что нужно сделать:")
+        print("   1. Отключи TRRS кабель между половинками!")
+        print("   2. Отключи USB от обеих половин")
+        print("   3. Проверь переключатель питания:")
+        print("      • Правая половинка: ON = вниз ⬇️")
+        print("      • Левая половинка:  ON = вверх ⬆️")
+        print(f"   4. Подключи USB только к: {half_name}")
+        print("   5. Нажми 2 раза кнопку RESET на контроллере")
+        print("      (появится диск NICENANO)")
+        print()
+        print("⏳ Жду диск NICENANO... (таймаут 60 сек)")
+        print("   (нажми Ctrl+C для отмены)")
+        print()
+
+    @staticmethod
+    def _exit_on_timeout():
+        """Таймаут ожидания диска: подсказка и выход"""
+        print()
+        print()
+        print_color("⏱️  Таймаут истек! Диск NICENANO не обнаружен.", Colors.RED)
+        print()
+        print("━" * 60)
+        print_color("💡 МЕТОД B: Альтернативный вход в bootloader", Colors.YELLOW)
+        print("━" * 60)
+        print()
+        print("Попробуй этот метод, если двойной reset не работает:")
+        print()
+        print("   1. Отключи USB от клавиатуры")
+        print("   2. Найди кнопку RESET на контроллере")
+        print("   3. НАЖМИ и УДЕРЖИВАЙ кнопку RESET")
+        print("   4. Подключи USB (продолжая ДЕРЖАТЬ RESET!)")
+        print("   5. Держи RESET ещё 2-3 секунды после подключения")
+        print("   6. Отпусти RESET")
+        print("   7. Должен появиться диск NICENANO")
+        print()
+        print("Альтернатива: замкни контакты RST и GND скрепкой дважды")
+        print()
+        sys.exit(1)
+
+    def _wait_for_drive(self, validation, busy_devices=(), timeout=60):
+        """Ожидание диска NICENANO (timeout=None - без ограничения).
+
+        Диски из busy_devices (предыдущий шаг еще перезагружается)
+        пропускаются. По таймауту - подсказка и выход.
+        """
+        def countdown(remaining):
+            self._check_validation(validation)
+            print(f"\r⏳ Осталось: {math.ceil(remaining):02d} сек...", end='', flush=True)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with TELEMETRY.span("flash.detect") as span:
+            while True:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                mount_point = self.watcher.wait_appeared(timeout=remaining, tick=countdown)
+                self._check_validation(validation, wait=True)
+                if mount_point is None:
+                    span['outcome'] = 'timeout'
+                    self._exit_on_timeout()
+                if busy_devices and self.devices.for_mount(mount_point) in busy_devices:
+                    self.watcher.wait_disappeared(mount_point, timeout=DEVICE_GONE_TIMEOUT)
+                    continue
+                return mount_point
+
+    def _print_flashed(self, half_name, result):
+        """Итог записи половинки (при ошибке - выход)"""
+        if not result['ok']:
+            print()
+            print_color(f"❌ Ошибка ({result['failed_phase']}): {result['error']}", Colors.RED)
+            if result['failed_phase'] == 'mount':
+                print(f"💡 Попробуй вручную: {HOST_DEVICES.mount_hint(result['device'], self.mount_dir)}")
+            sys.exit(1)
+
+        if result['skipped']:
+            print()
+            print_color(f"✅ {half_name}: этот образ уже записан на контроллер (журнал прошивок) - "
+                        f"запись пропущена", Colors.GREEN)
+            print("   Нажми RESET один раз, чтобы выйти из bootloader'а (--reflash - прошить заново)")
+            print()
+            return
+
+        stats = result['stats']
+        print()
+        print_color(f"✅ {half_name} успешно прошита! "
+                    f"({format_size(stats['bytes'])} за {stats['seconds']:.2f} сек, "
+                    f"{format_size(int(stats['throughput']))}/с)", Colors.GREEN)
+        print(f"   Отключи USB от этой половины.")
+
+        print()
+        print_color("ℹ️  ВАЖНО: Контроллер перезагрузится автоматически", Colors.YELLOW)
+        print("   macOS может показать ошибку 'диск извлечен неправильно'")
+        print("   ✅ Это НОРМАЛЬНО - так работает bootloader!")
+        print("   ✅ Прошивка записана успешно, ошибку можно игнорировать")
+        print()
+
+    def flash_half(self, fw_file, half_name, target=None):
+        """Прошивка одной половинки (target - ключ из FIRMWARE_TARGETS)"""
+        if not Path(fw_file).exists():
+            print_color(f"❌ Файл прошивки не найден: {fw_file}", Colors.RED)
+            sys.exit(1)
+
+        # Проверка образа идет в фоне, пока ждем диск
+        validation = self._validate_async(fw_file, target)
+
+        if not self.force_mode:
+            self._print_instructions(half_name)
+
+        # Ожидание подключения диска (тем временем может прийти обновление)
+        mount_point = self._wait_for_drive(validation)
+        print(f"{timestamp()} - {half_name} подключена: {mount_point}")
+        swapped = self.image_for_write(fw_file)
+        if swapped != fw_file:
+            fw_file = swapped
+            self._check_validation(self._validate_async(fw_file, target), wait=True)
+
+        result = self.flash_device(
+            mount_point, fw_file, self.mount_dir,
+            on_unmount_failed=self._ask_after_unmount_failure,
+            progress=print_write_progress,
+            target=target
+        )
+        self._print_flashed(half_name, result)
+
+        # Ждем отключения диска
+        print()
+        print("⏳ Жду отключения диска NICENANO...")
+        with TELEMETRY.span("flash.disconnect", device=result['device']):
+            self.watcher.wait_disappeared()
+        print_color("✅ Диск отключен, можно продолжать", Colors.GREEN)
+        print()
+
+        # Показываем подсказку
+        print("ℹ️  Если следующая половинка не подключается:")
+        print("   Попробуй МЕТОД B:")
+        print("   1. Отключи USB")
+        print("   2. УДЕРЖИВАЙ кнопку RESET")
+        print("   3. Подключи USB (продолжая держать RESET)")
+        print("   4. Отпусти RESET через 2-3 секунды")
+        print()
+
+    def _ask_after_unmount_failure(self, volume):
+        """Интерактивный выбор после неудачного unmount; True - продолжать"""
+        print_color(f"❌ Не удалось unmount после 3 попыток", Colors.RED)
+        print()
+        choice = input("Продолжить? (y - да, n - выход, r - повторить unmount): ").strip().lower()
+        if choice == 'n':
+            sys.exit(1)
+        elif choice == 'r':
+            # Даем пользователю время вручную unmount
+            print(f"Попробуй вручную: {HOST_DEVICES.unmount_hint(volume)}")
+            input("Нажми Enter когда unmount будет готов...")
+        # Если 'y' или другое - продолжаем
+        return True
+
+    def flash_device(self, volume, fw_file, mount_dir=None, on_unmount_failed=None,
+                     progress=None, log=print_color, on_phase=None, eject=True, target=None):
+        """Unmount → mount в mount_dir → запись → eject для одного диска.
+
+        on_unmount_failed(volume) решает, продолжать ли после 3 неудачных
+        попыток unmount (без него - ошибка); on_phase(name) вызывается
+        в начале фаз unmount/write/eject. eject=False оставляет извлечение
+        вызывающему (конвейер делает его в фоне). В режиме direct образ
+        пишется прямо в volume мимо кеша ОС, unmount/mount/eject не
+        выполняются (direct=True в результате). Если журнал прошивок
+        говорит, что образ уже на контроллере, запись пропускается
+        (skipped=True, диск остается в bootloader'е). Возвращает
+        {'volume', 'device', 'identity', 'ok', 'skipped', 'direct', 'error',
+        'failed_phase', 'stats', 'phases'}, где phases - длительность фаз в секундах.
+        Каждая запись (успешная или нет) попадает в историю прошивок.
+        """
+        start = time.monotonic()
+        result = self._flash_device(volume, fw_file, mount_dir, on_unmount_failed, progress, log,
+                                    on_phase, eject, target)
+        if not result['skipped'] and result['device']:
+            self.ledger.record(result['identity'], target, self.image_digest(fw_file), fw_file,
+                               time.monotonic() - start, result['ok'], result['error'])
+        return result
+
+    def _flash_device(self, volume, fw_file, mount_dir, on_unmount_failed, progress, log, on_phase,
+                      eject, target):
+        result = {
+            'volume': str(volume),
+            'device': None,
+            'identity': None,
+            'ok': False,
+            'skipped': False,
+            'direct': self.direct,
+            'error': None,
+            'failed_phase': None,
+            'stats': None,
+            'phases': {}
+        }
+        phases = result['phases']
+
+        def enter(name):
+            if on_phase:
+                on_phase(name)
+
+        def track(name, op_result, **attrs):
+            phases[name] = phases.get(name, 0) + op_result['ms'] / 1000
+            TELEMETRY.record(f"flash.{name}", op_result['ms'] / 1000,
+                             outcome='ok' if op_result['ok'] else 'error', device=result['device'], **attrs)
+            return op_result['ok']
+
+        def fail(phase, error):
+            result['failed_phase'] = phase
+            result['error'] = error
+            return result
+
+        device = self.devices.for_mount(volume)
+        if not device:
+            return fail('detect', f"не удалось определить устройство для {volume}")
+        result['device'] = device
+
+        # Reset-образ ценен побочным эффектом (очистка настроек) - его не пропускаем
+        identity = result['identity'] = self.ledger.identify(volume, device, self.devices)
+        digest = self.image_digest(fw_file)
+        entry = self.ledger.get(identity)
+        if entry and entry['digest'] == digest and target != 'reset' and not self.reflash:
+            TELEMETRY.record("flash.skip", 0, device=device, target=target)
+            result.update(ok=True, skipped=True)
+            return result
+
+        if self.direct:
+            if Path(volume).parent == Path("/dev"):
+                return fail('detect', f"{volume} не смонтирован - для --direct нужно автомонтирование")
+            return self._write(result, fw_file, Path(volume), progress, enter)
+
+        mount_dir = Path(mount_dir or self.mount_dir)
+        mount_dir.mkdir(parents=True, exist_ok=True)
+
+        # Unmount + mount одним пакетом через помощника (без повторного sudo)
+        enter('unmount')
+        mount_op = {'op': 'mount', 'device': f"/dev/{device}", 'target': str(mount_dir),
+                    'uid': os.getuid(), 'gid': os.getgid()}
+        results = self.sudo.batch([{'op': 'unmount', 'path': str(volume)}, mount_op], stop_on_error=True)
+        unmounted = track('unmount', results[0], attempt=1)
+        mount_result = results[1] if len(results) > 1 else None
+
+        # Повторные попытки - force unmount
+        for attempt in range(1, 3):
+            if unmounted:
+                break
+            log(f"⚠️  Попытка {attempt + 1}/3: принудительный unmount...", Colors.YELLOW)
+            time.sleep(1)
+            unmounted = track('unmount', self.sudo.call('unmount', path=str(volume), force=True),
+                              attempt=attempt + 1)
+            if unmounted:
+                log("✅ Принудительный unmount успешен", Colors.GREEN)
+
+        if not unmounted and not (on_unmount_failed and on_unmount_failed(volume)):
+            return fail('unmount', "не удалось unmount после 3 попыток")
+
+        # Mount
+        if mount_result is None:
+            mount_result = self.sudo.batch([mount_op])[0]
+        if not track('mount', mount_result):
+            return fail('mount', mount_result['err'])
+
+        if not self._write(result, fw_file, mount_dir, progress, enter)['ok']:
+            return result
+
+        # Корректно извлекаем диск (eject); bootloader к этому моменту
+        # может уже перезагрузиться - ошибка eject не критична
+        if eject:
+            enter('eject')
+            track('eject', self.sudo.call('eject', path=str(mount_dir)))
+        return result
+
+    def _write(self, result, fw_file, dest_dir, progress, enter):
+        """Фаза write flash_device: запись образа в dest_dir"""
+        device = result['device']
+        # fsync только этого файла, без фиксированной паузы
+        enter('write')
+        write_start = time.monotonic()
+        try:
+            result['stats'] = stats = write_uf2(fw_file, dest_dir, progress=progress, direct=self.direct)
+        except OSError as e:
+            TELEMETRY.record("flash.copy", time.monotonic() - write_start, outcome='error', device=device)
+            result.update(failed_phase='write', error=str(e))
+            return result
+        result['phases']['write'] = stats['seconds']
+        TELEMETRY.record("flash.copy", stats['seconds'] - stats['sync_seconds'], device=device,
+                         bytes=stats['bytes'], direct=self.direct)
+        TELEMETRY.record("flash.sync", stats['sync_seconds'], device=device)
+
+        result['ok'] = True
+        return result
+
+    def clear_btpairs(self, firmware):
+        """Очистка BT-пар и перепрошивка"""
+        if not firmware['reset']:
+            print_color(f"❌ Reset-прошивка не найдена в {DOWNLOADS}", Colors.RED)
+            sys.exit(1)
+
+        print(f"{timestamp()} - ⚠️ Сначала будет прошивка reset на ОБЕ половинки, все BT-пары удалятся!")
+        print()
+
+        FlashSequencer(self).run([
+            {'fw': firmware['reset'], 'target': 'reset', 'name': "правую половину (reset)",
+             'title': "📋 ШАГ 1/4: Reset правой половины"},
+            {'fw': firmware['reset'], 'target': 'reset', 'name': "левую половину (reset)",
+             'title': "📋 ШАГ 2/4: Reset левой половины"},
+            {'fw': firmware['right'], 'target': 'right', 'name': "правую половину",
+             'title': "📋 ШАГ 3/4: Основная прошивка правой половины",
+             'intro': [
+                 ("✅ BT-пары очищены на обеих половинках", Colors.GREEN),
+                 (f"{timestamp()} - 🔄 Прошиваем основную прошивку (правую → левую)...", Colors.NC)
+             ]},
+            {'fw': firmware['left'], 'target': 'left', 'name': "левую половину",
+             'title': "📋 ШАГ 4/4: Основная прошивка левой половины"}
+        ])
+
+        print()
+        print_color("✅ Обе половины перепрошиты (reset + основная прошивка)", Colors.GREEN)
+
+        self.show_post_flash_help()
+
+    def flash_all(self, firmware):
+        """Прошивка обеих половин"""
+        FlashSequencer(self).run([
+            {'fw': firmware['right'], 'target': 'right', 'name': "правую половину",
+             'title': "📋 Прошивка правой половины"},
+            {'fw': firmware['left'], 'target': 'left', 'name': "левую половину",
+             'title': "📋 Прошивка левой половины"}
+        ])
+
+        self.show_post_flash_help()
+
+    def show_post_flash_help(self):
+        """Инструкции после прошивки"""
+        print()
+        print("━" * 60)
+        print_color("✅ ОБЕ ПОЛОВИНЫ ПРОШИТЫ!", Colors.GREEN)
+        print("━" * 60)
+        print()
+        print("📋 ШАГИ ДЛЯ ПОДКЛЮЧЕНИЯ:")
+        print()
+        print("1️⃣  Проверь переключатели питания:")
+        print("   • Правая половинка: ON = вниз ⬇️")
+        print("   • Левая половинка:  ON = вверх ⬆️")
+        print()
+        print("2️⃣  Подключи TRRS кабель между половинами")
+        print("   ⚠️  ВАЖНО: TRRS должен быть надежно вставлен с обеих сторон")
+        print()
+        print("3️⃣  Подключи USB к ЛЕВОЙ половине")
+        print("   💡 Левая половина = центральная (central)")
+        print("   💡 Правая половина = периферийная (peripheral)")
+        print()
+        print("4️⃣  Подожди 5-10 секунд для инициализации")
+        print()
+        print("━" * 60)
+        print_color("🔧 ЕСЛИ ПРАВАЯ ПОЛОВИНА НЕ ВИДИТ ЛЕВУЮ:", Colors.YELLOW)
+        print("━" * 60)
+        print()
+        print("ВАРИАНТ 1: Проверь TRRS кабель")
+        print("   • Отключи USB")
+        print("   • Отключи TRRS кабель")
+        print("   • Подожди 5 секунд")
+        print("   • Подключи TRRS кабель заново (проверь, что вставлен до конца)")
+        print("   • Подключи USB к левой половине")
+        print()
+        print("ВАРИАНТ 2: Hard reset обеих половин")
+        print("   • Отключи USB и TRRS")
+        print("   • Нажми кнопку RESET на правой половине")
+        print("   • Нажми кнопку RESET на левой половине")
+        print("   • Подключи TRRS кабель")
+        print("   • Подключи USB к левой половине")
+        print()
+        print("ВАРИАНТ 3: Очистка BT-пар (если используешь Bluetooth)")
+        print("   • Выполни: ./flash_sofle.py btclear")
+        print("   • Это очистит все BT-соединения и перепрошьет обе половины")
+        print()
+        print("ВАРИАНТ 4: Проверь порядок прошивки")
+        print("   • ВАЖНО: сначала правая, потом левая!")
+        print("   • Если прошил в обратном порядке:")
+        print("     ./flash_sofle.py right")
+        print("     ./flash_sofle.py left")
+        print()
+        print("ВАРИАНТ 5: Проверь физическое соединение")
+        print("   • TRRS кабель может быть неисправен - попробуй другой")
+        print("   • TRRS разъемы могут быть загрязнены - протри спиртом")
+        print("   • Проверь, что в TRRS разъёмах нет мусора/пыли")
+        print()
+        print("━" * 60)
+        print_color("💡 ДИАГНОСТИКА:", Colors.BLUE)
+        print("━" * 60)
+        print()
+        print("Проверить версию прошивки:")
+        print("   ./flash_sofle.py version")
+        print()
+        print("━" * 60)
+        print_color("🔓 LOCK/UNLOCK КЛАВИАТУРЫ:", Colors.BLUE)
+        print("━" * 60)
+        print()
+        print("Блокировка:   ЛЕВЫЙ Shift + Lower + Raise")
+        print("Разблокировка: ПРАВЫЙ Shift + Lower + Raise")
+        print()
+        print("(Lower = левая нижняя кнопка большого пальца)")
+        print("(Raise = правая нижняя кнопка большого пальца)")
+        print()
+
+# ===== Конвейер прошивки =====
+class FlashSequencer:
+    """Конвейерное выполнение последовательности прошивок (all, btclear, batch).
+
+    Пока текущая половинка извлекается и перезагружается (eject и ожидание
+    исчезновения устройства идут в фоне), образ следующего шага уже
+    проверен, его каталог монтирования готов и детектор ждет его диск.
+    Шаги монтируются в чередующиеся каталоги slot0/slot1, чтобы извлечение
+    предыдущего шага не мешало следующему.
+
+    Шаг - dict: fw, target, name, title и необязательный intro
+    (список строк (текст, цвет) перед шагом).
+
+    Журнал прошивок (FlashLedger) позволяет не трогать половинку, на
+    которой уже стоит нужный образ: если журнал знает ровно один
+    контроллер этой половинки и образ совпадает, шаг пропускается без
+    подключения. Подключенный контроллер опознается, и если это другая
+    половинка, чем ожидал шаг, соседние шаги меняются местами.
+    """
+
+    def __init__(self, flasher, interactive=True):
+        self.flasher = flasher
+        self.interactive = interactive
+        self.teardown = ThreadPoolExecutor(max_workers=2)
+        self.busy_devices = set()
+        self.slot_teardowns = {}
+        self.teardown_futures = []
+        self.results = []
+
+    def mount_slot(self, index):
+        return self.flasher.mount_dir / f"slot{index % 2}"
+
+    def _prepare(self, step):
+        """Подготовка шага заранее: фоновая проверка образа"""
+        return self.flasher._validate_async(step['fw'], step['target'])
+
+    def _acquire_slot(self, index):
+        """Каталог монтирования шага (после завершения извлечения шага index-2)"""
+        slot = self.mount_slot(index)
+        previous = self.slot_teardowns.get(slot)
+        if previous:
+            previous.result()
+        slot.mkdir(parents=True, exist_ok=True)
+        return slot
+
+    def _teardown(self, result, slot):
+        """Eject и ожидание перезагрузки контроллера (в фоне)"""
+        if result['skipped']:
+            # Записи не было: диск уйдет, когда контроллер перезагрузят кнопкой
+            self.flasher.devices.wait_gone(result['device'])
+            self.busy_devices.discard(result['device'])
+            return
+        if not result['direct']:
+            eject = self.flasher.sudo.call('eject', path=str(slot))
+            result['phases']['eject'] = eject['ms'] / 1000
+            TELEMETRY.record("flash.eject", eject['ms'] / 1000, outcome='ok' if eject['ok'] else 'error',
+                             device=result['device'])
+        gone_start = time.monotonic()
+        if not self.flasher.devices.wait_gone(result['device']):
+            result.update(ok=False, failed_phase='disconnect', error="контроллер не перезагрузился")
+        result['phases']['disconnect'] = time.monotonic() - gone_start
+        self.busy_devices.discard(result['device'])
+
+    def _announce(self, step):
+        for text, color in step.get('intro', []):
+            print()
+            print_color(text, color)
+        if 'title' not in step:
+            return
+        if self.interactive:
+            print()
+            print("━" * 60)
+            print(step['title'])
+            print("━" * 60)
+            if not self.flasher.force_mode:
+                self.flasher._print_instructions(step['name'])
+        else:
+            print_color(step['title'], Colors.YELLOW)
+
+    def _already_flashed(self, step):
+        """Запись журнала, если половинка шага уже прошита этим образом.
+
+        Только когда журнал знает один контроллер этой половинки: при
+        нескольких (партия клавиатур, замененный контроллер) неизвестно,
+        какой из них будет подключен.
+        """
+        if step['target'] not in FIRMWARE_HALVES or self.flasher.reflash:
+            return None
+        holders = self.flasher.ledger.holders(step['target'])
+        if len(holders) != 1:
+            return None
+        entry = holders[0][1]
+        return entry if entry['digest'] == self.flasher.image_digest(step['fw']) else None
+
+    def _match_half(self, steps, index, volume):
+        """Сверка подключенного контроллера с шагом по журналу.
+
+        Возвращает True - шаг подходит (возможно, после обмена с
+        соседним шагом), False - подключена половинка, которой в
+        оставшихся шагах нет.
+        """
+        step = steps[index]
+        device = self.flasher.devices.for_mount(volume)
+        entry = self.flasher.ledger.get(self.flasher.ledger.identify(volume, device, self.flasher.devices))
+        half = entry and entry.get('half')
+        if half not in FIRMWARE_HALVES or step['target'] not in FIRMWARE_HALVES or half == step['target']:
+            return True
+        following = steps[index + 1] if index + 1 < len(steps) else None
+        if following and following['target'] == half and self.interactive:
+            steps[index], steps[index + 1] = following, step
+            print_color(f"ℹ️  По журналу прошивок подключена другая половинка - сначала прошиваем "
+                        f"{following['name']}, затем {step['name']}", Colors.BLUE)
+            return True
+        print_color(f"⚠️  По журналу прошивок подключена не та половинка ({half}), ждем {step['name']} - "
+                    f"перезагрузи подключенную (RESET)", Colors.YELLOW)
+        return False
+
+    def run(self, steps, skip=None, on_result=None):
+        """Выполнение шагов; skip(step) - пропустить шаг, on_result(step, result)"""
+        results = self.results
+        steps = list(steps)
+        try:
+            for index in range(len(steps)):
+                step = steps[index]
+                if skip and skip(step):
+                    continue
+                entry = self.interactive and self._already_flashed(step)
+                if entry:
+                    print()
+                    print_color(f"✅ {step['name']}: образ уже записан {entry['time']} (журнал прошивок) - "
+                                f"шаг пропущен (--reflash - прошить заново)", Colors.GREEN)
+                    continue
+                self._announce(step)
+
+                wait_start = time.monotonic()
+                rejected = set()
+                while True:
+                    volume = self.flasher._wait_for_drive(
+                        self._prepare(step), self.busy_devices | rejected,
+                        timeout=60 if self.interactive else None)
+                    if self._match_half(steps, index, volume):
+                        break
+                    rejected.add(self.flasher.devices.for_mount(volume))
+                if self.flasher.image_for_write(steps[index]['fw']) != steps[index]['fw']:
+                    # Подхвачена сборка из фона: образы всех оставшихся шагов
+                    for rest in range(index, len(steps)):
+                        steps[rest] = dict(steps[rest], fw=self.flasher.image_for_write(steps[rest]['fw']))
+                step = steps[index]
+                self.flasher._check_validation(self._prepare(step), wait=True)
+                wait_time = time.monotonic() - wait_start
+                if self.interactive:
+                    print(f"{timestamp()} - {step['name']} подключена: {volume}")
+
+                # Следующий шаг готовится, пока идет текущий
+                if index + 1 < len(steps):
+                    self._prepare(steps[index + 1])
+
+                slot = self._acquire_slot(index)
+                result = self.flasher.flash_device(
+                    volume, step['fw'], slot,
+                    on_unmount_failed=self.flasher._ask_after_unmount_failure if self.interactive else None,
+                    progress=print_write_progress if self.interactive else None,
+                    eject=False,
+                    target=step['target']
+                )
+                result['phases']['wait'] = wait_time
+                result['step'] = step
+                results.append(result)
+                if self.interactive:
+                    self.flasher._print_flashed(step['name'], result)
+
+                # Извлечение и ожидание перезагрузки - в фоне, параллельно со следующим шагом
+                if result['ok']:
+                    self.busy_devices.add(result['device'])
+                    future = self.teardown.submit(self._teardown, result, slot)
+                    self.slot_teardowns[slot] = future
+                    self.teardown_futures.append(future)
+                if on_result:
+                    on_result(step, result)
+        finally:
+            self.join()
+        return results
+
+    def join(self):
+        """Ожидание завершения всех фоновых извлечений"""
+        if self.interactive and self.busy_devices:
+            print("⏳ Жду отключения дисков NICENANO...")
+        for future in self.teardown_futures:
+            future.result()
+        self.teardown.shutdown(wait=True)
+        if not self.interactive or not self.teardown_futures:
+            return
+        stuck = [r for r in self.results if r['failed_phase'] == 'disconnect']
+        for result in stuck:
+            print_color(f"⚠️  {result['step']['name']}: {result['error']}", Colors.YELLOW)
+        if not stuck:
+            print_color("✅ Диски отключены", Colors.GREEN)
+
+# ===== Станция прошивки =====
+class FlashStation:
+    """Режим станции: параллельная прошивка любого числа клавиатур.
+
+    Каждый появившийся диск NICENANO проходит свой конечный автомат
+    detect → validate → write → eject → gone в пуле потоков, так что
+    пропускная способность растет с числом USB-портов.
+    """
+
+    def __init__(self, flasher, fw_file, target, workers=STATION_WORKERS):
+        self.flasher = flasher
+        self.fw_file = fw_file
+        self.target = target
+        self.workers = workers
+        self.results = []
+        self.states = {}
+        self.report = None
+        self._lock = threading.Lock()
+
+    def _log(self, volume, text, color=Colors.NC):
+        with self._lock:
+            print_color(f"{timestamp()} [{Path(volume).name}] {text}", color)
+
+    def _set_state(self, volume, state):
+        with self._lock:
+            self.states[str(volume)] = state
+            active = sum(1 for st in self.states.values() if st not in ('done', 'failed'))
+        self._log(volume, f"→ {state} (активных: {active})")
+
+    def _process(self, volume, slot):
+        """Конечный автомат одного устройства"""
+        start = time.monotonic()
+        self._set_state(volume, 'detect')
+        mount_dir = self.flasher.mount_dir / f"slot{slot}"
+
+        # Образ проверен один раз при запуске станции (run)
+        self._set_state(volume, 'validate')
+
+        def on_phase(phase):
+            # unmount/mount - подготовка к записи, отдельным состоянием не показываем
+            if phase in ('write', 'eject'):
+                self._set_state(volume, phase)
+
+        result = self.flasher.flash_device(
+            volume, self.fw_file, mount_dir,
+            log=lambda text, color=Colors.NC: self._log(volume, text, color),
+            on_phase=on_phase,
+            target=self.target
+        )
+
+        if result['skipped']:
+            self._log(volume, "ℹ️  образ уже на контроллере (журнал прошивок) - запись пропущена, "
+                              "нажми RESET", Colors.BLUE)
+        elif result['ok']:
+            self._set_state(volume, 'gone')
+            gone_start = time.monotonic()
+            if not self.flasher.devices.wait_gone(result['device']):
+                result.update(ok=False, failed_phase='gone', error="контроллер не перезагрузился")
+            result['phases']['disconnect'] = time.monotonic() - gone_start
+
+        try:
+            mount_dir.rmdir()
+        except OSError:
+            pass
+
+        result['seconds'] = time.monotonic() - start
+        if result['ok']:
+            self._set_state(volume, 'done')
+            self._log(volume, f"✅ прошит за {result['seconds']:.1f} сек", Colors.GREEN)
+        else:
+            self._set_state(volume, 'failed')
+            self._log(volume, f"❌ {result['failed_phase']}: {result['error']}", Colors.RED)
+        with self._lock:
+            self.results.append(result)
+        return result
+
+    def run(self, count=None):
+        """Обработка дисков до count устройств (или до Ctrl+C)"""
+        self.report = validate_uf2(self.fw_file, self.target)
+        if self.report['errors']:
+            print_uf2_errors(self.report)
+            return False
+
+        print("━" * 60)
+        print_color(f"🏭 СТАНЦИЯ ПРОШИВКИ: {Path(self.fw_file).name}", Colors.BLUE)
+        print("━" * 60)
+        print(f"   Параллельно: до {self.workers} устройств")
+        print(f"   Устройств: {count if count else 'без ограничения (Ctrl+C - завершить)'}")
+        print("   Подключай контроллеры и нажимай RESET дважды")
+        print()
+
+        start = time.monotonic()
+        watcher = self.flasher.watcher
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        active = {}
+        started = 0
+        try:
+            while count is None or started < count or active:
+                for volume, future in list(active.items()):
+                    if future.done():
+                        future.result()
+                        del active[volume]
+                if count is not None and started >= count and not active:
+                    break
+                for kind, volume in watcher.poll_events(0.5):
+                    if kind != 'appeared' or volume in active:
+                        continue
+                    if count is not None and started >= count:
+                        continue
+                    active[volume] = pool.submit(self._process, volume, started)
+                    started += 1
+        except KeyboardInterrupt:
+            print()
+            print_color("⚠️  Остановка станции, жду завершения активных устройств...", Colors.YELLOW)
+        finally:
+            pool.shutdown(wait=True)
+            watcher.close()
+
+        self.print_summary(time.monotonic() - start)
+        return all(r['ok'] for r in self.results)
+
+    def print_summary(self, elapsed):
+        """Итоги по устройствам"""
+        ok = [r for r in self.results if r['ok']]
+        print()
+        print("━" * 60)
+        print_color("📊 ИТОГИ СТАНЦИИ", Colors.BLUE)
+        print("━" * 60)
+        for r in self.results:
+            status = ("✅ (уже прошит)" if r['skipped'] else "✅") if r['ok'] else f"❌ {r['failed_phase']}"
+            print(f"   {Path(r['volume']).name:<16} {r.get('device') or '-':<10} "
+                  f"{r.get('seconds', 0):>6.1f} сек  {status}")
+        print()
+        print(f"   Успешно: {len(ok)}, ошибок: {len(self.results) - len(ok)}")
+        if elapsed > 0 and ok:
+            print(f"   Пропускная способность: {len(ok) * 3600 / elapsed:.0f} устройств/час")
+        print()
+
+# ===== Пакетная прошивка =====
+class BatchRunner:
+    """Пакетная прошивка партии клавиатур по манифесту.
+
+    Манифест (JSON):
+      {
+        "reset": false,                        // reset перед прошивкой (по умолчанию)
+        "firmware": {"left": "left", ...},     // образы по умолчанию
+        "boards": [
+          {"name": "unit-01", "reset": true},
+          {"name": "unit-02", "left": "/path/custom_left.uf2"}
+        ]
+      }
+    Образ - ключ из FIRMWARE_TARGETS (из активной сборки) или путь к .uf2.
+    Все образы проверяются один раз до начала, затем шаги идут конвейером
+    (извлечение платы - в фоне, пока подключают следующую).
+    """
+
+    PHASES = ('wait', 'unmount', 'mount', 'write', 'eject', 'disconnect')
+
+    def __init__(self, flasher, firmware, manifest_path):
+        self.flasher = flasher
+        self.firmware = firmware
+        self.manifest_path = Path(manifest_path)
+        self.manifest = json.loads(self.manifest_path.read_text())
+        self.steps = []
+        self.results = []
+        self.failed_boards = {}
+
+    def _resolve(self, ref, half):
+        """Путь к образу по ключу прошивки или пути"""
+        if ref in FIRMWARE_TARGETS:
+            path = self.firmware.get(ref)
+            if not path:
+                raise ValueError(f"в активной сборке нет образа '{ref}'")
+            return path
+        path = Path(ref).expanduser()
+        if not path.is_absolute():
+            path = self.manifest_path.parent / path
+        return str(path)
+
+    def plan(self):
+        """Шаги прошивки: (плата, половинка, ключ образа, путь) - правая перед левой"""
+        defaults = self.manifest.get('firmware', {})
+        for index, board in enumerate(self.manifest.get('boards', [])):
+            name = board.get('name', f"board-{index + 1}")
+            if board.get('reset', self.manifest.get('reset', False)):
+                reset = self._resolve(board.get('reset_image', defaults.get('reset', 'reset')), 'reset')
+                self.steps.append((name, 'right', 'reset', reset))
+                self.steps.append((name, 'left', 'reset', reset))
+            for half in ('right', 'left'):
+                image = self._resolve(board.get(half, defaults.get(half, half)), half)
+                self.steps.append((name, half, half, image))
+        return self.steps
+
+    def validate_all(self):
+        """Проверка каждого уникального образа один раз (параллельно)"""
+        unique = sorted({(key, path) for _, _, key, path in self.steps})
+        with ThreadPoolExecutor(max_workers=len(unique) or 1) as pool:
+            reports = list(pool.map(lambda item: validate_uf2(item[1], item[0]), unique))
+        failed = [r for r in reports if r['errors']]
+        for report in failed:
+            print_uf2_errors(report)
+        return not failed
+
+    def run(self):
+        """Выполнение манифеста"""
+        try:
+            self.plan()
+        except (ValueError, KeyError) as e:
+            print_color(f"❌ Ошибка в манифесте {self.manifest_path}: {e}", Colors.RED)
+            return False
+        if not self.steps:
+            print_color("❌ В манифесте нет плат", Colors.RED)
+            return False
+        if not self.validate_all():
+            return False
+
+        boards = list(dict.fromkeys(step[0] for step in self.steps))
+        print("━" * 60)
+        print_color(f"📦 ПАКЕТНАЯ ПРОШИВКА: {len(boards)} плат, {len(self.steps)} шагов", Colors.BLUE)
+        print("━" * 60)
+        print()
+
+        steps = []
+        for number, (board, half, key, image) in enumerate(self.steps, 1):
+            half_title = "правая" if half == 'right' else "левая"
+            label = f"{board}: {half_title} половина" + (" (reset)" if key == 'reset' else "")
+            steps.append({'fw': image, 'target': key, 'name': label, 'board': board, 'half': half,
+                          'title': f"▶ [{number}/{len(self.steps)}] {label} - подключи и нажми RESET дважды"})
+
+        def board_failed(step):
+            # Ошибка извлечения предыдущего шага могла прийти из фона уже после on_result
+            self._collect_failures()
+            return step['board'] in self.failed_boards
+
+        def report_step(step, result):
+            result.update(board=step['board'], half=step['half'], image=step['fw'])
+            self.results.append(result)
+            if result['ok']:
+                print_color(f"  ✅ {step['name']}", Colors.GREEN)
+            else:
+                self._collect_failures()
+                print_color(f"  ❌ {step['name']}: {self.failed_boards[step['board']]}", Colors.RED)
+
+        start = time.monotonic()
+        try:
+            FlashSequencer(self.flasher, interactive=False).run(steps, skip=board_failed, on_result=report_step)
+        except KeyboardInterrupt:
+            print()
+            print_color("⚠️  Пакет прерван пользователем", Colors.YELLOW)
+        self._collect_failures()
+
+        report = self.build_report(time.monotonic() - start, boards)
+        self.print_report(report)
+        report_file = get_option('--report')
+        if report_file:
+            Path(report_file).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+            print(f"💾 Отчет сохранен: {report_file}")
+        return not report['failures']
+
+    def _collect_failures(self):
+        """Перенос ошибок из результатов (в т.ч. фоновых) в failed_boards"""
+        for result in self.results:
+            if not result['ok'] and result['board'] not in self.failed_boards:
+                self.failed_boards[result['board']] = f"{result['failed_phase']}: {result['error']}"
+                if result['failed_phase'] == 'disconnect':
+                    print_color(f"  ❌ {result['step']['name']}: {self.failed_boards[result['board']]}", Colors.RED)
+
+    def build_report(self, elapsed, boards):
+        """Отчет о пропускной способности"""
+        done_boards = [b for b in boards if b not in self.failed_boards
+                       and sum(1 for r in self.results if r['board'] == b and r['ok']) ==
+                       sum(1 for step in self.steps if step[0] == b)]
+        phases = {}
+        for name in self.PHASES:
+            values = [r['phases'][name] for r in self.results if name in r['phases']]
+            if values:
+                phases[name] = {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'count': len(values)}
+        return {
+            'manifest': str(self.manifest_path),
+            'elapsed_seconds': elapsed,
+            'boards_total': len(boards),
+            'boards_done': len(done_boards),
+            'boards_per_hour': len(done_boards) * 3600 / elapsed if elapsed > 0 else 0,
+            'phases': phases,
+            'failures': [{'board': b, 'error': e} for b, e in self.failed_boards.items()]
+        }
+
+    @staticmethod
+    def print_report(report):
+        print()
+        print("━" * 60)
+        print_color("📊 ОТЧЕТ О ПАКЕТЕ", Colors.BLUE)
+        print("━" * 60)
+        print(f"   Плат прошито: {report['boards_done']}/{report['boards_total']} "
+              f"за {report['elapsed_seconds'] / 60:.1f} мин")
+        print(f"   Пропускная способность: {report['boards_per_hour']:.1f} плат/час")
+        print()
+        print(f"   {'Фаза':<12} {'p50, сек':>9} {'p95, сек':>9} {'N':>5}")
+        for name, stats in report['phases'].items():
+            print(f"   {name:<12} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['count']:>5}")
+        if report['failures']:
+            print()
+            print_color(f"   Ошибок: {len(report['failures'])}", Colors.RED)
+            for failure in report['failures']:
+                print_color(f"   • {failure['board']}: {failure['error']}", Colors.RED)
+        print()
+
+# ===== Симулятор bootloader'а =====
+def make_test_uf2(path, size, base=NRF52840_APP_RANGE[0], family=NRF52840_FAMILY_ID):
+    """Синтетический UF2-образ (~size байт) для симулятора и бенчмарка"""
+    payload = 256
+    num_blocks = max(1, size // UF2_BLOCK_SIZE)
+    with open(path, 'wb') as f:
+        for block in range(num_blocks):
+            header = array('I', [UF2_MAGIC_START0, UF2_MAGIC_START1, UF2_FLAG_FAMILY_ID,
+                                 base + block * payload, payload, block, num_blocks, family])
+            data = bytes([block & 0xFF]) * payload
+            f.write(header.tobytes() + data.ljust(UF2_MAX_PAYLOAD, b"\0") + array('I', [UF2_MAGIC_END]).tobytes())
+    return Path(path)
+
+class SimulatedBootloader:
+    """nice!nano в режиме UF2 bootloader'а без железа.
+
+    Диск NICENANO - каталог в tmpfs (/dev/shm), который появляется через
+    appear_delay после "подключения" и исчезает при unmount. Симулятор
+    одновременно играет роль помощника sudo (batch/call: unmount, mount,
+    eject) и источника устройств (for_mount/wait_gone), поэтому Flasher
+    работает с ним без изменений:
+      • unmount_failures - сколько первых unmount каждого диска завершатся ошибкой
+      • после записи всех блоков образа (numBlocks из заголовка UF2)
+        и eject контроллер перезагружается через reboot_delay; с improper_eject=True
+        сразу, не дожидаясь eject ("диск извлечен неправильно")
+      • после перезагрузки следующий контроллер подключается сам,
+        пока не исчерпано plugs подключений
+      • serials - серийные номера USB подключаемых контроллеров по кругу
+        (по умолчанию каждое подключение - новый контроллер)
+      • образ, записанный прямо в автосмонтированный диск (--direct),
+        перезагружает контроллер сразу после последнего блока
+    """
+
+    INFO_UF2 = "UF2 Bootloader 0.6.0\nModel: nice!nano\nBoard-ID: nRF52840-nicenano\n"
+
+    def __init__(self, appear_delay=0.2, reboot_delay=0.1, unmount_failures=0,
+                 improper_eject=False, label=BOOTLOADER_LABEL, serials=None):
+        shm = Path("/dev/shm")
+        self.root = Path(tempfile.mkdtemp(prefix="sofle-sim-", dir=shm if shm.is_dir() else None))
+        self.volumes = self.root / "Volumes"
+        self.mount_dir = self.root / "mnt"
+        self.volumes.mkdir()
+        self.mount_dir.mkdir()
+        self.appear_delay = appear_delay
+        self.reboot_delay = reboot_delay
+        self.unmount_failures = unmount_failures
+        self.improper_eject = improper_eject
+        self.label = label
+        self.serials = list(serials or [])
+        self.devices = {}
+        self.flashed = []
+        self.plugs_left = 0
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._timers = []
+
+    # --- Оператор ---
+    def start(self, plugs):
+        """Подключать контроллеры один за другим, всего plugs раз"""
+        self.plugs_left = plugs
+        self._plug_next()
+
+    def _plug_next(self):
+        with self._cond:
+            if self.plugs_left <= 0:
+                return
+            self.plugs_left -= 1
+        self._schedule(self.appear_delay, self._appear)
+
+    def _schedule(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        self._timers.append(timer)
+        timer.start()
+
+    def _appear(self):
+        with self._cond:
+            self._counter += 1
+            name = f"sim{self._counter}"
+            volume = self.volumes / self.label
+            if volume.exists():
+                volume = self.volumes / f"{self.label} {self._counter}"
+            volume.mkdir()
+            (volume / "INFO_UF2.TXT").write_text(self.INFO_UF2)
+            self.devices[name] = {
+                'volume': volume,
+                'serial': (self.serials[(self._counter - 1) % len(self.serials)] if self.serials
+                           else f"SIM{os.getpid()}-{self._counter}"),
+                'mounted': None,
+                'unmount_failures': self.unmount_failures,
+                'written': False,
+                'ejected': False,
+                'gone': False
+            }
+            self._cond.notify_all()
+        threading.Thread(target=self._watch_write, args=(name,), daemon=True).start()
+
+    # --- Устройства (интерфейс DeviceBackend) ---
+    def for_mount(self, path):
+        path = Path(path)
+        with self._cond:
+            for name, dev in self.devices.items():
+                if not dev['gone'] and path in (dev['volume'], dev['mounted']):
+                    return name
+        return None
+
+    def serial(self, device):
+        with self._cond:
+            return self.devices[device]['serial'] if device in self.devices else None
+
+    def wait_gone(self, device, timeout=DEVICE_GONE_TIMEOUT):
+        with TELEMETRY.span("flash.disconnect", device=device) as span:
+            with self._cond:
+                gone = self._cond.wait_for(lambda: self.devices[device]['gone'], timeout)
+            if not gone:
+                span['outcome'] = 'timeout'
+        return gone
+
+    # --- Помощник sudo (интерфейс SudoManager) ---
+    def batch(self, ops, stop_on_error=False):
+        results = []
+        for request in ops:
+            start = time.monotonic()
+            ok, err = getattr(self, f"_op_{request['op']}")(request)
+            results.append({'op': request['op'], 'ok': ok, 'out': '', 'err': err,
+                            'ms': (time.monotonic() - start) * 1000})
+            if stop_on_error and not ok:
+                break
+        return results
+
+    def call(self, op, **params):
+        return self.batch([dict(params, op=op)])[0]
+
+    def _op_unmount(self, request):
+        with self._cond:
+            name = next((n for n, d in self.devices.items()
+                         if d['volume'] == Path(request['path']) and not d['gone']), None)
+            if name is None:
+                return False, f"{request['path']}: not mounted"
+            dev = self.devices[name]
+            if dev['unmount_failures'] > 0:
+                dev['unmount_failures'] -= 1
+                return False, f"{request['path']}: Resource busy"
+            shutil.rmtree(dev['volume'], ignore_errors=True)
+        return True, ''
+
+    def _op_mount(self, request):
+        name = request['device'].replace('/dev/', '')
+        with self._cond:
+            dev = self.devices.get(name)
+            if not dev or dev['gone']:
+                return False, f"{request['device']}: No such device"
+            dev['mounted'] = Path(request['target'])
+        return True, ''
+
+    def _op_eject(self, request):
+        with self._cond:
+            name = next((n for n, d in self.devices.items()
+                         if d['mounted'] == Path(request['path']) and not d['gone']), None)
+            if name is None:
+                return False, f"{request['path']}: device ejected improperly"
+        # К eject записанный образ уже у bootloader'а (не ждем опроса _watch_write)
+        written = self._check_written(name)
+        if self.improper_eject and written:
+            # Bootloader перезагрузился сразу после последнего блока
+            self._reboot(name)
+            return False, f"{request['path']}: device ejected improperly"
+        with self._cond:
+            self.devices[name]['ejected'] = True
+        self._maybe_reboot(name)
+        return True, ''
+
+    def _op_ping(self, request):
+        return True, ''
+
+    # --- Контроллер ---
+    def _check_written(self, name):
+        """Записаны ли все блоки образа (numBlocks из заголовка первого блока)"""
+        dev = self.devices[name]
+        try:
+            images = list((dev['mounted'] or dev['volume']).glob("*.uf2"))
+        except OSError:
+            # Между unmount и mount каталога диска нет
+            return False
+        for uf2 in images:
+            try:
+                with open(uf2, 'rb') as f:
+                    header = f.read(32)
+                size = uf2.stat().st_size
+            except OSError:
+                continue
+            if len(header) == 32 and size >= array('I', header)[6] * UF2_BLOCK_SIZE:
+                with self._cond:
+                    if not dev['written']:
+                        dev['written'] = True
+                        self.flashed.append((name, uf2.name, size))
+                return True
+        return False
+
+    def _watch_write(self, name):
+        """Ожидание записи всех блоков образа, как это делает bootloader"""
+        while not self.devices[name]['gone']:
+            if self._check_written(name):
+                self._maybe_reboot(name)
+                return
+            time.sleep(0.005)
+
+    def _maybe_reboot(self, name):
+        with self._cond:
+            dev = self.devices[name]
+            if dev.get('rebooting') or not dev['written']:
+                return
+            if dev['mounted'] is not None and not (dev['ejected'] or self.improper_eject):
+                return
+            dev['rebooting'] = True
+        improper = self.improper_eject or dev['mounted'] is None
+        self._schedule(0 if improper else self.reboot_delay, self._reboot, name)
+
+    def _reboot(self, name):
+        with self._cond:
+            dev = self.devices[name]
+            if dev['gone']:
+                return
+            if dev['mounted'] is None:
+                shutil.rmtree(dev['volume'], ignore_errors=True)
+            else:
+                for item in dev['mounted'].glob("*"):
+                    item.unlink()
+            dev['gone'] = True
+            self._cond.notify_all()
+        self._plug_next()
+
+    def close(self):
+        for timer in self._timers:
+            timer.cancel()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# ===== Бенчмарк =====
+BENCH_IMAGE_SIZE = 384 * 1024  # размер синтетических образов (как у сборки ZMK)
+
+class FlashBenchmark:
+    """Сквозной замер flash_half, flash_all и clear_btpairs на симуляторе.
+
+    Каждый раунд - новый SimulatedBootloader и Flasher с DriveWatcher на
+    каталоге симулятора. Время по фазам берется из спанов телеметрии;
+    в журнал сессий (stats) замеры бенчмарка не попадают.
+    """
+
+    SCENARIOS = (
+        ('flash_half', 1),
+        ('flash_all', 2),
+        ('clear_btpairs', 4)
+    )
+
+    def __init__(self, rounds=3, verbose=False, direct=False, **sim_options):
+        self.rounds = rounds
+        self.verbose = verbose
+        self.direct = direct
+        self.sim_options = sim_options
+        self.results = {}
+
+    @staticmethod
+    def _images(root):
+        images = {}
+        for key, prefix in FIRMWARE_TARGETS.items():
+            images[key] = str(make_test_uf2(root / f"{prefix}-nice_nano_v2-zmk.uf2", BENCH_IMAGE_SIZE))
+        return images
+
+    def _round(self, scenario, plugs):
+        sim = SimulatedBootloader(**self.sim_options)
+        watcher = DriveWatcher(roots=[sim.volumes], ignore=[sim.mount_dir])
+        flasher = Flasher(sim, force_mode=True, mount_dir=sim.mount_dir, watcher=watcher, devices=sim,
+                          history=HistoryDB(sim.root / "history.db", ledger_file=None), direct=self.direct)
+        firmware = self._images(sim.root)
+        first_span = len(TELEMETRY.spans)
+        output = sys.stdout if self.verbose else open(os.devnull, 'w')
+        ok = True
+        start = time.monotonic()
+        try:
+            sim.start(plugs)
+            with contextlib.redirect_stdout(output):
+                if scenario == 'flash_half':
+                    flasher.flash_half(firmware['right'], "правую половину", target='right')
+                else:
+                    getattr(flasher, scenario)(firmware)
+        except SystemExit:
+            ok = False
+        finally:
+            wall = time.monotonic() - start
+            if output is not sys.stdout:
+                output.close()
+            flasher.validator.shutdown()
+            watcher.close()
+            sim.close()
+        with TELEMETRY._lock:
+            spans = TELEMETRY.spans[first_span:]
+            del TELEMETRY.spans[first_span:]
+        ok = ok and len(sim.flashed) == plugs
+        return {'wall': wall, 'ok': ok, 'spans': spans}
+
+    def run(self):
+        print("━" * 80)
+        print_color(f"🧪 БЕНЧМАРК НА СИМУЛЯТОРЕ: {self.rounds} раунд(ов)", Colors.BLUE)
+        print("━" * 80)
+        for scenario, plugs in self.SCENARIOS:
+            rounds = [self._round(scenario, plugs) for _ in range(self.rounds)]
+            self.results[scenario] = rounds
+            failed = sum(1 for r in rounds if not r['ok'])
+            walls = [r['wall'] for r in rounds]
+            status = "✅" if not failed else f"❌ ошибок: {failed}"
+            print(f"{scenario:<16} p50 {percentile(walls, 50):6.2f} сек   p95 {percentile(walls, 95):6.2f} сек   {status}")
+        print()
+        report = self.build_report()
+        self.print_phases(report)
+        return all(r['ok'] for rounds in self.results.values() for r in rounds), report
+
+    def build_report(self):
+        report = {'rounds': self.rounds, 'options': dict(self.sim_options, direct=self.direct), 'scenarios': {}}
+        for scenario, rounds in self.results.items():
+            walls = [r['wall'] for r in rounds]
+            spans = [span for r in rounds for span in r['spans']]
+            report['scenarios'][scenario] = {
+                'wall_p50': percentile(walls, 50),
+                'wall_p95': percentile(walls, 95),
+                'failed': sum(1 for r in rounds if not r['ok']),
+                'phases': Telemetry.aggregate(spans)
+            }
+        return report
+
+    @staticmethod
+    def print_phases(report):
+        print(f"{'Сценарий / фаза':<30} {'N':>5} {'p50, мс':>9} {'p95, мс':>9}")
+        for scenario, data in report['scenarios'].items():
+            print_color(scenario, Colors.YELLOW)
+            for name, stats in data['phases'].items():
+                print(f"   {name:<27} {stats['count']:>5} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f}")
+        print()
+
+# ===== Парсер keymap (devicetree) =====
+class KeymapSyntaxError(ValueError):
+    """Ошибка разбора keymap с номером строки"""
+
+    def __init__(self, message, line):
+        super().__init__(f"строка {line}: {message}")
+        self.line = line
+
+KEYMAP_TOKEN_RE = re.compile(r'''
+      (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<directive>^[ \t]*\#[ \t]*(?:include|define|undef|ifdef|ifndef|if|elif|else|endif|pragma)\b(?:\\\n|[^\n])*)
+    | (?P<string>"(?:\\.|[^"\\])*")
+    | (?P<ref>&[A-Za-z_][\w-]*)
+    | (?P<group>[\w-]*\((?:[^()]|\([^()]*\))*\))
+    | (?P<word>[\#\w][\w.+@\#-]*)
+    | (?P<punct>[{}<>;=:,/])
+    | (?P<space>\s+)
+    | (?P<error>.)
+''', re.S | re.M | re.X)
+
+def tokenize_keymap(text):
+    """Токены devicetree за один проход: [(kind, value, line)].
+
+    Комментарии остаются токенами (описания узлов), пробелы и директивы
+    препроцессора отбрасываются.
+    """
+    tokens = []
+    line = 1
+    for match in KEYMAP_TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'error':
+            raise KeymapSyntaxError(f"неожиданный символ {value!r}", line)
+        if kind not in ('space', 'directive'):
+            tokens.append((kind, value, line))
+        line += value.count("\n")
+    return tokens
+
+class KeymapParser:
+    """Разбор дерева devicetree: узлы {'name', 'label', 'comment', 'notes', 'line', 'props', 'children'}.
+
+    comment - комментарий перед узлом, notes - комментарии внутри него.
+    Значение свойства - список строк и массивов ячеек <...>; в массиве,
+    занимающем несколько строк, перенос строки отмечен ячейкой "\n"
+    (по ним восстанавливаются ряды клавиш слоя).
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize_keymap(text)
+        self.pos = 0
+        self.comments = []
+
+    def _peek(self, offset=0):
+        """Следующий значимый токен (комментарии копятся как описание)"""
+        while self.pos < len(self.tokens) and self.tokens[self.pos][0] == 'comment':
+            kind, value, line = self.tokens[self.pos]
+            previous = self.tokens[self.pos - 1] if self.pos else None
+            # Комментарий в конце строки относится к предыдущей конструкции
+            if not previous or previous[2] != line or previous[0] == 'comment':
+                self.comments.append(value)
+            self.pos += 1
+        index = self.pos + offset
+        while offset and index < len(self.tokens) and self.tokens[index][0] == 'comment':
+            index += 1
+        return self.tokens[index] if index < len(self.tokens) else ('eof', '', self.tokens[-1][2] if self.tokens else 1)
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _expect(self, value):
+        kind, got, line = self._next()
+        if got != value:
+            raise KeymapSyntaxError(f"ожидалось '{value}', найдено '{got or 'конец файла'}'", line)
+
+    def _take_comment(self):
+        lines = []
+        for comment in self.comments:
+            for text in comment.strip('/*').splitlines():
+                text = text.strip().lstrip('*/').strip()
+                if text and not set(text) <= set('-=*'):
+                    lines.append(text)
+        self.comments = []
+        return lines
+
+    def parse(self):
+        """Корневые узлы; несколько блоков '/ { ... };' объединяются"""
+        root = {'name': '/', 'label': None, 'comment': [], 'notes': [], 'line': 1, 'props': {}, 'children': []}
+        while self._peek()[0] != 'eof':
+            kind, value, line = self._next()
+            if value in ('/', ) or kind == 'ref':
+                node = root if value == '/' else self._new_node(value, None, line)
+                self._expect('{')
+                self._body(node)
+                self._expect(';')
+                if node is not root:
+                    root['children'].append(node)
+            else:
+                raise KeymapSyntaxError(f"неожиданный токен '{value}' на верхнем уровне", line)
+        return root
+
+    def _new_node(self, name, label, line):
+        return {'name': name, 'label': label, 'comment': self._take_comment(), 'notes': [], 'line': line,
+                'props': {}, 'children': []}
+
+    def _body(self, node):
+        while True:
+            kind, value, line = self._peek()
+            if value == '}':
+                self._next()
+                self.comments = []
+                return
+            if kind == 'eof':
+                raise KeymapSyntaxError(f"не закрыт узел '{node['name']}'", node['line'])
+            self._next()
+
+            label = None
+            if self._peek()[1] == ':' and kind == 'word':
+                self._next()
+                label = value
+                kind, value, line = self._next()
+            if kind not in ('word', 'ref'):
+                raise KeymapSyntaxError(f"ожидалось имя узла или свойства, найдено '{value}'", line)
+
+            following = self._next()[1]
+            if following == '{':
+                child = self._new_node(value, label, line)
+                self._body(child)
+                self._expect(';')
+                node['children'].append(child)
+            elif following == '=':
+                node['notes'].extend(self._take_comment())
+                node['props'][value] = self._values()
+            elif following == ';':
+                node['notes'].extend(self._take_comment())
+                node['props'][value] = True
+            else:
+                raise KeymapSyntaxError(f"после '{value}' ожидалось '{{', '=' или ';'", line)
+
+    def _values(self):
+        values = []
+        while True:
+            kind, value, line = self._next()
+            if kind == 'string':
+                values.append(value[1:-1])
+            elif value == '<':
+                values.append(self._cells())
+            elif kind == 'ref':
+                values.append([value])
+            else:
+                raise KeymapSyntaxError(f"неожиданное значение '{value}'", line)
+            separator = self._next()
+            if separator[1] == ';':
+                return values
+            if separator[1] != ',':
+                raise KeymapSyntaxError(f"ожидалось ',' или ';', найдено '{separator[1]}'", separator[2])
+
+    def _cells(self):
+        cells = []
+        last_line = None
+        while True:
+            kind, value, line = self._next()
+            if value == '>':
+                return cells
+            if kind not in ('word', 'ref', 'group'):
+                raise KeymapSyntaxError(f"недопустимая ячейка '{value}'", line)
+            if last_line is not None and line != last_line:
+                cells.append("\n")
+            last_line = line
+            cells.append(value)
+
+def split_bindings(cells):
+    """Ячейки массива bindings → (список привязок [ref, параметры...], длины рядов)"""
+    bindings = []
+    rows = []
+    row = 0
+    for cell in cells:
+        if cell == "\n":
+            if row:
+                rows.append(row)
+            row = 0
+        elif cell.startswith('&'):
+            bindings.append([cell])
+            row += 1
+        elif bindings:
+            bindings[-1].append(cell)
+    if row:
+        rows.append(row)
+    return bindings, rows
+
+def _cell_int(value, default=None):
+    try:
+        return int(value.strip('()'), 0)
+    except (ValueError, AttributeError):
+        return default
+
+def _prop_cells(node, name):
+    """Ячейки всех массивов свойства (без переносов строк)"""
+    cells = []
+    for value in node['props'].get(name, []):
+        if isinstance(value, list):
+            cells.extend(cell for cell in value if cell != "\n")
+    return cells
+
+def _prop_int(node, name):
+    cells = _prop_cells(node, name)
+    return _cell_int(cells[0]) if cells else None
+
+def _prop_string(node, name):
+    for value in node['props'].get(name, []):
+        if isinstance(value, str):
+            return value
+    return None
+
+def build_keymap_ast(tree):
+    """Сводка keymap из дерева: behaviors, combos и слои"""
+    ast = {'behaviors': [], 'combos': [], 'layers': []}
+
+    def walk(node):
+        yield node
+        for child in node['children']:
+            yield from walk(child)
+
+    for node in walk(tree):
+        compatible = _prop_string(node, 'compatible') or ''
+        if compatible.startswith('zmk,behavior-') and node['label']:
+            bindings, _ = split_bindings(_prop_cells(node, 'bindings'))
+            ast['behaviors'].append({
+                'label': node['label'],
+                'kind': compatible[len('zmk,behavior-'):],
+                'comment': node['comment'],
+                'line': node['line'],
+                'binding_cells': _prop_int(node, '#binding-cells'),
+                'tapping_term_ms': _prop_int(node, 'tapping-term-ms'),
+                'flavor': _prop_string(node, 'flavor'),
+                'mods': [m.strip('()') for m in _prop_cells(node, 'mods')],
+                'bindings': bindings
+            })
+        elif compatible == 'zmk,combos':
+            for combo in node['children']:
+                bindings, _ = split_bindings(_prop_cells(combo, 'bindings'))
+                ast['combos'].append({
+                    'name': combo['name'],
+                    'comment': combo['comment'],
+                    'line': combo['line'],
+                    'key_positions': [_cell_int(c) for c in _prop_cells(combo, 'key-positions')],
+                    'timeout_ms': _prop_int(combo, 'timeout-ms'),
+                    'require_prior_idle_ms': _prop_int(combo, 'require-prior-idle-ms'),
+                    'layers': [_cell_int(c) for c in _prop_cells(combo, 'layers')],
+                    'bindings': bindings
+                })
+        elif compatible == 'zmk,keymap':
+            for layer in node['children']:
+                cells = [c for value in layer['props'].get('bindings', []) if isinstance(value, list) for c in value]
+                bindings, rows = split_bindings(cells)
+                ast['layers'].append({
+                    'name': layer['name'],
+                    'display_name': _prop_string(layer, 'display-name'),
+                    'comment': layer['comment'] + layer['notes'],
+                    'line': layer['line'],
+                    'bindings': bindings,
+                    'rows': rows
+                })
+    return ast
+
+def load_keymap(path=None):
+    """AST keymap с кешем в KEYMAP_CACHE_FILE по SHA-256 содержимого"""
+    path = Path(path or KEYMAP_FILE)
+    data = path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    key = str(path.resolve())
+
+    cache = {}
+    if KEYMAP_CACHE_FILE.exists():
+        try:
+            cache = json.loads(KEYMAP_CACHE_FILE.read_text())
+        except ValueError:
+            cache = {}
+    entry = cache.get(key)
+    if entry and entry.get('sha256') == digest and entry.get('version') == KEYMAP_AST_VERSION:
+        return entry['ast']
+
+    ast = build_keymap_ast(KeymapParser(data.decode()).parse())
+    cache[key] = {'sha256': digest, 'version': KEYMAP_AST_VERSION, 'ast': ast}
+    try:
+        KEYMAP_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = KEYMAP_CACHE_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(cache, ensure_ascii=False))
+        os.replace(tmp, KEYMAP_CACHE_FILE)
+    except OSError:
+        pass
+    return ast
+
+# ===== Симулятор поведений keymap =====
+KEY_EVENT_KINDS = bytes.maketrans(b"pPdD1rRuU0", b"\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00")
+COMBO_POSITION_BASE = 1 << 12  # виртуальные позиции сработавших комбо
+INTENT_COMBO = 1
+INTENT_HOLD = 2
+KEY_EVENT_INTENTS = bytes.maketrans(b"-ch", bytes([0, INTENT_COMBO, INTENT_HOLD]))
+# Модификаторы для mod-morph: MOD_* → коды клавиш, которые его держат
+MODIFIER_KEYS = {
+    'MOD_LSFT': {'LSHFT', 'LSHIFT', 'LEFT_SHIFT'},
+    'MOD_RSFT': {'RSHFT', 'RSHIFT', 'RIGHT_SHIFT'},
+    'MOD_LCTL': {'LCTRL', 'LEFT_CONTROL'},
+    'MOD_RCTL': {'RCTRL', 'RIGHT_CONTROL'},
+    'MOD_LALT': {'LALT', 'LEFT_ALT'},
+    'MOD_RALT': {'RALT', 'RIGHT_ALT'},
+    'MOD_LGUI': {'LGUI', 'LEFT_GUI', 'LMETA', 'LEFT_META', 'LCMD', 'LEFT_COMMAND', 'LWIN', 'LEFT_WIN'},
+    'MOD_RGUI': {'RGUI', 'RIGHT_GUI', 'RMETA', 'RIGHT_META', 'RCMD', 'RIGHT_COMMAND', 'RWIN', 'RIGHT_WIN'}
+}
+ALL_MODIFIER_KEYS = set().union(*MODIFIER_KEYS.values())
+
+def load_trace(path):
+    """Трасса нажатий: строки 't_ms позиция p|r' (пробелы или запятые, # - комментарий).
+
+    Нажатие можно пометить намерением: pc - часть задуманного комбо,
+    ph - задуманное удержание hold-tap; остальные нажатия считаются
+    обычным набором (для подсчета ложных срабатываний).
+    Возвращает (times, positions, presses, intents): array('d') в мс,
+    array('B') (или array('H') для позиций > 255), bytes (1 - нажатие)
+    и bytes намерений (None, если пометок нет). Разбор идет целиком
+    на уровне bytes/array, без цикла по строкам.
+    """
+    data = Path(path).read_bytes()
+    if b"#" in data:
+        data = b"\n".join(line.split(b"#", 1)[0] for line in data.splitlines())
+    tokens = data.replace(b",", b" ").split()
+    if len(tokens) % 3:
+        raise ValueError(f"{path}: ожидается 3 поля на событие (t_ms позиция p|r)")
+    times = array('d', map(float, tokens[0::3]))
+    positions = array('H', map(int, tokens[1::3]))
+    if not positions or max(positions) < 256:
+        positions = array('B', positions)
+    kinds = b"".join(tokens[2::3])
+    intents = None
+    if len(kinds) != len(times):
+        # Есть пометки намерений: второй символ типа события
+        marks = tokens[2::3]
+        kinds = b"".join(kind[:1] for kind in marks)
+        intents = b"".join(kind[1:2] or b"-" for kind in marks).translate(KEY_EVENT_INTENTS)
+        if intents.translate(None, bytes([0, INTENT_COMBO, INTENT_HOLD])) or any(len(k) > 2 for k in marks):
+            raise ValueError(f"{path}: пометка намерения должна быть c (комбо) или h (удержание)")
+    presses = kinds.translate(KEY_EVENT_KINDS)
+    if presses.translate(None, b"\x00\x01"):
+        raise ValueError(f"{path}: тип события должен быть p (нажатие) или r (отпускание)")
+    return times, positions, presses, intents
+
+def _percentile_with_zeros(delays, zeros, q):
+    """Перцентиль выборки из zeros нулей и отсортированных delays"""
+    count = zeros + len(delays)
+    if not count:
+        return 0.0
+    rank = (count - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, count - 1)
+    value = lambda k: 0.0 if k < zeros else delays[k - zeros]
+    return value(low) + (value(high) - value(low)) * (rank - low)
+
+class BehaviorEngine:
+    """Проигрывание трассы нажатий через combos, hold-tap, tap-dance, mod-morph и слои.
+
+    Модель повторяет ZMK: комбо перехватывают нажатия своих клавиш на
+    timeout-ms (с учетом require-prior-idle-ms и слоев), нерешенный
+    hold-tap задерживает последующие события до решения (flavor),
+    tap-dance ждет tapping-term после нажатия. Для каждого выданного
+    нажатия считается задержка: время выдачи минус время нажатия,
+    которое его вызвало.
+
+    Участки трассы из одних обычных клавиш (&kp без модификаторов, при
+    отсутствии ожидающих решений) обрабатываются пачкой: классы позиций
+    получаются одним bytes.translate, границы участков - поиском regex
+    по этим bytes, нажатия участка считаются через Counter.
+
+    overrides - замена параметров: {'esc_tilde.tapping_term_ms': 150,
+    'combo_esc.timeout_ms': 40, ...}.
+    """
+
+    FLAVORS = ('tap-preferred', 'hold-preferred', 'balanced', 'tap-unless-interrupted')
+    LAYER_REFS = ('&mo', '&tog', '&to')
+    INTERESTING = re.compile(rb"[^\x00]")
+
+    def __init__(self, ast, overrides=None, emit=None):
+        self.layers = [layer['bindings'] for layer in ast['layers']]
+        self.behaviors = {b['label']: dict(b) for b in ast['behaviors']}
+        self.combos = [dict(c) for c in ast['combos']]
+        for key, value in (overrides or {}).items():
+            name, field = key.rsplit('.', 1)
+            target = self.behaviors.get(name) or next((c for c in self.combos if c['name'] == name), None)
+            if target is None or field not in target:
+                raise ValueError(f"неизвестный параметр: {key}")
+            target[field] = value
+        self.emit = emit
+
+        self.members = {}
+        for index, combo in enumerate(self.combos):
+            combo['keys'] = frozenset(combo['key_positions'])
+            for position in combo['keys']:
+                self.members.setdefault(position, []).append(index)
+
+        self.width = max([len(layer) for layer in self.layers] + [max(self.members, default=0) + 1])
+        # Привязки и классы позиций для каждого набора активных слоев
+        self._states = {}
+
+        self.active = {0}
+        self.momentary = {}
+        self.toggled = set()
+        self.held = {}
+        self.held_keys = {}
+        self.ht = None
+        self.td = None
+        self.pending = []
+        self.pending_deadline = None
+        self.active_combos = {}
+        self.last_press = float('-inf')
+        self.events = 0
+        self.sources = {}
+        self.keys = {}
+        self.errors = {'misfires': {}, 'missed': {}}
+
+    @staticmethod
+    def _plain(binding):
+        return binding[0] in ('&trans', '&none') or \
+            (binding[0] == '&kp' and not ALL_MODIFIER_KEYS.intersection(binding[1:]))
+
+    # --- Слои ---
+    def _layer(self):
+        return max(self.active)
+
+    def _update_layers(self):
+        self.active = {0} | self.toggled | {n for n, count in self.momentary.items() if count}
+
+    def _state(self):
+        """(привязки, таблица классов) для текущих активных слоев.
+
+        Класс 1 - позиция требует пособытийной обработки: член комбо
+        или привязка, отличная от обычной &kp.
+        """
+        key = frozenset(self.active)
+        state = self._states.get(key)
+        if state is None:
+            order = sorted(key, reverse=True)
+            bindings = []
+            for position in range(self.width):
+                binding = ['&none']
+                for layer in order:
+                    if position < len(self.layers[layer]) and self.layers[layer][position][0] != '&trans':
+                        binding = self.layers[layer][position]
+                        break
+                bindings.append(binding)
+            classes = bytearray([1]) * max(self.width, 256)
+            for position, binding in enumerate(bindings):
+                classes[position] = position in self.members or not self._plain(binding)
+            state = self._states[key] = (bindings, bytes(classes), {})
+        return state
+
+    def _resolve(self, position):
+        """Привязка позиции на верхнем активном слое (&trans - сквозь)"""
+        if position >= COMBO_POSITION_BASE:
+            return self.combos[position - COMBO_POSITION_BASE]['bindings'][0]
+        bindings = self._state()[0]
+        return bindings[position] if position < len(bindings) else ['&none']
+
+    # --- Выдача ---
+    def _key(self, keycode, t_emit, origin, source):
+        stats = self.sources.setdefault(source, {'count': 0, 'delays': array('d')})
+        stats['count'] += 1
+        delay = t_emit - origin
+        if delay > 0:
+            stats['delays'].append(delay)
+        self.keys[keycode] = self.keys.get(keycode, 0) + 1
+        if self.emit:
+            self.emit(t_emit, keycode, delay, source)
+
+    def _press_binding(self, binding, t, origin, source, position, intent=0):
+        ref, params = binding[0], binding[1:]
+        if ref == '&kp':
+            keycode = " ".join(params)
+            self.held_keys[keycode] = self.held_keys.get(keycode, 0) + 1
+            self._key(keycode, t, origin, source)
+        elif ref in self.LAYER_REFS and params:
+            layer = int(params[0])
+            if ref == '&mo':
+                self.momentary[layer] = self.momentary.get(layer, 0) + 1
+            elif ref == '&tog':
+                self.toggled ^= {layer}
+            else:
+                self.toggled = {layer} - {0}
+                self.momentary = {}
+            self._update_layers()
+        elif ref in ('&trans', '&none'):
+            pass
+        elif ref[1:] in self.behaviors:
+            behavior = self.behaviors[ref[1:]]
+            kind = behavior['kind']
+            if kind == 'hold-tap' and len(params) == 2:
+                term = behavior['tapping_term_ms'] or 200
+                self.ht = {'position': position, 'binding': binding, 'behavior': behavior, 'origin': origin,
+                           'deadline': t + term, 'captured': [], 'others': set(), 'intent': intent}
+            elif kind == 'tap-dance' and behavior['bindings']:
+                self.td = {'position': position, 'behavior': behavior, 'count': 1, 'origin': origin,
+                           'deadline': t + (behavior['tapping_term_ms'] or 200), 'released': False}
+                if len(behavior['bindings']) == 1:
+                    self._resolve_tap_dance(t)
+            elif kind == 'mod-morph' and len(behavior['bindings']) == 2:
+                mods = {m for cell in behavior['mods'] for m in cell.split('|')}
+                morphed = any(self.held_keys.get(k) for m in mods for k in MODIFIER_KEYS.get(m, ()))
+                chosen = behavior['bindings'][1 if morphed else 0]
+                self.held[position] = (chosen, source)
+                self._press_binding(chosen, t, origin, behavior['label'], position)
+            else:
+                self._key(" ".join([ref[1:]] + params), t, origin, behavior['label'])
+        else:
+            self._key(" ".join([ref[1:]] + params), t, origin, source)
+
+    def _release_binding(self, binding):
+        ref, params = binding[0], binding[1:]
+        if ref == '&kp':
+            keycode = " ".join(params)
+            if self.held_keys.get(keycode):
+                self.held_keys[keycode] -= 1
+        elif ref == '&mo' and params:
+            layer = int(params[0])
+            if self.momentary.get(layer):
+                self.momentary[layer] -= 1
+            self._update_layers()
+
+    # --- Hold-tap и tap-dance ---
+    def _decide_hold_tap(self, at, hold):
+        ht, self.ht = self.ht, None
+        behavior = ht['behavior']
+        params = ht['binding'][1:]
+        base = behavior['bindings'][0 if hold else 1] if len(behavior['bindings']) == 2 else ['&kp']
+        chosen = base + [params[0 if hold else 1]]
+        if hold != (ht['intent'] == INTENT_HOLD):
+            self._count_error('misfires' if hold else 'missed', behavior['label'])
+        self.held[ht['position']] = (chosen, behavior['label'])
+        self._press_binding(chosen, at, ht['origin'], behavior['label'], ht['position'])
+        for t, position, pressed, origin, intent in ht['captured']:
+            self._deliver(max(at, t), position, pressed, origin, intent)
+
+    def _resolve_tap_dance(self, at):
+        td, self.td = self.td, None
+        behavior = td['behavior']
+        binding = behavior['bindings'][min(td['count'], len(behavior['bindings'])) - 1]
+        self._press_binding(binding, at, td['origin'], behavior['label'], td['position'])
+        if td['released']:
+            self._release_binding(binding)
+        else:
+            self.held[td['position']] = (binding, behavior['label'])
+
+    def _expire(self, t):
+        """Срабатывание таймеров hold-tap и tap-dance до момента t"""
+        if self.ht and t >= self.ht['deadline']:
+            flavor = self.ht['behavior']['flavor'] or 'hold-preferred'
+            self._decide_hold_tap(self.ht['deadline'], hold=flavor != 'tap-unless-interrupted')
+        if self.td and t >= self.td['deadline']:
+            self._resolve_tap_dance(self.td['deadline'])
+
+    def _deliver(self, t, position, pressed, origin, intent=0):
+        """Событие после комбо: hold-tap, tap-dance и привязки слоя"""
+        self._expire(t)
+        ht = self.ht
+        if ht and position != ht['position']:
+            flavor = ht['behavior']['flavor'] or 'hold-preferred'
+            if pressed and flavor in ('hold-preferred', 'tap-unless-interrupted'):
+                self._decide_hold_tap(t, hold=True)
+                return self._deliver(t, position, pressed, origin, intent)
+            if flavor == 'balanced':
+                if pressed:
+                    ht['others'].add(position)
+                elif position in ht['others']:
+                    ht['captured'].append((t, position, pressed, origin, intent))
+                    return self._decide_hold_tap(t, hold=True)
+            ht['captured'].append((t, position, pressed, origin, intent))
+            return
+        if ht and not pressed:
+            # Отпущен до решения - tap
+            self._decide_hold_tap(t, hold=False)
+            return self._deliver(t, position, pressed, origin, intent)
+
+        td = self.td
+        if td:
+            if position == td['position']:
+                if pressed:
+                    td['count'] += 1
+                    td['origin'] = origin
+                    td['released'] = False
+                    td['deadline'] = t + (td['behavior']['tapping_term_ms'] or 200)
+                    if td['count'] >= len(td['behavior']['bindings']):
+                        self._resolve_tap_dance(t)
+                else:
+                    td['released'] = True
+                return
+            if pressed:
+                self._resolve_tap_dance(t)
+
+        if pressed:
+            binding = self._resolve(position)
+            source = self.combos[position - COMBO_POSITION_BASE]['name'] \
+                if position >= COMBO_POSITION_BASE else 'kp'
+            self.held[position] = (binding, source)
+            self._press_binding(binding, t, origin, source, position, intent)
+        else:
+            binding, _ = self.held.pop(position, (None, None))
+            if binding:
+                self._release_binding(binding)
+
+    # --- Комбо ---
+    def _candidates(self, keys, first):
+        layer = self._layer()
+        return [i for i in {i for p in keys for i in self.members.get(p, ())}
+                if keys <= self.combos[i]['keys']
+                and (not self.combos[i]['layers'] or layer in self.combos[i]['layers'])
+                and first['t'] - first['idle'] >= (self.combos[i]['require_prior_idle_ms'] or 0)]
+
+    def _flush_combo(self, at):
+        """Комбо не сложилось - перехваченные нажатия идут дальше как обычные"""
+        pending, self.pending = self.pending, []
+        self.pending_deadline = None
+        if any(item['intent'] == INTENT_COMBO for item in pending):
+            self._count_error('missed', 'combo')
+        for item in pending:
+            self._deliver(at, item['position'], True, item['t'], item['intent'])
+
+    def _fire_combo(self, index, at):
+        pending, self.pending = self.pending, []
+        self.pending_deadline = None
+        if any(item['intent'] != INTENT_COMBO for item in pending):
+            self._count_error('misfires', self.combos[index]['name'])
+        self.active_combos[index] = {item['position'] for item in pending}
+        self._deliver(at, COMBO_POSITION_BASE + index, True, pending[-1]['t'])
+
+    def _settle_combo(self, at):
+        """Таймаут или прерывание: самое длинное полное совпадение или сброс"""
+        keys = {item['position'] for item in self.pending}
+        full = [i for i in self._candidates(keys, self.pending[0]) if self.combos[i]['keys'] == keys]
+        if full:
+            self._fire_combo(full[0], at)
+        else:
+            self._flush_combo(at)
+
+    def _physical(self, t, position, pressed, intent=0):
+        """Физическое событие: сначала перехват комбо"""
+        self.events += 1
+        if self.pending and t >= self.pending_deadline:
+            self._settle_combo(self.pending_deadline)
+
+        if pressed:
+            idle = self.last_press
+            self.last_press = t
+            if position in self.members:
+                item = {'t': t, 'position': position, 'idle': idle, 'intent': intent}
+                keys = {p['position'] for p in self.pending} | {position}
+                first = self.pending[0] if self.pending else item
+                candidates = [i for i in self._candidates(keys, first)
+                              if t - first['t'] < (self.combos[i]['timeout_ms'] or 50)]
+                if self.pending and not candidates:
+                    self._settle_combo(t)
+                    keys, first = {position}, item
+                    candidates = self._candidates(keys, first)
+                if candidates:
+                    self.pending.append(item)
+                    if len(self.pending) == 1:
+                        self.pending_deadline = t + max(self.combos[i]['timeout_ms'] or 50 for i in candidates)
+                    full = [i for i in candidates if self.combos[i]['keys'] == keys]
+                    if full and all(self.combos[i]['keys'] == keys for i in candidates):
+                        self._fire_combo(full[0], t)
+                    return
+            elif self.pending:
+                self._settle_combo(t)
+            self._deliver(t, position, True, t, intent)
+            return
+
+        for index, keys in list(self.active_combos.items()):
+            if position in keys:
+                # Комбо отпускается с первой отпущенной клавишей, остальные поглощаются
+                if len(keys) == len(self.combos[index]['keys']):
+                    self._deliver(t, COMBO_POSITION_BASE + index, False, t)
+                keys.discard(position)
+                if not keys:
+                    del self.active_combos[index]
+                return
+        if self.pending:
+            self._settle_combo(t)
+        self._deliver(t, position, False, t)
+
+    def _count_error(self, kind, source):
+        """Ложное срабатывание (misfires) или пропущенное намерение (missed)"""
+        errors = self.errors[kind]
+        errors[source] = errors.get(source, 0) + 1
+
+    # --- Пакетная обработка ---
+    def _busy(self):
+        return bool(self.pending or self.ht or self.td)
+
+    def _plain_run(self, times, positions, presses, start, end):
+        """Участок из обычных клавиш без ожидающих решений: выдача без задержки"""
+        bindings = self._state()[0]
+        counts = Counter(compress(positions[start:end], presses[start:end]))
+        stats = self.sources.setdefault('kp', {'count': 0, 'delays': array('d')})
+        for position, count in counts.items():
+            binding = bindings[position]
+            if binding[0] == '&kp':
+                keycode = " ".join(binding[1:])
+                self.keys[keycode] = self.keys.get(keycode, 0) + count
+                stats['count'] += count
+        last = presses.rfind(b"\x01", start, end)
+        if last >= 0:
+            self.last_press = times[last]
+        self.events += end - start
+
+    def run(self, times, positions, presses, intents=None):
+        """Проигрывание трассы; возвращает сводку (см. report)"""
+        n = len(times)
+        intents = intents or bytes(n)
+        # Пособытийно: нужен поток выдачи или позиции > 255
+        bulk = self.emit is None and positions.itemsize == 1
+        raw = positions.tobytes() if bulk else None
+        i = 0
+        while i < n:
+            # Граница участка считается заново после каждого пособытийного шага:
+            # он мог сменить слои
+            if bulk and not self._busy():
+                # Классы событий трассы при текущих слоях - один translate на набор слоев
+                _, table, cache = self._state()
+                if 'classes' not in cache:
+                    cache['classes'] = raw.translate(table[:256])
+                match = self.INTERESTING.search(cache['classes'], i, n)
+                j = match.start() if match else n
+                # Отпускание клавиши, нажатой пособытийно, тоже идет пособытийно
+                for position in self.held:
+                    if position < 256:
+                        release = raw.find(bytes([position]), i, j)
+                        if release >= 0:
+                            j = release
+                if i < j:
+                    self._plain_run(times, positions, presses, i, j)
+                    i = j
+                    continue
+            self._physical(times[i], positions[i], presses[i], intents[i])
+            i += 1
+
+        # Конец трассы: догоняем таймеры
+        if self.pending:
+            self._settle_combo(self.pending_deadline)
+        self._expire(float('inf'))
+        return self.report()
+
+    def report(self):
+        """Сводка: {'events', 'keystrokes', 'sources': {источник: статистика}, 'misfires', 'missed', 'keys'}"""
+        sources = {}
+        for source, stats in sorted(self.sources.items()):
+            delays = sorted(stats['delays'])
+            zeros = stats['count'] - len(delays)
+            sources[source] = {
+                'count': stats['count'],
+                'delayed': len(delays),
+                'p50_ms': _percentile_with_zeros(delays, zeros, 50),
+                'p95_ms': _percentile_with_zeros(delays, zeros, 95),
+                'max_ms': delays[-1] if delays else 0.0,
+                'total_ms': sum(delays)
+            }
         return {
-            'run_id': run_info['databaseId'],
-            'commit': commit_sha,
-            'commit_short': commit_sha[:7],
-            'branch': run_info['headBranch'],
-            'build_date': run_info['createdAt'],
-            'commit_message': run_info['displayTitle'],
-            'tag': tag if tag else '-'
+            'events': self.events,
+            'keystrokes': sum(s['count'] for s in self.sources.values()),
+            'sources': sources,
+            'misfires': self.errors['misfires'],
+            'missed': self.errors['missed'],
+            'keys': dict(sorted(self.keys.items(), key=lambda kv: -kv[1]))
         }
 
-    @staticmethod
-    def download_firmware(force=False):
-        """Скачивание прошивки из GitHub Actions"""
-        print(f"{timestamp()} - 📥 Скачивание последней прошивки из GitHub Actions...")
+def print_latency_report(report, elapsed):
+    """Таблица задержек по источникам"""
+    print("━" * 80)
+    print_color(f"⏱️  ЗАДЕРЖКИ ПОВЕДЕНИЙ: {report['events']} событий → {report['keystrokes']} нажатий "
+                f"за {elapsed:.2f} сек", Colors.BLUE)
+    print("━" * 80)
+    print(f"{'Источник':<20} {'Нажатий':>9} {'С задержкой':>12} {'p50, мс':>8} {'p95, мс':>8} "
+          f"{'Макс, мс':>9} {'Всего, с':>9}")
+    for source, stats in report['sources'].items():
+        print(f"{source:<20} {stats['count']:>9} {stats['delayed']:>12} {stats['p50_ms']:>8.1f} "
+              f"{stats['p95_ms']:>8.1f} {stats['max_ms']:>9.1f} {stats['total_ms'] / 1000:>9.2f}")
+    total = sum(s['total_ms'] for s in report['sources'].values())
+    print()
+    print(f"   Добавлено задержки всего: {total / 1000:.2f} сек "
+          f"({total / report['keystrokes'] if report['keystrokes'] else 0:.1f} мс на нажатие)")
+    for kind, title in (('misfires', 'Ложные срабатывания'), ('missed', 'Пропущенные намерения')):
+        if report[kind]:
+            print(f"   {title}: " + ", ".join(f"{source}×{count}" for source, count in report[kind].items()))
+    top = list(report['keys'].items())[:10]
+    if top:
+        print("   Чаще всего: " + ", ".join(f"{key}×{count}" for key, count in top))
+    print()
 
-        GitHubFirmware.check_gh_cli()
-        remote = GitHubFirmware.fetch_remote_version()
+# ===== Подбор таймингов =====
+SWEEP_MODEL_VERSION = 1  # увеличить при изменении модели BehaviorEngine
+SWEEP_DEFAULT_GRID = ("*.tapping_term_ms=x0.75,x1,x1.25;"
+                      "*.timeout_ms=x0.66,x1,x1.5;"
+                      "*.require_prior_idle_ms=x0,x0.5,x1,x1.5")
+SWEEP_TRACE_SUFFIXES = ('.txt', '.trace', '.csv')
 
-        print_color("✅ Найден run: " + str(remote['run_id']), Colors.GREEN)
-        print(f"   Version: {remote['tag']}")
-        print(f"   Commit:  {remote['commit_short']} ({remote['commit_message']})")
-        print(f"   Branch:  {remote['branch']}")
-        print(f"   Date:    {remote['build_date']}")
-        print()
+def sweep_points(spec, ast):
+    """Точки сетки параметров: список словарей overrides для BehaviorEngine.
 
-        # Проверяем, не скачана ли уже эта версия
-        if VERSION_FILE.exists() and not force:
-            local = json.loads(VERSION_FILE.read_text())
-            if local.get('commit') == remote['commit']:
-                print_color("ℹ️  Эта версия уже скачана локально!", Colors.BLUE)
-                print()
-                print("💾 Локальная версия:")
-                print(f"   Version: {local.get('tag', '-')}")
-                print(f"   Commit:  {local['commit_short']}")
-                print(f"   Build:   {local['build_date']}")
-                print()
-                print_color("✅ Прошивка актуальна, скачивание не требуется", Colors.GREEN)
-                print()
-                print("💡 Для принудительной загрузки используй: ./flash_sofle.py download --force")
-                return
+    spec - 'ключ=значение,значение;ключ=...'. Ключ - 'имя.поле' или
+    '*.поле' (все behaviors/combos, где поле задано). Значение - число
+    в мс или xK - множитель к текущему значению из keymap.
+    """
+    current = {f"{item.get('label') or item.get('name')}.{field}": value
+               for item in ast['behaviors'] + ast['combos']
+               for field, value in item.items() if field.endswith('_ms') and value is not None}
+    axes = []
+    for part in filter(None, (p.strip() for p in spec.split(';'))):
+        key, _, values = part.partition('=')
+        key = key.strip()
+        if key.startswith('*.'):
+            keys = [k for k in current if k.endswith(key[1:])]
+        else:
+            keys = [key] if key in current else []
+        if not keys or not values:
+            raise ValueError(f"неизвестный параметр в сетке: {part}")
+        options = []
+        for value in values.split(','):
+            value = value.strip()
+            try:
+                option = {k: max(0, round(current[k] * float(value[1:]))) if value.startswith('x') else int(value)
+                          for k in keys}
+            except ValueError:
+                raise ValueError(f"неверное значение '{value}' для {key}")
+            if option not in options:
+                options.append(option)
+        axes.append(options)
 
-        # Очищаем и создаем директорию
-        if DOWNLOADS.exists():
-            run_command(f"rm -rf {DOWNLOADS}", check=False)
-        DOWNLOADS.mkdir(parents=True, exist_ok=True)
+    points = [{}]
+    for options in axes:
+        points = [dict(point, **option) for point in points for option in options]
+    # Только отличия от keymap; одинаковые точки схлопываются
+    unique = {}
+    for point in points:
+        diff = {k: v for k, v in sorted(point.items()) if current[k] != v}
+        unique.setdefault(json.dumps(diff, sort_keys=True), diff)
+    return list(unique.values())
 
-        # Скачиваем артефакты
-        print("📦 Скачиваем артефакты...")
-        run_command(f'gh run download {remote["run_id"]} --repo {REPO} --dir {DOWNLOADS}')
+# Состояние процесса-исполнителя: AST и уже загруженные трассы
+_SWEEP_WORKER = {'ast': None, 'traces': {}}
 
-        # Перемещаем .uf2 файлы
-        for uf2 in DOWNLOADS.rglob("*.uf2"):
-            if uf2.parent != DOWNLOADS:
-                uf2.rename(DOWNLOADS / uf2.name)
+def _sweep_init(ast):
+    _SWEEP_WORKER['ast'] = ast
+    _SWEEP_WORKER['traces'].clear()
 
-        # Удаляем пустые директории
-        for d in DOWNLOADS.iterdir():
-            if d.is_dir() and not list(d.iterdir()):
-                d.rmdir()
+def _sweep_task(trace_path, overrides):
+    """Прогон одной трассы с одним набором параметров (в процессе пула)"""
+    traces = _SWEEP_WORKER['traces']
+    if trace_path not in traces:
+        traces[trace_path] = load_trace(trace_path)
+    report = BehaviorEngine(_SWEEP_WORKER['ast'], overrides=overrides).run(*traces[trace_path])
+    return {
+        'keystrokes': report['keystrokes'],
+        'added_ms': sum(s['total_ms'] for s in report['sources'].values()),
+        'misfires': report['misfires'],
+        'missed': report['missed']
+    }
 
-        # Сохраняем информацию о версии
-        remote['download_date'] = datetime.now().isoformat()
-        VERSION_FILE.write_text(json.dumps(remote, indent=2))
+class ParameterSweep:
+    """Перебор таймингов keymap на корпусе трасс в пуле процессов.
 
-        print_color(f"✅ Прошивки скачаны в {DOWNLOADS}:", Colors.GREEN)
-        for uf2 in sorted(DOWNLOADS.glob("*.uf2")):
-            print(f"   {uf2.name}")
-        print()
+    Каждая пара (трасса, параметры) считается один раз: результат
+    хранится в SWEEP_CACHE_FILE по ключу из sha256 трассы, хэша AST,
+    параметров и SWEEP_MODEL_VERSION, так что повторный запуск считает
+    только новые точки. Точки ранжируются по Парето-фронту (добавленная
+    задержка на нажатие против ложных срабатываний на 1000 нажатий).
+    """
 
-        GitHubFirmware.show_version()
+    def __init__(self, ast, traces, points, workers=None, cache_file=SWEEP_CACHE_FILE):
+        self.ast = ast
+        self.traces = [str(t) for t in traces]
+        self.points = points if {} in points else [{}] + points
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_file = Path(cache_file)
+        self.ast_hash = hashlib.sha256(json.dumps(ast, sort_keys=True).encode()).hexdigest()[:16]
 
-    @staticmethod
-    def show_version():
-        """Показать текущую версию прошивки"""
-        if not VERSION_FILE.exists():
-            print_color("❌ Версия не найдена. Сначала выполни: ./flash_sofle.py download", Colors.RED)
-            return False
+    def _load_cache(self):
+        try:
+            return json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return {}
 
-        info = json.loads(VERSION_FILE.read_text())
-        print("📋 Версия прошивки:")
-        print(f"   Version: {info.get('tag', '-')}")
-        print(f"   Commit:  {info['commit_short']} ({info['commit_message']})")
-        print(f"   Branch:  {info['branch']}")
-        print(f"   Build:   {info['build_date']}")
-        print(f"   Run ID:  {info['run_id']}")
-        return True
+    def _save_cache(self, cache):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(cache, separators=(',', ':')))
+        os.replace(tmp, self.cache_file)
 
-# ===== Прошивка =====
-class Flasher:
-    def __init__(self, sudo_mgr, force_mode=False):
-        self.sudo = sudo_mgr
-        self.force_mode = force_mode
-        MOUNT_DIR.mkdir(parents=True, exist_ok=True)
+    def _key(self, trace_hash, point):
+        return f"{SWEEP_MODEL_VERSION}:{self.ast_hash}:{trace_hash}:{json.dumps(point, sort_keys=True)}"
 
-    def find_firmware(self):
-        """Поиск файлов прошивки"""
-        files = {
-            'left': list(DOWNLOADS.glob("sofle_left-*.uf2")),
-            'right': list(DOWNLOADS.glob("sofle_right-*.uf2")),
-            'reset': list(DOWNLOADS.glob("settings_reset-*.uf2"))
-        }
+    def run(self, log=print_color):
+        """Прогон всех точек; возвращает ранжированный список результатов"""
+        cache = self._load_cache()
+        trace_hashes = {path: hashlib.sha256(Path(path).read_bytes()).hexdigest() for path in self.traces}
+        results = {}
+        todo = []
+        for index, point in enumerate(self.points):
+            for path in self.traces:
+                key = self._key(trace_hashes[path], point)
+                if key in cache:
+                    results[(index, path)] = cache[key]
+                else:
+                    todo.append((index, path, key))
 
-        if not files['left'] or not files['right']:
-            print_color(f"❌ Не найдены прошивки в {DOWNLOADS}", Colors.RED)
-            sys.exit(1)
+        total = len(self.points) * len(self.traces)
+        log(f"📊 Точек: {len(self.points)}, трасс: {len(self.traces)}, из кэша {total - len(todo)}/{total}",
+            Colors.BLUE)
+        if todo:
+            start = time.monotonic()
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(todo)),
+                                     initializer=_sweep_init, initargs=(self.ast,)) as pool:
+                futures = {pool.submit(_sweep_task, path, self.points[index]): (index, path, key)
+                           for index, path, key in todo}
+                try:
+                    for done, future in enumerate(as_completed(futures), 1):
+                        index, path, key = futures[future]
+                        results[(index, path)] = cache[key] = future.result()
+                        if done % max(1, len(todo) // 10) == 0 or done == len(todo):
+                            print(f"\r   Прогонов: {done}/{len(todo)}", end='', flush=True)
+                finally:
+                    print()
+                    # Сохраняем и частичный результат: повторный запуск продолжит
+                    self._save_cache(cache)
+            log(f"✅ Посчитано за {time.monotonic() - start:.1f} сек ({self.workers} процессов)", Colors.GREEN)
+        return self.rank([self._merge(index, [results[(index, path)] for path in self.traces])
+                          for index in range(len(self.points))])
 
-        firmware = {
-            'left': str(files['left'][0]),
-            'right': str(files['right'][0]),
-            'reset': str(files['reset'][0]) if files['reset'] else None
+    def _merge(self, index, runs):
+        """Сумма по трассам для одной точки"""
+        keystrokes = sum(r['keystrokes'] for r in runs) or 1
+        misfires, missed = Counter(), Counter()
+        for r in runs:
+            misfires.update(r['misfires'])
+            missed.update(r['missed'])
+        return {
+            'params': self.points[index],
+            'keystrokes': keystrokes,
+            'latency_ms': sum(r['added_ms'] for r in runs) / keystrokes,
+            'misfire_rate': sum(misfires.values()) * 1000 / keystrokes,
+            'missed_rate': sum(missed.values()) * 1000 / keystrokes,
+            'misfires': dict(misfires.most_common()),
+            'missed': dict(missed.most_common())
         }
 
-        # Показываем версию
-        if VERSION_FILE.exists():
-            GitHubFirmware.show_version()
-            print()
+    @staticmethod
+    def rank(points):
+        """Парето-фронт (задержка, ложные срабатывания) первым, внутри - по задержке"""
+        for p in points:
+            p['pareto'] = not any(
+                q['latency_ms'] <= p['latency_ms'] and q['misfire_rate'] <= p['misfire_rate']
+                and (q['latency_ms'], q['misfire_rate']) != (p['latency_ms'], p['misfire_rate'])
+                for q in points)
+        return sorted(points, key=lambda p: (not p['pareto'], p['latency_ms'], p['misfire_rate'], p['missed_rate']))
 
-        print_color("✅ Найдены прошивки:", Colors.GREEN)
-        print(f"   Левая  = {firmware['left']}")
-        print(f"   Правая = {firmware['right']}")
-        if firmware['reset']:
-            print(f"   Reset  = {firmware['reset']}")
+    @staticmethod
+    def print_ranking(ranked, top=15):
+        """Таблица лучших точек и текущих значений keymap"""
+        baseline = next(p for p in ranked if not p['params'])
+        print("━" * 80)
+        print_color(f"🎯 ПОДБОР ТАЙМИНГОВ: {len(ranked)} точек, {baseline['keystrokes']} нажатий", Colors.BLUE)
+        print("━" * 80)
+        print(f"  {'#':>3} {'мс/нажатие':>11} {'ложных/1000':>12} {'пропусков/1000':>15}  Параметры")
+        shown = ranked[:top] + ([baseline] if baseline not in ranked[:top] else [])
+        for p in shown:
+            mark = '★' if p['pareto'] else ' '
+            params = ', '.join(f"{k}={v}" for k, v in p['params'].items()) or '(текущий keymap)'
+            print(f"{mark} {ranked.index(p) + 1:>3} {p['latency_ms']:>11.2f} {p['misfire_rate']:>12.2f} "
+                  f"{p['missed_rate']:>15.2f}  {params}")
+        print()
+        print("   ★ - Парето-фронт: нельзя уменьшить задержку, не добавив ложных срабатываний")
+        if baseline['misfires']:
+            print("   Ложные срабатывания сейчас: " +
+                  ", ".join(f"{source}×{count}" for source, count in baseline['misfires'].items()))
+        print()
 
-        return firmware
+def sweep_corpus(paths):
+    """Файлы трасс: сами файлы и трассы внутри каталогов"""
+    traces = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            traces.extend(sorted(p for p in path.rglob('*') if p.is_file() and p.suffix in SWEEP_TRACE_SUFFIXES))
+        elif path.is_file():
+            traces.append(path)
+        else:
+            raise ValueError(f"трасса не найдена: {path}")
+    if not traces:
+        raise ValueError("в корпусе нет трасс (" + ", ".join(SWEEP_TRACE_SUFFIXES) + ")")
+    return traces
 
-    def flash_half(self, fw_file, half_name):
-        """Прошивка одной половинки"""
-        if not Path(fw_file).exists():
-            print_color(f"❌ Файл прошивки не найден: {fw_file}", Colors.RED)
-            sys.exit(1)
+# ===== Анализ keymap =====
+def _bits(mask):
+    """Номера установленных битов маски по возрастанию"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
 
-        if not self.force_mode:
-            print()
-            print("━" * 60)
-            print_color(f"⚠️  ПРОШИВКА: {half_name}", Colors.YELLOW)
-            print("━" * 60)
-            print()
-            print("📋 Что нужно сделать:")
-            print("   1. Отключи TRRS кабель между половинками!")
-            print("   2. Отключи USB от обеих половин")
-            print("   3. Проверь переключатель питания:")
-            print("      • Правая половинка: ON = вниз ⬇️")
-            print("      • Левая половинка:  ON = вверх ⬆️")
-            print(f"   4. Подключи USB только к: {half_name}")
-            print("   5. Нажми 2 раза кнопку RESET на контроллере")
-            print("      (появится диск NICENANO)")
-            print()
-            print("⏳ Жду диск NICENANO... (таймаут 60 сек)")
-            print("   (нажми Ctrl+C для отмены)")
-            print()
+class KeymapLinter:
+    """Статические проверки keymap: комбо, слои, тайминги.
 
-        # Ожидание подключения диска
-        timeout = 60
-        elapsed = 0
-
-        while elapsed < timeout:
-            # Проверяем наличие диска
-            volumes = Path("/Volumes")
-            if volumes.exists():
-                for v in volumes.iterdir():
-                    if "NICENANO" in v.name.upper():
-                        mount_point = v
-                        print(f"{timestamp()} - {half_name} подключена: {mount_point}")
-
-                        # Получаем устройство
-                        df_output, _ = run_command(f"df | grep '{mount_point}'")
-                        device = df_output.split()[0].replace('/dev/', '') if df_output else 'disk4'
-
-                        # Обновляем sudo timestamp
-                        self.sudo.run_sudo("-v")
-
-                        # Unmount (с повторами)
-                        unmounted = False
-                        for attempt in range(3):
-                            if attempt == 0:
-                                # Первая попытка - обычный unmount
-                                unmount_out, unmount_err = self.sudo.run_sudo(f"diskutil unmount {mount_point}")
-                            else:
-                                # Повторные попытки - force unmount
-                                print_color(f"⚠️  Попытка {attempt + 1}/3: принудительный unmount...", Colors.YELLOW)
-                                time.sleep(1)
-                                unmount_out, unmount_err = self.sudo.run_sudo(f"diskutil unmount force {mount_point}")
-
-                            if unmount_out or "successfully" in str(unmount_err).lower():
-                                unmounted = True
-                                if attempt > 0:
-                                    print_color("✅ Принудительный unmount успешен", Colors.GREEN)
-                                break
-
-                        if not unmounted:
-                            print_color(f"❌ Не удалось unmount после 3 попыток", Colors.RED)
-                            print()
-                            choice = input("Продолжить? (y - да, n - выход, r - повторить unmount): ").strip().lower()
-                            if choice == 'n':
-                                sys.exit(1)
-                            elif choice == 'r':
-                                # Даем пользователю время вручную unmount
-                                print("Попробуй вручную: sudo diskutil unmount force /Volumes/NICENANO")
-                                input("Нажми Enter когда unmount будет готов...")
-                            # Если 'y' или другое - продолжаем
-
-                        # Mount
-                        mount_out, mount_err = self.sudo.run_sudo(f"mount -t msdos -o rw,auto,nobrowse /dev/{device} {MOUNT_DIR}")
-                        if not mount_out and mount_err:
-                            print_color(f"❌ Ошибка при монтировании: {mount_err}", Colors.RED)
-                            print(f"💡 Попробуй вручную: sudo mount -t msdos /dev/{device} {MOUNT_DIR}")
-                            sys.exit(1)
-
-                        # Копируем прошивку
-                        run_command(f"cp {fw_file} {MOUNT_DIR}/")
-                        print_color(f"✅ {half_name} успешно прошита!", Colors.GREEN)
-                        print(f"   Отключи USB от этой половины.")
-
-                        # Синхронизируем и ждем завершения записи
-                        print("⏳ Синхронизация данных...")
-                        run_command("sync")
-                        time.sleep(2)
-
-                        print()
-                        print_color("ℹ️  ВАЖНО: Контроллер перезагрузится автоматически", Colors.YELLOW)
-                        print("   macOS может показать ошибку 'диск извлечен неправильно'")
-                        print("   ✅ Это НОРМАЛЬНО - так работает bootloader!")
-                        print("   ✅ Прошивка записана успешно, ошибку можно игнорировать")
-                        print()
-
-                        # Корректно извлекаем диск (eject)
-                        self.sudo.run_sudo(f"diskutil eject {MOUNT_DIR}")
-
-                        # Ждем отключения диска
-                        print()
-                        print("⏳ Жду отключения диска NICENANO...")
-                        while True:
-                            found = False
-                            if volumes.exists():
-                                for v in volumes.iterdir():
-                                    if "NICENANO" in v.name.upper():
-                                        found = True
-                                        break
-                            if not found:
-                                print_color("✅ Диск отключен, можно продолжать", Colors.GREEN)
-                                print()
-                                break
-                            time.sleep(1)
-
-                        # Показываем подсказку
-                        print("ℹ️  Если следующая половинка не подключается:")
-                        print("   Попробуй МЕТОД B:")
-                        print("   1. Отключи USB")
-                        print("   2. УДЕРЖИВАЙ кнопку RESET")
-                        print("   3. Подключи USB (продолжая держать RESET)")
-                        print("   4. Отпусти RESET через 2-3 секунды")
-                        print()
-                        return
+    Наборы позиций комбо, слои комбо и позиции behaviors с таймингом
+    хранятся как битовые маски (int), поэтому каждая проверка - это
+    несколько AND/OR на комбо: пересечения ищутся через индекс
+    позиция -> маска комбо, а не перебором всех пар.
+    """
 
-            # Обратный отсчет
-            remaining = timeout - elapsed
-            print(f"\r⏳ Осталось: {remaining:02d} сек...", end='', flush=True)
-            time.sleep(1)
-            elapsed += 1
+    TIMED_KINDS = ('hold-tap', 'tap-dance')
+    LAYER_REFS = ('&mo', '&tog', '&to', '&sl', '&lt')
+    ICONS = {'error': ('❌', Colors.RED), 'warning': ('⚠️ ', Colors.YELLOW), 'info': ('ℹ️ ', Colors.BLUE)}
 
-        # Таймаут истек
-        print()
-        print()
-        print_color("⏱️  Таймаут истек! Диск NICENANO не обнаружен.", Colors.RED)
-        print()
-        print("━" * 60)
-        print_color("💡 МЕТОД B: Альтернативный вход в bootloader", Colors.YELLOW)
-        print("━" * 60)
-        print()
-        print("Попробуй этот метод, если двойной reset не работает:")
-        print()
-        print("   1. Отключи USB от клавиатуры")
-        print("   2. Найди кнопку RESET на контроллере")
-        print("   3. НАЖМИ и УДЕРЖИВАЙ кнопку RESET")
-        print("   4. Подключи USB (продолжая ДЕРЖАТЬ RESET!)")
-        print("   5. Держи RESET ещё 2-3 секунды после подключения")
-        print("   6. Отпусти RESET")
-        print("   7. Должен появиться диск NICENANO")
-        print()
-        print("Альтернатива: замкни контакты RST и GND скрепкой дважды")
-        print()
-        sys.exit(1)
+    def __init__(self, ast):
+        self.ast = ast
+        self.layers = ast['layers']
+        self.combos = ast['combos']
+        self.behaviors = {b['label']: b for b in ast['behaviors']}
+        self.width = len(self.layers[0]['bindings']) if self.layers else 0
+        self.all_layers = (1 << len(self.layers)) - 1
+        self.combo_keys = [sum(1 << p for p in set(c['key_positions'])) for c in self.combos]
+        # Пустой layers у комбо - активно на всех слоях
+        self.combo_layers = [sum(1 << n for n in set(c['layers'])) or self.all_layers for c in self.combos]
+        self.issues = []
 
-    def clear_btpairs(self, firmware):
-        """Очистка BT-пар и перепрошивка"""
-        if not firmware['reset']:
-            print_color(f"❌ Reset-прошивка не найдена в {DOWNLOADS}", Colors.RED)
-            sys.exit(1)
+    def _issue(self, level, where, message):
+        self.issues.append({'level': level, 'where': where, 'message': message})
 
-        print(f"{timestamp()} - ⚠️ Сначала будет прошивка reset на ОБЕ половинки, все BT-пары удалятся!")
-        print()
+    def _layer_name(self, index):
+        return KeymapViewer.layer_title(self.ast, index) if index < len(self.layers) else f"#{index}"
 
-        print("━" * 60)
-        print("📋 ШАГ 1/4: Reset правой половины")
-        print("━" * 60)
-        self.flash_half(firmware['reset'], "правую половину (reset)")
+    def _layer_target(self, binding):
+        """Номер слоя в &mo/&tog/&to/&sl/&lt или None"""
+        if binding[0] in self.LAYER_REFS and len(binding) > 1 and binding[1].isdigit():
+            return int(binding[1])
+        return None
 
-        print()
-        print("━" * 60)
-        print("📋 ШАГ 2/4: Reset левой половины")
-        print("━" * 60)
-        self.flash_half(firmware['reset'], "левую половину (reset)")
+    def run(self):
+        self.check_grid()
+        self.check_overlaps()
+        self.check_timings()
+        self.check_layers()
+        self.check_unused()
+        return self.issues
 
-        print()
-        print_color("✅ BT-пары очищены на обеих половинках", Colors.GREEN)
-        print()
-        print(f"{timestamp()} - 🔄 Прошиваем основную прошивку (правую → левую)...")
-        print()
+    def check_grid(self):
+        """Все слои покрывают одну сетку, позиции комбо в ее пределах"""
+        if not self.layers:
+            return self._issue('error', 'keymap', "нет ни одного слоя")
+        base = self.layers[0]
+        for index, layer in enumerate(self.layers):
+            count = len(layer['bindings'])
+            if count != self.width:
+                self._issue('error', layer['name'],
+                            f"{count} привязок вместо {self.width} - позиции после {min(count, self.width)} сдвинуты")
+            elif layer['rows'] != base['rows']:
+                self._issue('warning', layer['name'],
+                            f"строки {layer['rows']} не совпадают с {base['name']} {base['rows']}")
+        for position, binding in enumerate(base['bindings']):
+            if binding[0] == '&trans':
+                self._issue('warning', base['name'], f"позиция {position}: &trans на базовом слое ничего не делает")
+        grid = (1 << self.width) - 1
+        for combo, keys in zip(self.combos, self.combo_keys):
+            outside = keys & ~grid
+            if outside:
+                self._issue('error', combo['name'], f"позиции {list(_bits(outside))} вне сетки 0-{self.width - 1}")
+            if keys & (keys - 1) == 0:
+                self._issue('warning', combo['name'], "меньше двух позиций - это не комбо")
 
-        print("━" * 60)
-        print("📋 ШАГ 3/4: Основная прошивка правой половины")
-        print("━" * 60)
-        self.flash_half(firmware['right'], "правую половину")
+    def check_overlaps(self):
+        """Общие позиции комбо: затенение, вложенность, пересечения"""
+        index = {}
+        for i, keys in enumerate(self.combo_keys):
+            for position in _bits(keys):
+                index[position] = index.get(position, 0) | (1 << i)
 
-        print()
-        print("━" * 60)
-        print("📋 ШАГ 4/4: Основная прошивка левой половины")
-        print("━" * 60)
-        self.flash_half(firmware['left'], "левую половину")
+        for i, keys in enumerate(self.combo_keys):
+            neighbours = 0
+            for position in _bits(keys):
+                neighbours |= index[position]
+            # Каждую пару смотрим один раз: только j > i
+            neighbours &= ~((1 << (i + 1)) - 1)
+            a = self.combos[i]
+            for j in _bits(neighbours):
+                b = self.combos[j]
+                other = self.combo_keys[j]
+                shared = keys & other
+                layers = self.combo_layers[i] & self.combo_layers[j]
+                positions = list(_bits(shared))
+                if not layers:
+                    self._issue('info', f"{a['name']}/{b['name']}",
+                                f"общие позиции {positions} на разных слоях - конфликта нет")
+                elif keys == other:
+                    self._issue('error', b['name'],
+                                f"те же позиции, что у {a['name']}, на слоях {self._layer_list(layers)} - "
+                                f"никогда не сработает")
+                elif shared in (keys, other):
+                    small, big = (a, b) if shared == keys else (b, a)
+                    self._issue('warning', small['name'],
+                                f"вложено в {big['name']}: срабатывает только после окна "
+                                f"{big['timeout_ms'] or 50} мс без третьей клавиши")
+                else:
+                    self._issue('warning', f"{a['name']}/{b['name']}",
+                                f"общие позиции {positions} на слоях {self._layer_list(layers)}")
 
-        print()
-        print_color("✅ Обе половины перепрошиты (reset + основная прошивка)", Colors.GREEN)
+    def check_timings(self):
+        """Окно комбо не должно перекрывать tapping-term behaviors на его клавишах"""
+        timed = []
+        for layer in self.layers:
+            mask = 0
+            for position, binding in enumerate(layer['bindings']):
+                behavior = self.behaviors.get(binding[0][1:])
+                if behavior and behavior['kind'] in self.TIMED_KINDS:
+                    mask |= 1 << position
+            timed.append(mask)
 
-        self.show_post_flash_help()
+        for combo, keys, layers in zip(self.combos, self.combo_keys, self.combo_layers):
+            timeout = combo['timeout_ms'] or 50
+            for n in _bits(layers & self.all_layers):
+                for position in _bits(keys & timed[n]):
+                    label = self.layers[n]['bindings'][position][0][1:]
+                    term = self.behaviors[label]['tapping_term_ms'] or 200
+                    level = 'warning' if timeout >= term else 'info'
+                    self._issue(level, combo['name'],
+                                f"позиция {position} на слое {self._layer_name(n)} - {label} "
+                                f"(tapping-term {term} мс), окно комбо {timeout} мс")
 
-    def flash_all(self, firmware):
-        """Прошивка обеих половин"""
-        print("━" * 60)
-        print("📋 Прошивка правой половины")
-        print("━" * 60)
-        self.flash_half(firmware['right'], "правую половину")
+    def check_layers(self):
+        """Достижимость слоев от базового и выход из включенных через &tog/&to"""
+        refs = []   # по слоям: [(цель, источник, привязка)]
+        for n, layer in enumerate(self.layers):
+            refs.append([(self._layer_target(b), f"{layer['name']}:{p}", b[0])
+                         for p, b in enumerate(layer['bindings']) if self._layer_target(b) is not None])
+        combo_refs = [[(self._layer_target(b), combo['name'], b[0])
+                       for b in combo['bindings'] if self._layer_target(b) is not None]
+                      for combo in self.combos]
 
-        print()
-        print("━" * 60)
-        print("📋 Прошивка левой половины")
-        print("━" * 60)
-        self.flash_half(firmware['left'], "левую половину")
+        for n, targets in enumerate(refs):
+            for target, source, _ in targets:
+                if target >= len(self.layers):
+                    self._issue('error', source, f"ссылка на несуществующий слой {target}")
+        for i, (combo, targets) in enumerate(zip(self.combos, combo_refs)):
+            for target, source, _ in targets:
+                if target >= len(self.layers):
+                    self._issue('error', source, f"ссылка на несуществующий слой {target}")
+            outside = self.combo_layers[i] & ~self.all_layers
+            if outside:
+                self._issue('error', combo['name'], f"слои {list(_bits(outside))} не существуют")
 
-        self.show_post_flash_help()
+        reach = 1 if self.layers else 0
+        toggles = {}   # слой -> [(источник, маска слоев, где он активен)]
+        while True:
+            found = reach
+            for n in _bits(reach):
+                for target, source, kind in refs[n]:
+                    found |= (1 << target) & self.all_layers
+                    if kind in ('&tog', '&to'):
+                        toggles.setdefault(target, []).append((source, 1 << n))
+            for i, targets in enumerate(combo_refs):
+                if self.combo_layers[i] & reach:
+                    for target, source, kind in targets:
+                        found |= (1 << target) & self.all_layers
+                        if kind in ('&tog', '&to'):
+                            toggles.setdefault(target, []).append((source, self.combo_layers[i]))
+            if found == reach:
+                break
+            reach = found
 
-    def show_post_flash_help(self):
-        """Инструкции после прошивки"""
-        print()
-        print("━" * 60)
-        print_color("✅ ОБЕ ПОЛОВИНЫ ПРОШИТЫ!", Colors.GREEN)
-        print("━" * 60)
-        print()
-        print("📋 ШАГИ ДЛЯ ПОДКЛЮЧЕНИЯ:")
-        print()
-        print("1️⃣  Проверь переключатели питания:")
-        print("   • Правая половинка: ON = вниз ⬇️")
-        print("   • Левая половинка:  ON = вверх ⬆️")
-        print()
-        print("2️⃣  Подключи TRRS кабель между половинами")
-        print("   ⚠️  ВАЖНО: TRRS должен быть надежно вставлен с обеих сторон")
-        print()
-        print("3️⃣  Подключи USB к ЛЕВОЙ половине")
-        print("   💡 Левая половина = центральная (central)")
-        print("   💡 Правая половина = периферийная (peripheral)")
-        print()
-        print("4️⃣  Подожди 5-10 секунд для инициализации")
-        print()
-        print("━" * 60)
-        print_color("🔧 ЕСЛИ ПРАВАЯ ПОЛОВИНА НЕ ВИДИТ ЛЕВУЮ:", Colors.YELLOW)
-        print("━" * 60)
-        print()
-        print("ВАРИАНТ 1: Проверь TRRS кабель")
-        print("   • Отключи USB")
-        print("   • Отключи TRRS кабель")
-        print("   • Подожди 5 секунд")
-        print("   • Подключи TRRS кабель заново (проверь, что вставлен до конца)")
-        print("   • Подключи USB к левой половине")
-        print()
-        print("ВАРИАНТ 2: Hard reset обеих половин")
-        print("   • Отключи USB и TRRS")
-        print("   • Нажми кнопку RESET на правой половине")
-        print("   • Нажми кнопку RESET на левой половине")
-        print("   • Подключи TRRS кабель")
-        print("   • Подключи USB к левой половине")
-        print()
-        print("ВАРИАНТ 3: Очистка BT-пар (если используешь Bluetooth)")
-        print("   • Выполни: ./flash_sofle.py btclear")
-        print("   • Это очистит все BT-соединения и перепрошьет обе половины")
-        print()
-        print("ВАРИАНТ 4: Проверь порядок прошивки")
-        print("   • ВАЖНО: сначала правая, потом левая!")
-        print("   • Если прошил в обратном порядке:")
-        print("     ./flash_sofle.py right")
-        print("     ./flash_sofle.py left")
-        print()
-        print("ВАРИАНТ 5: Проверь физическое соединение")
-        print("   • TRRS кабель может быть неисправен - попробуй другой")
-        print("   • TRRS разъемы могут быть загрязнены - протри спиртом")
-        print("   • Проверь, что в TRRS разъёмах нет мусора/пыли")
-        print()
-        print("━" * 60)
-        print_color("💡 ДИАГНОСТИКА:", Colors.BLUE)
-        print("━" * 60)
-        print()
-        print("Проверить версию прошивки:")
-        print("   ./flash_sofle.py version")
-        print()
-        print("━" * 60)
-        print_color("🔓 LOCK/UNLOCK КЛАВИАТУРЫ:", Colors.BLUE)
-        print("━" * 60)
-        print()
-        print("Блокировка:   ЛЕВЫЙ Shift + Lower + Raise")
-        print("Разблокировка: ПРАВЫЙ Shift + Lower + Raise")
-        print()
-        print("(Lower = левая нижняя кнопка большого пальца)")
-        print("(Raise = правая нижняя кнопка большого пальца)")
+        for n in _bits(self.all_layers & ~reach):
+            self._issue('error', self.layers[n]['name'], "слой недостижим: на него нет &mo/&tog/&to/&lt")
+
+        for n, sources in sorted(toggles.items()):
+            # Источники, активные только на самом слое N, его не включают
+            sources = sorted({source for source, mask in sources if mask & ~(1 << n)})
+            if n == 0 or not sources:
+                continue
+            # Выход: &tog N или &to на самом слое (с учетом &trans до базового) или в комбо этого слоя
+            bindings = [b if b[0] != '&trans' else self.layers[0]['bindings'][p]
+                        for p, b in enumerate(self.layers[n]['bindings'][:self.width])]
+            exits = [f"{self.layers[n]['name']}:{p}" for p, b in enumerate(bindings)
+                     if b[0] == '&to' or (b[0] == '&tog' and self._layer_target(b) == n)]
+            exits += [self.combos[i]['name'] for i, targets in enumerate(combo_refs)
+                      if self.combo_layers[i] >> n & 1
+                      and any(kind == '&to' or (kind == '&tog' and target == n) for target, _, kind in targets)]
+            if not exits:
+                self._issue('error', self.layers[n]['name'],
+                            f"включается через {', '.join(sources)}, но выключить нечем")
+            elif all(kind != '&mo' for refs_n in refs for target, _, kind in refs_n if target == n):
+                self._issue('info', self.layers[n]['name'],
+                            f"только переключение: вкл. {', '.join(sources)}, "
+                            f"выкл. {', '.join(exits)}")
+
+    def check_unused(self):
+        """Behaviors, на которые нет ссылок"""
+        used = {b[0][1:] for layer in self.layers for b in layer['bindings']}
+        used |= {b[0][1:] for combo in self.combos for b in combo['bindings']}
+        used |= {b[0][1:] for behavior in self.behaviors.values() for b in behavior['bindings']}
+        for label in self.behaviors:
+            if label not in used:
+                self._issue('info', label, "behavior определен, но нигде не используется")
+
+    def _layer_list(self, mask):
+        return ", ".join(self._layer_name(n) for n in _bits(mask))
+
+    def print_report(self, elapsed):
+        """Список замечаний; возвращает число ошибок"""
+        counts = Counter(issue['level'] for issue in self.issues)
+        print_color(f"🔍 ПРОВЕРКА KEYMAP: {len(self.combos)} комбо, {len(self.layers)} слоев, "
+                    f"{len(self.behaviors)} behaviors за {elapsed * 1000:.1f} мс", Colors.BLUE)
+        for level in ('error', 'warning', 'info'):
+            icon, color = self.ICONS[level]
+            for issue in self.issues:
+                if issue['level'] == level:
+                    print_color(f"{icon} {issue['where']}: {issue['message']}", color)
         print()
+        if counts['error']:
+            print_color(f"❌ Ошибок: {counts['error']}, предупреждений: {counts['warning']}", Colors.RED)
+        else:
+            print_color(f"✅ Ошибок нет, предупреждений: {counts['warning']}", Colors.GREEN)
+        return counts['error']
 
 # ===== Просмотр раскладки =====
 class KeymapViewer:
-    KEYMAP_FILE = Path(__file__).parent.parent / "config" / "sofle.keymap"
+    KEYMAP_FILE = KEYMAP_FILE
+    LAYER_REFS = ('&mo', '&tog', '&to', '&sl', '&lt')
+    CELL_WIDTH = 7
+    # Короткие подписи для сетки слоя
+    KEY_ALIASES = {
+        'LEFT_CONTROL': 'LCTRL', 'RIGHT_CONTROL': 'RCTRL', 'LEFT_ALT': 'LALT', 'RIGHT_ALT': 'RALT',
+        'LEFT_META': 'LGUI', 'RIGHT_META': 'RGUI', 'LEFT_SHIFT': 'LSHFT', 'RIGHT_SHIFT': 'RSHFT',
+        'LEFT_BRACKET': '[', 'RIGHT_BRACKET': ']', 'LBKT': '[', 'RBKT': ']', 'LBRC': '{', 'RBRC': '}',
+        'CAPSLOCK': 'CAPS', 'SPACE': 'SPC', 'ENTER': 'ENT', 'ESCAPE': 'ESC', 'BSPC': '⌫',
+        'UP_ARROW': '↑', 'UP': '↑', 'DOWN': '↓', 'LEFT': '←', 'RIGHT': '→',
+        'PAGE_DOWN': 'PGDN', 'PAGE_UP': 'PGUP', 'PRINTSCREEN': 'PSCRN',
+        'MINUS': '-', 'EQUAL': '=', 'COMMA': ',', 'DOT': '.', 'FSLH': '/', 'BSLH': '\\',
+        'SEMI': ';', 'COLON': ':', 'SQT': "'", 'DQT': '"', 'GRAVE': '`', 'TILDE': '~',
+        'EXCL': '!', 'AT': '@', 'HASH': '#', 'PIPE': '|', 'RPAR': ')', 'KP_PLUS': '+', 'PLUS': '+',
+        'UNDER': '_', 'BT_SEL': 'BT', 'BT_CLR': 'BTCLR'
+    }
 
     @staticmethod
     def show_layout():
@@ -574,120 +5399,158 @@ class KeymapViewer:
             print_color(f"❌ Файл конфигурации не найден: {KeymapViewer.KEYMAP_FILE}", Colors.RED)
             return
 
-        content = KeymapViewer.KEYMAP_FILE.read_text()
+        try:
+            ast = load_keymap(KeymapViewer.KEYMAP_FILE)
+        except KeymapSyntaxError as e:
+            print_color(f"❌ Ошибка разбора {KeymapViewer.KEYMAP_FILE.name}: {e}", Colors.RED)
+            return
 
         print_color("⌨️  РАСКЛАДКА КЛАВИАТУРЫ SOFLE", Colors.BLUE)
         print()
 
         # Показываем behaviors
-        KeymapViewer._show_behaviors(content)
+        KeymapViewer._show_behaviors(ast)
 
         # Показываем combos
-        KeymapViewer._show_combos(content)
+        KeymapViewer._show_combos(ast)
 
         # Показываем слои
-        KeymapViewer._show_layers(content)
+        KeymapViewer._show_layers(ast)
+
+    @staticmethod
+    def layer_title(ast, index):
+        """Имя слоя по индексу: display-name или имя узла без _layer"""
+        if index is None or not 0 <= index < len(ast['layers']):
+            return f"#{index}"
+        layer = ast['layers'][index]
+        return layer['display_name'] or layer['name'].replace('_layer', '').upper()
+
+    @staticmethod
+    def binding_label(binding, behaviors):
+        """Короткая подпись привязки для сетки слоя"""
+        ref = binding[0]
+        params = [KeymapViewer.KEY_ALIASES.get(p, p[1:] if re.fullmatch(r'N\d', p) else p) for p in binding[1:]]
+        if ref == '&kp':
+            return " ".join(params)
+        if ref == '&trans':
+            return "▽"
+        if ref == '&none':
+            return "·"
+        if ref in KeymapViewer.LAYER_REFS:
+            return f"{ref[1:].upper()}{params[0] if params else ''}" + (f" {params[1]}" if len(params) > 1 else "")
+        behavior = behaviors.get(ref[1:])
+        if behavior and behavior['kind'] == 'hold-tap' and len(params) == 2:
+            return f"{params[1]}/{params[0]}"
+        return "".join(params) if params and ref in ('&bt', '&out', '&msc', '&mmv', '&mkp') else " ".join([ref[1:]] + params)
 
     @staticmethod
-    def _show_behaviors(content):
-        """Показать behaviors (hold-tap, tap-dance)"""
+    def _usages(ast, label):
+        """Где используется behavior: [(слой, позиция, привязка)] и комбо"""
+        ref = f"&{label}"
+        usages = []
+        for index, layer in enumerate(ast['layers']):
+            for position, binding in enumerate(layer['bindings']):
+                if binding[0] == ref:
+                    usages.append((KeymapViewer.layer_title(ast, index), position, binding))
+        for combo in ast['combos']:
+            for binding in combo['bindings']:
+                if binding[0] == ref:
+                    usages.append((combo['name'], None, binding))
+        return usages
+
+    @staticmethod
+    def _describe_behavior(behavior, binding):
+        """Что делает конкретная привязка behavior'а"""
+        params = binding[1:]
+        if behavior['kind'] == 'hold-tap' and len(params) == 2:
+            return f"tap={params[1]}, hold={params[0]}"
+        if behavior['kind'] == 'tap-dance':
+            return ", ".join(f"{n}×tap={' '.join(b[1:]) or b[0]}" for n, b in enumerate(behavior['bindings'], 1))
+        if behavior['kind'] == 'mod-morph' and len(behavior['bindings']) == 2:
+            base, morph = (" ".join(b[1:]) or b[0] for b in behavior['bindings'])
+            return f"обычно={base}, с {' '.join(behavior['mods'])}={morph}"
+        return " ".join(params)
+
+    @staticmethod
+    def _show_behaviors(ast):
+        """Показать behaviors (hold-tap, tap-dance, mod-morph...)"""
         print("━" * 80)
         print_color("🎛️  BEHAVIORS (Специальные поведения клавиш)", Colors.GREEN)
         print("━" * 80)
         print()
 
-        behaviors = []
+        for behavior in ast['behaviors']:
+            details = [behavior['kind']]
+            if behavior['tapping_term_ms'] is not None:
+                details.append(f"{behavior['tapping_term_ms']} мс")
+            if behavior['flavor']:
+                details.append(behavior['flavor'])
+            print_color(f"• {behavior['label']} ({', '.join(details)})", Colors.YELLOW)
+            for line in behavior['comment']:
+                print(f"   {line}")
 
-        # Hold-tap behaviors
-        if "bspc_del:" in content:
-            behaviors.append("• BSPC: tap=Backspace, hold=Delete")
-        if "esc_tilde:" in content:
-            behaviors.append("• ESC: tap=Escape, hold=Tilde (~)")
-
-        # Tap-dance behaviors
-        if "semi_colon:" in content:
-            behaviors.append("• ; (semicolon): tap=;, double-tap=:")
-        if "sqt_dqt:" in content:
-            behaviors.append("• ' (quote): tap=', double-tap=\"")
-
-        # Mod-morph behaviors
-        if "lshift_grave:" in content:
-            behaviors.append("• LSHIFT: обычно=Shift, с RSHIFT=` (grave)")
-        if "rshift_tilde:" in content:
-            behaviors.append("• RSHIFT: обычно=Shift, с LSHIFT=~ (tilde)")
-
-        for behavior in behaviors:
-            print(behavior)
+            usages = KeymapViewer._usages(ast, behavior['label'])
+            if not usages:
+                print_color("   ⚠️  Не используется ни в одном слое и комбо", Colors.YELLOW)
+            for where, position, binding in usages:
+                place = f"{where}[{position}]" if position is not None else where
+                print(f"   → {place}: {KeymapViewer._describe_behavior(behavior, binding)}")
         print()
 
     @staticmethod
-    def _show_combos(content):
+    def _show_combos(ast):
         """Показать combos (комбинации клавиш)"""
         print("━" * 80)
         print_color("🔀 COMBOS (Комбинации клавиш)", Colors.GREEN)
         print("━" * 80)
         print()
 
-        combos = []
-
-        if "combo_esc" in content:
-            combos.append("• J + K → Escape (с задержкой 150мс)")
-        if "combo_lock" in content:
-            combos.append("• LSHIFT + Lower + Raise → Заблокировать клавиатуру 🔒")
-        if "combo_unlock" in content:
-            combos.append("• RSHIFT + Lower + Raise → Разблокировать клавиатуру 🔓")
-        if "combo_delete_word" in content:
-            combos.append("• ALT + BSPC → Удалить слово (Option+Backspace)")
-
-        for combo in combos:
-            print(combo)
+        behaviors = {b['label']: b for b in ast['behaviors']}
+        base = ast['layers'][0]['bindings'] if ast['layers'] else []
+        for combo in ast['combos']:
+            keys = []
+            for position in combo['key_positions']:
+                if position is not None and position < len(base):
+                    keys.append(f"{KeymapViewer.binding_label(base[position], behaviors)}({position})")
+                else:
+                    keys.append(f"#{position}")
+            action = ", ".join(KeymapViewer.binding_label(b, behaviors) for b in combo['bindings'])
+            details = []
+            if combo['timeout_ms'] is not None:
+                details.append(f"окно {combo['timeout_ms']} мс")
+            if combo['require_prior_idle_ms'] is not None:
+                details.append(f"пауза перед {combo['require_prior_idle_ms']} мс")
+            if combo['layers']:
+                details.append("слои: " + ", ".join(KeymapViewer.layer_title(ast, i) for i in combo['layers']))
+            print_color(f"• {' + '.join(keys)} → {action}", Colors.YELLOW)
+            print(f"   {combo['name']}: {'; '.join(details)}")
+            for line in combo['comment']:
+                print(f"   {line}")
         print()
 
     @staticmethod
-    def _show_layers(content):
+    def _show_layers(ast):
         """Показать слои клавиатуры"""
         print("━" * 80)
         print_color("📑 СЛОИ КЛАВИАТУРЫ", Colors.GREEN)
         print("━" * 80)
         print()
 
-        layers = [
-            {
-                'name': 'default_layer',
-                'title': '🔵 СЛОЙ 0: DEFAULT (Основной)',
-                'description': 'Обычная раскладка QWERTY с модификаторами'
-            },
-            {
-                'name': 'lower_layer',
-                'title': '🟡 СЛОЙ 1: LOWER (Символы и навигация)',
-                'description': 'F-клавиши, цифры, символы, стрелки'
-            },
-            {
-                'name': 'raise_layer',
-                'title': '🟢 СЛОЙ 2: RAISE (Bluetooth и мышь)',
-                'description': 'Bluetooth профили, мышь, медиа-клавиши'
-            },
-            {
-                'name': 'lock_layer',
-                'title': '🔴 СЛОЙ 3: LOCK (Блокировка)',
-                'description': 'Все клавиши заблокированы (только unlock комбо работает)'
-            }
-        ]
+        behaviors = {b['label']: b for b in ast['behaviors']}
+        width = KeymapViewer.CELL_WIDTH
+        for index, layer in enumerate(ast['layers']):
+            print_color(f"СЛОЙ {index}: {KeymapViewer.layer_title(ast, index)} ({layer['name']})", Colors.YELLOW)
+            for line in layer['comment']:
+                # Таблицу индексов из комментария заменяет сетка ниже
+                if not re.match(r'^\d+\s', line) and not line.startswith("Индексы"):
+                    print(f"   ℹ️  {line}")
 
-        for layer in layers:
-            print_color(layer['title'], Colors.YELLOW)
-            print(f"   {layer['description']}")
-
-            # Пытаемся найти комментарии о слое
-            layer_start = content.find(f"{layer['name']} {{")
-            if layer_start != -1:
-                # Ищем комментарии перед слоем
-                lines_before = content[:layer_start].split('\n')[-20:]
-                for line in lines_before:
-                    if '//' in line and any(x in line.lower() for x in ['индексы', 'hold-tap', 'tap-dance', 'combo']):
-                        comment = line.split('//')[-1].strip()
-                        if comment and len(comment) > 10:
-                            print(f"   ℹ️  {comment}")
+            position = 0
+            for count in layer['rows'] or [len(layer['bindings'])]:
+                row = layer['bindings'][position:position + count]
+                cells = [KeymapViewer.binding_label(b, behaviors)[:width].ljust(width) for b in row]
+                print("   " + " ".join(cells).rstrip())
+                position += count
             print()
 
         # Показываем как переключаться между слоями
@@ -695,10 +5558,18 @@ class KeymapViewer:
         print_color("🔄 ПЕРЕКЛЮЧЕНИЕ СЛОЕВ", Colors.BLUE)
         print("━" * 80)
         print()
-        print("• Lower (слой 1): удерживай левую нижнюю кнопку большого пальца")
-        print("• Raise (слой 2): удерживай правую нижнюю кнопку большого пальца")
-        print("• Lock (слой 3): LSHIFT + Lower + Raise (блокировка)")
-        print("• Unlock: RSHIFT + Lower + Raise (разблокировка)")
+        for target in range(1, len(ast['layers'])):
+            ways = []
+            for index, layer in enumerate(ast['layers']):
+                for position, binding in enumerate(layer['bindings']):
+                    if binding[0] in KeymapViewer.LAYER_REFS and binding[1:2] == [str(target)]:
+                        ways.append(f"{binding[0][1:]} на клавише {position} (слой {KeymapViewer.layer_title(ast, index)})")
+            for combo in ast['combos']:
+                for binding in combo['bindings']:
+                    if binding[0] in KeymapViewer.LAYER_REFS and binding[1:2] == [str(target)]:
+                        keys = " + ".join(str(p) for p in combo['key_positions'])
+                        ways.append(f"{binding[0][1:]} комбо {combo['name']} ({keys})")
+            print(f"• {KeymapViewer.layer_title(ast, target)} (слой {target}): " + ("; ".join(ways) or "не переключается"))
         print()
 
 # ===== CLI =====
@@ -711,25 +5582,75 @@ def show_help():
     print()
     print("Команды:")
     print("  download  - скачать последнюю прошивку (пропускает если уже скачана)")
+    print("              --watch - следить за CI и скачивать новые сборки сразу по готовности")
     print("  version   - показать версию скачанной прошивки")
+    print("  builds    - список сборок в локальном хранилище")
+    print("  build     - собрать матрицу build.yaml локально (неизменившиеся цели из кэша)")
+    print("  use REF   - переключиться на сборку (тег, коммит или run ID) без скачивания")
+    print("  stats     - длительность фаз прошивки/скачивания (p50/p95/p99 по всем сессиям)")
+    print("  history   - история прошивок: когда, какая половинка, сколько заняло")
     print("  layout    - показать раскладку клавиатуры (все слои)")
+    print("  lint      - проверить keymap: пересечения комбо, тайминги, недостижимые слои")
     print("  all       - прошить обе половины (правую → левую)")
     print("  left      - только левую половину")
     print("  right     - только правую половину")
     print("  btclear   - очистить BT-пары и перепрошить обе половины")
+    print("  batch M   - пакетная прошивка партии плат по манифесту M (JSON)")
+    print("  station T - режим станции: прошивать образ T (left/right/reset)")
+    print("              на все подключаемые контроллеры параллельно")
+    print("  bench     - замер right/all/btclear на симуляторе bootloader'а (без железа)")
+    print("  latency T - задержка нажатий от combos/hold-tap/tap-dance на трассе T")
+    print("              (строки 't_ms позиция p|r', pc/ph - задуманное комбо/удержание)")
+    print("  sweep C.. - подбор таймингов keymap на корпусе трасс C (файлы или каталоги):")
+    print("              задержка против ложных срабатываний, результаты кэшируются")
     print()
     print("Опции:")
-    print("  --force   - принудительное скачивание/отключение предупреждений")
+    print("  --force   - принудительное скачивание/сборка, отключение предупреждений")
+    print("  --profile - в конце показать время внешних вызовов")
+    print("  --reflash - прошивать, даже если по журналу образ уже на контроллере")
+    print("  --update  - (all, left, right, btclear) пока ждем диск, проверить и скачать в фоне")
+    print("              новую сборку CI; если успеет до записи - прошить ее")
+    print("  --direct  - писать образ прямо на автосмонтированный NICENANO мимо кеша ОС,")
+    print("              без unmount/mount/eject и без sudo (также для bench)")
+    print("  --metrics F - сохранить сводку по фазам в F (формат OpenMetrics)")
+    print("  --report F  - (batch, bench, latency, sweep) сохранить отчет в F (JSON)")
+    print("  --emit F    - (latency) записать выданные нажатия в F")
+    print("  --keymap F  - (lint, latency, sweep) другой keymap вместо config/sofle.keymap")
+    print("  --grid G    - (sweep) сетка 'ключ=v1,v2;...', ключ 'имя.поле' или '*.поле',")
+    print("                значение в мс или xK от текущего (по умолчанию tapping/timeout/idle)")
+    print("  --top N     - (sweep) сколько лучших точек показать")
+    print("  --build-cmd C - (build) команда сборки элемента матрицы, подстановки")
+    print("                {board} {shield} {cmake_args} {config} {build_dir} {output}")
+    print("  --count N   - (station) остановиться после N устройств")
+    print("  --interval S - (download --watch) начальный интервал опроса без активных сборок, сек")
+    print("  --older-than V - (history) контроллеры, на которых стоит сборка старше тега V")
+    print("  --device S  - (history) только контроллер S (идентификатор или серийный номер)")
+    print("  --limit N   - (history) сколько последних прошивок показать")
+    print("  --workers N - (station) число параллельных прошивок; (sweep, build) число процессов")
+    print("  --rounds N  - (bench) раундов на сценарий")
+    print("  --delay S   - (bench) задержка появления диска после подключения, сек")
+    print("  --fail-unmount N - (bench) первые N (до 2) unmount каждого диска с ошибкой")
+    print("  --improper  - (bench) перезагрузка до eject ('диск извлечен неправильно')")
+    print("  --verbose   - (bench) показывать вывод прошивки")
     print()
 
 def main():
     """Главная функция"""
+    # Внутренний режим: привилегированный помощник, запущенный через sudo
+    if len(sys.argv) == 6 and sys.argv[1] == "--privileged-helper":
+        run_privileged_helper(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5])
+        return
+
     if len(sys.argv) < 2:
         show_help()
         sys.exit(0)
 
     command = sys.argv[1]
     force_mode = '--force' in sys.argv
+    if '--profile' in sys.argv:
+        atexit.register(EXECUTOR.print_report)
+    TELEMETRY.command = command
+    atexit.register(TELEMETRY.flush)
 
     # Команды без sudo
     if command == "version":
@@ -740,31 +5661,177 @@ def main():
         KeymapViewer.show_layout()
         return
 
+    if command == "builds":
+        GitHubFirmware.list_builds()
+        return
+
+    if command == "stats":
+        TELEMETRY.print_stats()
+        return
+
+    if command == "history":
+        if not HISTORY.print_history(device=get_option('--device'), limit=int(get_option('--limit', 20)),
+                                     older_than=get_option('--older-than')):
+            sys.exit(1)
+        return
+
+    if command == "latency":
+        if len(sys.argv) < 3:
+            show_help()
+            sys.exit(1)
+        try:
+            ast = load_keymap(get_option('--keymap'))
+            trace = load_trace(sys.argv[2])
+        except (OSError, ValueError) as e:
+            print_color(f"❌ {e}", Colors.RED)
+            sys.exit(1)
+        emit_file = get_option('--emit')
+        with open(emit_file, 'w') if emit_file else contextlib.nullcontext() as out:
+            emit = (lambda t, key, delay, source: out.write(f"{t:.1f} {key} {delay:.1f} {source}\n")) if out else None
+            start = time.monotonic()
+            report = BehaviorEngine(ast, emit=emit).run(*trace)
+        print_latency_report(report, time.monotonic() - start)
+        report_file = get_option('--report')
+        if report_file:
+            Path(report_file).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+            print(f"💾 Отчет сохранен: {report_file}")
+        return
+
+    if command == "build":
+        try:
+            entries = parse_build_matrix()
+        except (OSError, ValueError) as e:
+            print_color(f"❌ {e}", Colors.RED)
+            sys.exit(1)
+        workers = get_option('--workers')
+        builder = LocalBuilder(command=get_option('--build-cmd'), workers=int(workers) if workers else None)
+        start = time.monotonic()
+        key = builder.run(entries, force=force_mode)
+        if not key:
+            sys.exit(1)
+        store = FirmwareStore()
+        print_color(f"✅ Сборка {key} за {time.monotonic() - start:.1f} сек активирована:", Colors.GREEN)
+        for uf2 in sorted((store.builds_dir / key).glob("*.uf2")):
+            print(f"   {uf2.name}")
+        print()
+        GitHubFirmware.show_version(store)
+        return
+
+    if command == "lint":
+        try:
+            start = time.monotonic()
+            linter = KeymapLinter(load_keymap(get_option('--keymap')))
+            linter.run()
+        except (OSError, KeymapSyntaxError) as e:
+            print_color(f"❌ {e}", Colors.RED)
+            sys.exit(1)
+        if linter.print_report(time.monotonic() - start):
+            sys.exit(1)
+        return
+
+    if command == "sweep":
+        try:
+            ast = load_keymap(get_option('--keymap'))
+            traces = sweep_corpus(get_arguments(flags=('--force', '--profile')))
+            points = sweep_points(get_option('--grid', SWEEP_DEFAULT_GRID), ast)
+        except (OSError, ValueError) as e:
+            print_color(f"❌ {e}", Colors.RED)
+            sys.exit(1)
+        workers = get_option('--workers')
+        sweep = ParameterSweep(ast, traces, points, workers=int(workers) if workers else None)
+        ranked = sweep.run()
+        ParameterSweep.print_ranking(ranked, top=int(get_option('--top', 15)))
+        report_file = get_option('--report')
+        if report_file:
+            Path(report_file).write_text(json.dumps(ranked, indent=2, ensure_ascii=False))
+            print(f"💾 Отчет сохранен: {report_file}")
+        return
+
+    if command == "bench":
+        benchmark = FlashBenchmark(
+            rounds=int(get_option('--rounds', 3)),
+            verbose='--verbose' in sys.argv,
+            direct='--direct' in sys.argv,
+            appear_delay=float(get_option('--delay', 0.2)),
+            unmount_failures=min(int(get_option('--fail-unmount', 0)), 2),
+            improper_eject='--improper' in sys.argv
+        )
+        ok, report = benchmark.run()
+        report_file = get_option('--report')
+        if report_file:
+            Path(report_file).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+            print(f"💾 Отчет сохранен: {report_file}")
+        if not ok:
+            sys.exit(1)
+        return
+
+    if command == "use":
+        if len(sys.argv) < 3:
+            show_help()
+            sys.exit(1)
+        if not GitHubFirmware.use_build(sys.argv[2]):
+            sys.exit(1)
+        return
+
     if command == "download":
-        sudo_mgr = SudoManager()
-        if not sudo_mgr.load_password():
+        try:
+            if '--watch' in sys.argv:
+                GitHubFirmware.watch(float(get_option('--interval', WATCH_IDLE_INTERVAL)))
+            else:
+                GitHubFirmware.download_firmware(force=force_mode)
+        except FirmwareError as e:
+            print_color(f"❌ {e}", Colors.RED)
+            if e.hint:
+                print_color(f"   {e.hint}", Colors.BLUE)
             sys.exit(1)
-        GitHubFirmware.download_firmware(force=force_mode)
         return
 
-    # Команды с прошивкой
-    sudo_mgr = SudoManager()
-    if not sudo_mgr.load_password():
-        sys.exit(1)
+    # Проверка обновления идет в фоне с самого старта: пока вводят пароль и ждут диск
+    update = None
+    if '--update' in sys.argv and command in ("all", "left", "right", "btclear"):
+        update = UpdatePrefetch().start()
+
+    # Команды с прошивкой (в режиме --direct sudo не нужен: диск уже смонтирован системой)
+    direct = '--direct' in sys.argv
+    sudo_mgr = None
+    if not direct:
+        sudo_mgr = SudoManager()
+        if not sudo_mgr.load_password():
+            sys.exit(1)
 
     print(f"{timestamp()} - 🚀 Автоматическая прошивка Sofle V2")
 
-    flasher = Flasher(sudo_mgr, force_mode)
+    flasher = Flasher(sudo_mgr, force_mode, reflash='--reflash' in sys.argv, direct=direct)
     firmware = flasher.find_firmware()
+    flasher.update = update
+    if update:
+        atexit.register(update.print_summary)
+        print_color("🌐 Проверяю обновление прошивки в фоне (--update)", Colors.BLUE)
 
     if command == "all":
         flasher.flash_all(firmware)
     elif command == "left":
-        flasher.flash_half(firmware['left'], "левую половину")
+        flasher.flash_half(firmware['left'], "левую половину", target='left')
     elif command == "right":
-        flasher.flash_half(firmware['right'], "правую половину")
+        flasher.flash_half(firmware['right'], "правую половину", target='right')
     elif command == "btclear":
         flasher.clear_btpairs(firmware)
+    elif command == "batch":
+        if len(sys.argv) < 3:
+            show_help()
+            sys.exit(1)
+        if not BatchRunner(flasher, firmware, sys.argv[2]).run():
+            sys.exit(1)
+    elif command == "station":
+        target = sys.argv[2] if len(sys.argv) > 2 else None
+        if target not in FIRMWARE_TARGETS or not firmware[target]:
+            show_help()
+            sys.exit(1)
+        count = get_option('--count')
+        station = FlashStation(flasher, firmware[target], target,
+                               workers=int(get_option('--workers', STATION_WORKERS)))
+        if not station.run(count=int(count) if count else None):
+            sys.exit(1)
     else:
         show_help()
         sys.exit(1)
@@ -0,0 +1,1032 @@
+#!/usr/bin/env python3
+"""Тесты flash_sofle.py против локальной замены GitHub API (make test).
+
+Сеть не нужна: FakeGitHub - http.server на 127.0.0.1, клиент
+направляется на него через base_url (как SOFLE_GITHUB_API). HOME
+подменяется временным каталогом до импорта модуля, поэтому хранилище,
+кеши и журналы пользователя не затрагиваются.
+"""
+
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import urllib.parse
+import zipfile
+from array import array
+from pathlib import Path
+
+os.environ['HOME'] = tempfile.mkdtemp(prefix="sofle-test-home-")
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import flash_sofle as fs  # noqa: E402
+
+# ===== Замена GitHub API =====
+class FakeGitHub:
+    """Локальный HTTP-сервер вместо api.github.com.
+
+    routes: путь -> bytes (отдается как есть), dict/list (JSON с ETag и
+    поддержкой If-None-Match) или callable(handler) для особых случаев.
+    requests - список (путь, заголовки, статус ответа); connections -
+    адреса клиентских соединений (по ним видно переиспользование пула).
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = set()
+        self.headers = {}  # дополнительные заголовки каждого ответа
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b'', headers=None):
+                fake.requests.append((self.path, dict(self.headers), status))
+                self.send_response(status)
+                for key, value in dict(fake.headers, **(headers or {})).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.connections.add(self.client_address)
+                route = fake.routes.get(urllib.parse.urlsplit(self.path).path)
+                if route is None:
+                    return self.send(404, b'{}')
+                if callable(route):
+                    return route(self)
+                if isinstance(route, bytes):
+                    return self.send(200, route, {'Content-Type': 'application/octet-stream'})
+                body = json.dumps(route).encode()
+                etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send(304, b'', {'ETag': etag})
+                self.send(200, body, {'ETag': etag, 'Content-Type': 'application/json'})
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def statuses(self, path):
+        return [status for p, _, status in self.requests if urllib.parse.urlsplit(p).path == path]
+
+# ===== Вспомогательное =====
+class _Unseekable(io.RawIOBase):
+    """Поток без seek: zipfile пишет дескрипторы данных после каждого элемента"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+def make_zip(members, method=zipfile.ZIP_DEFLATED, descriptors=False):
+    """zip из {путь: байты}; descriptors=True - с дескрипторами данных (флаг 0x8)"""
+    if descriptors:
+        out = _Unseekable()
+        with zipfile.ZipFile(out, 'w', method) as z:
+            for name, data in members.items():
+                with z.open(name, 'w') as f:
+                    f.write(data)
+        return bytes(out.data)
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', method) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    return out.getvalue()
+
+def uf2_bytes(target, size):
+    """Синтетический UF2-образ (как у сборки) в байтах"""
+    path = Path(tempfile.mkdtemp()) / f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk.uf2"
+    return fs.make_test_uf2(path, size).read_bytes()
+
+# ===== Проверка UF2 (user-003) =====
+class ValidateUf2Test(unittest.TestCase):
+    def image(self, target='left', size=8192, **kwargs):
+        path = Path(tempfile.mkdtemp()) / f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk.uf2"
+        return fs.make_test_uf2(path, size, **kwargs)
+
+    def errors(self, path, target='left'):
+        return fs.validate_uf2(path, target)['errors']
+
+    def test_valid_image(self):
+        path = self.image()
+        report = fs.validate_uf2(path, 'left')
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['blocks'], 16)
+        self.assertEqual(report['sha256'], hashlib.sha256(path.read_bytes()).hexdigest())
+
+    def test_truncated(self):
+        path = self.image()
+        path.write_bytes(path.read_bytes()[:-100])
+        errors = self.errors(path)
+        self.assertEqual(len(errors), 1)
+        self.assertIn("обрезан", errors[0])
+
+    def test_bad_magic(self):
+        path = self.image()
+        data = bytearray(path.read_bytes())
+        data[fs.UF2_BLOCK_SIZE * 3] ^= 0xFF  # первое magic-число четвертого блока
+        data[-1] ^= 0xFF  # magic-число в конце последнего блока
+        path.write_bytes(bytes(data))
+        errors = self.errors(path)
+        self.assertTrue(any("в начале блоков" in e for e in errors))
+        self.assertTrue(any("в конце блоков" in e for e in errors))
+
+    def test_wrong_family(self):
+        errors = self.errors(self.image(family=0x68ED2B88))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("familyID", errors[0])
+
+    def test_non_contiguous_blocks(self):
+        path = self.image()
+        data = path.read_bytes()
+        block = fs.UF2_BLOCK_SIZE
+        # Блоки 2 и 3 поменяны местами
+        path.write_bytes(data[:2 * block] + data[3 * block:4 * block] + data[2 * block:3 * block] + data[4 * block:])
+        errors = self.errors(path)
+        self.assertEqual(errors, ["нарушена последовательность номеров блоков"])
+
+    def test_half_mismatch(self):
+        errors = self.errors(self.image('left'), target='right')
+        self.assertEqual(len(errors), 1)
+        self.assertIn("не для 'right'", errors[0])
+        self.assertIn("это образ 'left'", errors[0])
+        self.assertEqual(self.errors(self.image('right'), target='right'), [])
+
+# ===== Потоковая распаковка артефактов (user-019) =====
+class ExtractUf2StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.dest = Path(tempfile.mkdtemp())
+
+    def extract(self, archive):
+        return fs.extract_uf2_stream(io.BytesIO(archive), self.dest)
+
+    def check(self, extracted, members):
+        for name, data in members.items():
+            base = name.rsplit('/', 1)[-1]
+            path, digest = extracted[base]
+            self.assertEqual(path.read_bytes(), data)
+            self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+
+    def test_stored_and_deflate(self):
+        for method in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with self.subTest(method=method):
+                self.dest = Path(tempfile.mkdtemp())
+                members = {'sofle_left.uf2': os.urandom(40000), 'README.txt': b"x" * 100}
+                extracted = self.extract(make_zip(members, method))
+                self.assertEqual(set(extracted), {'sofle_left.uf2'})
+                self.check(extracted, {'sofle_left.uf2': members['sofle_left.uf2']})
+
+    def test_data_descriptors(self):
+        members = {'sofle_right.uf2': os.urandom(70000), 'zephyr/zmk.elf': os.urandom(90000),
+                   'settings_reset.uf2': b"\x00" * 50000}
+        extracted = self.extract(make_zip(members, descriptors=True))
+        self.assertEqual(set(extracted), {'sofle_right.uf2', 'settings_reset.uf2'})
+        self.check(extracted, {k: v for k, v in members.items() if k.endswith('.uf2')})
+
+    def test_nested_paths(self):
+        members = {'build/out/zephyr/sofle_left.uf2': os.urandom(30000)}
+        extracted = self.extract(make_zip(members))
+        self.assertEqual(list(extracted), ['sofle_left.uf2'])
+        self.check(extracted, members)
+        self.assertEqual([p.name for p in self.dest.iterdir()], ['sofle_left.uf2'])
+
+    def test_crc_mismatch_leaves_no_file(self):
+        archive = bytearray(make_zip({'sofle_left.uf2': os.urandom(20000)}, zipfile.ZIP_STORED))
+        archive[14] ^= 0xFF  # CRC-32 в локальном заголовке
+        with self.assertRaises(fs.ZipStreamError):
+            self.extract(bytes(archive))
+        self.assertEqual(list(self.dest.iterdir()), [])
+
+    def test_truncated_archive(self):
+        archive = make_zip({'sofle_left.uf2': os.urandom(20000)}, zipfile.ZIP_STORED)
+        with self.assertRaises(fs.ZipStreamError):
+            self.extract(archive[:5000])
+        self.assertEqual(list(self.dest.iterdir()), [])
+
+class FetchArtifactsTest(unittest.TestCase):
+    """Скачивание артефактов run'а через замену API с перенаправлением на хранилище"""
+
+    def setUp(self):
+        self.api = FakeGitHub()
+        self.addCleanup(self.api.close)
+        self.client = fs.GitHubClient(token="secret", base_url=self.api.base_url, cache_file=None)
+        self.addCleanup(self.client.close)
+        self.images = {t: uf2_bytes(t, 20000 + i * 512) for i, t in enumerate(fs.FIRMWARE_TARGETS)}
+        self.blob_auth = []
+        artifacts = []
+        for i, (target, data) in enumerate(self.images.items()):
+            name = f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk"
+            archive = make_zip({f"{name}.uf2": data, 'zephyr/zmk.elf': os.urandom(1000)}, descriptors=bool(i % 2))
+            zip_path = f"/repos/{fs.REPO}/actions/artifacts/{i}/zip"
+            artifacts.append({'name': name, 'expired': False,
+                              'archive_download_url': self.api.base_url + zip_path})
+
+            # Хранилище артефактов - другой хост (localhost вместо 127.0.0.1)
+            def redirect(handler, i=i):
+                handler.send(302, b'', {'Location': f"http://localhost:{self.api.port}/blob/{i}?sig=1"})
+
+            def blob(handler, archive=archive):
+                self.blob_auth.append(handler.headers.get('Authorization'))
+                handler.send(200, archive, {'Content-Type': 'application/zip'})
+
+            self.api.routes[zip_path] = redirect
+            self.api.routes[f"/blob/{i}"] = blob
+        self.api.routes[f"/repos/{fs.REPO}/actions/runs/7/artifacts"] = {'artifacts': artifacts}
+
+    def test_fetch_artifacts(self):
+        dest = Path(tempfile.mkdtemp())
+        files = fs.GitHubFirmware.fetch_artifacts(self.client, 7, dest)
+        self.assertEqual(len(files), len(self.images))
+        for target, data in self.images.items():
+            path, digest = files[f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk.uf2"]
+            self.assertEqual(path.read_bytes(), data)
+            self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(sorted(p.name for p in dest.iterdir()), sorted(p.name for p, _ in files.values()))
+
+    def test_redirect_drops_token(self):
+        fs.GitHubFirmware.fetch_artifacts(self.client, 7, Path(tempfile.mkdtemp()))
+        self.assertEqual(self.blob_auth, [None] * len(self.images))
+        api_auth = [headers.get('Authorization') for path, headers, _ in self.api.requests
+                    if not path.startswith('/blob/')]
+        self.assertTrue(api_auth)
+        self.assertTrue(all(auth == "Bearer secret" for auth in api_auth))
+
+# ===== GitHub API клиент (user-005) =====
+class GitHubClientTest(unittest.TestCase):
+    PATH = f"/repos/{fs.REPO}/actions/workflows/build.yml/runs"
+
+    def setUp(self):
+        self.api = FakeGitHub()
+        self.addCleanup(self.api.close)
+        self.api.routes[self.PATH] = {'workflow_runs': [{'id': 1}]}
+        self.cache_file = Path(tempfile.mkdtemp()) / "api_cache.json"
+
+    def client(self):
+        client = fs.GitHubClient(token="t", base_url=self.api.base_url, cache_file=self.cache_file)
+        self.addCleanup(client.close)
+        return client
+
+    def test_conditional_request(self):
+        client = self.client()
+        self.assertEqual(client.get_json(self.PATH), ({'workflow_runs': [{'id': 1}]}, False))
+        self.assertEqual(client.get_json(self.PATH), ({'workflow_runs': [{'id': 1}]}, True))
+        (_, first, _), (_, second, _) = self.api.requests
+        self.assertNotIn('If-None-Match', first)
+        self.assertIn('If-None-Match', second)
+        self.assertEqual(self.api.statuses(self.PATH), [200, 304])
+
+        # Изменившиеся данные приходят целиком, кеш обновляется
+        self.api.routes[self.PATH] = {'workflow_runs': [{'id': 2}]}
+        self.assertEqual(client.get_json(self.PATH), ({'workflow_runs': [{'id': 2}]}, False))
+
+    def test_etag_cache_persists(self):
+        client = self.client()
+        client.get_json(self.PATH)
+        client.close()
+        self.assertTrue(self.cache_file.exists())
+
+        data, not_modified = self.client().get_json(self.PATH)
+        self.assertTrue(not_modified)
+        self.assertEqual(data, {'workflow_runs': [{'id': 1}]})
+        self.assertEqual(self.api.statuses(self.PATH), [200, 304])
+
+    def test_retry_on_remote_disconnect(self):
+        calls = []
+        payload = json.dumps({'ok': True}).encode()
+
+        def flaky(handler):
+            calls.append(handler.path)
+            if len(calls) == 1:
+                # Соединение закрыто без ответа - как простаивающий keep-alive
+                handler.close_connection = True
+                return
+            handler.send(200, payload, {'Content-Type': 'application/json'})
+
+        self.api.routes['/flaky'] = flaky
+        data, _ = self.client().get_json('/flaky')
+        self.assertEqual(data, {'ok': True})
+        self.assertEqual(len(calls), 2)
+
+    def test_pool_reuses_connection(self):
+        client = self.client()
+        for _ in range(5):
+            client.get_json(self.PATH)
+        self.assertEqual(len(self.api.requests), 5)
+        self.assertEqual(len(self.api.connections), 1)
+
+# ===== Индекс тегов (user-006) =====
+class TagIndexTest(unittest.TestCase):
+    """/tags упорядочен по имени: новый тег может появиться не на первой странице"""
+
+    PATH = f"/repos/{fs.REPO}/tags"
+
+    def setUp(self):
+        self.api = FakeGitHub()
+        self.addCleanup(self.api.close)
+        self.client = fs.GitHubClient(token="t", base_url=self.api.base_url, cache_file=None)
+        self.addCleanup(self.client.close)
+        self.index = fs.TagIndex(Path(tempfile.mkdtemp()) / "tag_index.json")
+        self.index.PER_PAGE = 2
+        self.tags = [('v3.0.0', 'c3'), ('v2.0.0', 'c2'), ('v1.0.0', 'c1')]
+        self.api.routes[self.PATH] = self.pages
+
+    def pages(self, handler):
+        """Постраничная выдача с Link и ETag, как у GitHub"""
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+        page, size = int(query.get('page', ['1'])[0]), self.index.PER_PAGE
+        items = [{'name': name, 'commit': {'sha': sha}} for name, sha in self.tags[(page - 1) * size:page * size]]
+        body = json.dumps(items).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        headers = {'ETag': etag}
+        if page * size < len(self.tags):
+            headers['Link'] = f'<{self.api.base_url}{self.PATH}?per_page={size}&page={page + 1}>; rel="next"'
+        if handler.headers.get('If-None-Match') == etag:
+            return handler.send(304, b'', headers)
+        handler.send(200, body, headers)
+
+    def test_new_tag_on_later_page(self):
+        self.assertEqual(self.index.refresh(self.client), 3)
+        self.assertEqual(self.index.tag_for('c1'), 'v1.0.0')
+
+        # Первая страница та же, новый тег на второй
+        self.tags.insert(2, ('v2.5.0-rc', 'c25'))
+        self.assertEqual(self.index.refresh(self.client), 1)
+        self.assertEqual(self.index.sha_for('v2.5.0-rc'), 'c25')
+        self.assertEqual(self.index.tag_for('c1'), 'v1.0.0')
+        self.assertEqual(self.api.statuses(self.PATH), [200, 200, 304, 200])
+
+        # Без изменений - только 304
+        self.assertEqual(self.index.refresh(self.client), 0)
+        self.assertEqual(self.api.statuses(self.PATH)[4:], [304, 304])
+
+    def test_removed_tag_dropped(self):
+        self.tags.append(('v0.9.0', 'c1'))
+        self.assertEqual(self.index.refresh(self.client), 4)
+        self.assertEqual(self.index.commits['c1'], ['v0.9.0', 'v1.0.0'])
+
+        # Тег удален в репозитории (последняя страница стала короче)
+        del self.tags[2]
+        self.assertEqual(self.index.refresh(self.client), 1)
+        self.assertIsNone(self.index.sha_for('v1.0.0'))
+        self.assertEqual(self.index.tag_for('c1'), 'v0.9.0')
+        saved = json.loads(self.index.path.read_text())
+        self.assertNotIn('v1.0.0', saved['tags'])
+
+        del self.tags[2]
+        self.assertEqual(self.index.refresh(self.client), 1)
+        self.assertIsNone(self.index.tag_for('c1'))
+        self.assertNotIn('c1', self.index.commits)
+
+# ===== download --watch (user-024) =====
+class BuildWatcherTest(unittest.TestCase):
+    """Несколько опросов BuildWatcher с подменой sleep/clock"""
+
+    RUNS = f"/repos/{fs.REPO}/actions/workflows/build.yml/runs"
+    SHA = "c0ffee" + "0" * 34
+    NOW = 1_000_000.0
+
+    def setUp(self):
+        self.api = FakeGitHub()
+        self.addCleanup(self.api.close)
+        self.client = fs.GitHubClient(token="t", base_url=self.api.base_url,
+                                      cache_file=Path(tempfile.mkdtemp()) / "api_cache.json")
+        self.addCleanup(self.client.close)
+        self.store = fs.FirmwareStore(root=Path(tempfile.mkdtemp()))
+
+        self.images = {t: uf2_bytes(t, 20000 + i * 512) for i, t in enumerate(fs.FIRMWARE_TARGETS)}
+        artifacts = []
+        for i, (target, data) in enumerate(self.images.items()):
+            name = f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk"
+            zip_path = f"/repos/{fs.REPO}/actions/artifacts/{i}/zip"
+            self.api.routes[zip_path] = make_zip({f"{name}.uf2": data})
+            artifacts.append({'name': name, 'expired': False,
+                              'archive_download_url': self.api.base_url + zip_path})
+        self.api.routes[f"/repos/{fs.REPO}/actions/runs/5/artifacts"] = {'artifacts': artifacts}
+        self.api.routes[f"/repos/{fs.REPO}/tags"] = [{'name': 'v1.2.0', 'commit': {'sha': self.SHA}}]
+        self.set_run('queued', None)
+
+    def set_run(self, status, conclusion):
+        self.api.routes[self.RUNS] = {'workflow_runs': [{
+            'id': 5, 'status': status, 'conclusion': conclusion, 'head_sha': self.SHA,
+            'head_branch': 'main', 'created_at': '2026-10-18T10:00:00Z', 'display_title': 'keymap'}]}
+
+    def test_polls(self):
+        waits = []
+        # Изменения на стороне API после n-й паузы
+        steps = {
+            2: lambda: self.set_run('completed', 'success'),
+            10: lambda: self.api.headers.update({'X-RateLimit-Remaining': '5',
+                                                 'X-RateLimit-Reset': str(int(self.NOW) + 600)}),
+        }
+
+        def sleep(seconds):
+            waits.append(seconds)
+            steps.get(len(waits), lambda: None)()
+
+        watcher = fs.BuildWatcher(self.client, self.store, sleep=sleep,
+                                  clock=lambda: self.NOW, log=lambda *args: None)
+        downloaded = watcher.run(max_polls=12)
+
+        idle = fs.WATCH_IDLE_INTERVAL
+        backoff = [min(idle * fs.WATCH_BACKOFF ** n, fs.WATCH_MAX_INTERVAL) for n in range(1, 8)]
+        self.assertEqual(waits[:2], [fs.WATCH_ACTIVE_INTERVAL] * 2)  # сборка в очереди
+        self.assertEqual(waits[2], idle)  # список изменился - интервал сброшен
+        self.assertEqual(waits[3:10], backoff)
+        self.assertEqual(waits[8:10], [fs.WATCH_MAX_INTERVAL] * 2)
+        self.assertEqual(waits[10], 600)  # запас лимита исчерпан - ждем сброса
+        self.assertEqual(self.api.statuses(self.RUNS), [200, 304, 200] + [304] * 9)
+
+        key = fs.FirmwareStore.build_key({'commit': self.SHA, 'run_id': 5})
+        self.assertEqual(downloaded, [key])
+        self.assertEqual(self.store.current_key(), key)
+        info = self.store.build_info(key)
+        self.assertEqual(info['tag'], 'v1.2.0')
+        for target, data in self.images.items():
+            name = f"{fs.FIRMWARE_TARGETS[target]}-nice_nano_v2-zmk.uf2"
+            self.assertEqual(info['files'][name], hashlib.sha256(data).hexdigest())
+            self.assertEqual((self.store.builds_dir / key / name).read_bytes(), data)
+        self.assertEqual(json.loads(self.store.version_file.read_text())['run_id'], 5)
+        self.assertFalse(fs.VERSION_FILE.exists())  # хранилище по умолчанию не затронуто
+        # Артефакты скачаны один раз, дальше только 304
+        self.assertEqual(self.api.statuses(f"/repos/{fs.REPO}/actions/runs/5/artifacts"), [200])
+
+# ===== Парсер keymap (user-014) =====
+SAMPLE_KEYMAP = """
+#include <dt-bindings/zmk/keys.h>
+/ {
+    behaviors {
+        // Esc по тапу, Ctrl по удержанию
+        ht: hold_tap {
+            compatible = "zmk,behavior-hold-tap";
+            #binding-cells = <2>;
+            tapping-term-ms = <200>;
+            flavor = "balanced";
+            bindings = <&kp>, <&kp>;
+        };
+    };
+    keymap {
+        compatible = "zmk,keymap";
+        base {
+            display-name = "Base";
+            bindings = <
+                &kp A &ht LCTRL ESC
+                &mo 1 &kp LS(B)
+            >;
+        };
+    };
+};
+"""
+
+class KeymapParserTest(unittest.TestCase):
+    def test_tokenizer_error(self):
+        with self.assertRaises(fs.KeymapSyntaxError) as ctx:
+            fs.tokenize_keymap("/ {\n    a = <1>;\n    b = $;\n};")
+        self.assertEqual(ctx.exception.line, 3)
+
+    def test_parser_errors(self):
+        for text, line in (("/ {\n    node {\n        a = <1>;\n};", 1),
+                           ("/ {\n    a = <1>\n};", 3),
+                           ("/ {\n};\nfoo", 3)):
+            with self.subTest(text=text), self.assertRaises(fs.KeymapSyntaxError) as ctx:
+                fs.KeymapParser(text).parse()
+            self.assertEqual(ctx.exception.line, line)
+
+    def test_sample(self):
+        ast = fs.build_keymap_ast(fs.KeymapParser(SAMPLE_KEYMAP).parse())
+        [behavior] = ast['behaviors']
+        self.assertEqual((behavior['label'], behavior['kind'], behavior['flavor'], behavior['tapping_term_ms']),
+                         ('ht', 'hold-tap', 'balanced', 200))
+        self.assertEqual(behavior['comment'], ["Esc по тапу, Ctrl по удержанию"])
+        [layer] = ast['layers']
+        self.assertEqual(layer['display_name'], "Base")
+        self.assertEqual(layer['bindings'], [['&kp', 'A'], ['&ht', 'LCTRL', 'ESC'], ['&mo', '1'], ['&kp', 'LS(B)']])
+        self.assertEqual(layer['rows'], [2, 2])
+
+    def test_repo_keymaps(self):
+        keymaps = sorted(fs.CONFIG_DIR.glob("*.keymap"))
+        self.assertTrue(keymaps)
+        for path in keymaps:
+            with self.subTest(keymap=path.name):
+                ast = fs.build_keymap_ast(fs.KeymapParser(path.read_text()).parse())
+                self.assertTrue(ast['layers'])
+                keys = len(ast['layers'][0]['bindings'])
+                for layer in ast['layers']:
+                    self.assertEqual(len(layer['bindings']), keys, layer['name'])
+                    self.assertEqual(sum(layer['rows']), keys, layer['name'])
+                    self.assertTrue(all(b[0].startswith('&') for b in layer['bindings']))
+                for combo in ast['combos']:
+                    self.assertTrue(all(0 <= p < keys for p in combo['key_positions']), combo['name'])
+                labels = [b['label'] for b in ast['behaviors']]
+                self.assertEqual(len(labels), len(set(labels)))
+
+    def test_cache_invalidation(self):
+        path = Path(tempfile.mkdtemp()) / "test.keymap"
+        path.write_text(SAMPLE_KEYMAP)
+        with unittest.mock.patch.object(fs, 'KEYMAP_CACHE_FILE', path.with_name("cache.json")), \
+                unittest.mock.patch.object(fs, 'build_keymap_ast', wraps=fs.build_keymap_ast) as build:
+            first = fs.load_keymap(path)
+            self.assertEqual(fs.load_keymap(path), first)
+            self.assertEqual(build.call_count, 1)
+
+            # Изменилось содержимое (sha256) - разбор заново
+            path.write_text(SAMPLE_KEYMAP.replace('"Base"', '"Main"'))
+            self.assertEqual(fs.load_keymap(path)['layers'][0]['display_name'], "Main")
+            self.assertEqual(build.call_count, 2)
+            fs.load_keymap(path)
+            self.assertEqual(build.call_count, 2)
+
+            # Изменилась версия формата AST - тоже
+            with unittest.mock.patch.object(fs, 'KEYMAP_AST_VERSION', fs.KEYMAP_AST_VERSION + 1):
+                fs.load_keymap(path)
+                self.assertEqual(build.call_count, 3)
+                fs.load_keymap(path)
+                self.assertEqual(build.call_count, 3)
+
+# ===== Симулятор поведений (user-015) =====
+def trace(events):
+    """Трасса из [(t_ms, позиция, 'p'|'r')] в формате load_trace"""
+    events = sorted(events, key=lambda e: e[0])
+    return (array('d', [e[0] for e in events]), array('B', [e[1] for e in events]),
+            bytes(e[2] == 'p' for e in events), None)
+
+def hold_tap_ast(flavor, term=200):
+    """Позиция 0 - &ht LCTRL ESC, 1 и 2 - обычные клавиши"""
+    return {
+        'behaviors': [{'label': 'ht', 'kind': 'hold-tap', 'comment': [], 'line': 1, 'binding_cells': 2,
+                       'tapping_term_ms': term, 'flavor': flavor, 'mods': [], 'bindings': [['&kp'], ['&kp']]}],
+        'combos': [],
+        'layers': [{'name': 'base', 'display_name': None, 'comment': [], 'line': 1, 'rows': [3],
+                    'bindings': [['&ht', 'LCTRL', 'ESC'], ['&kp', 'A'], ['&kp', 'B']]}]
+    }
+
+class BehaviorEngineTest(unittest.TestCase):
+    def keys(self, flavor, events):
+        report = fs.BehaviorEngine(hold_tap_ast(flavor)).run(*trace(events))
+        return report, {k: v for k, v in report['keys'].items() if k in ('LCTRL', 'ESC')}
+
+    def test_tapping_term_edge(self):
+        for flavor in fs.BehaviorEngine.FLAVORS:
+            with self.subTest(flavor=flavor):
+                # Отпущен за 1 мс до tapping-term - tap у всех
+                _, keys = self.keys(flavor, [(0, 0, 'p'), (199, 0, 'r')])
+                self.assertEqual(keys, {'ESC': 1})
+
+                # Ровно на tapping-term: таймер уже сработал
+                report, keys = self.keys(flavor, [(0, 0, 'p'), (200, 0, 'r')])
+                expected = 'ESC' if flavor == 'tap-unless-interrupted' else 'LCTRL'
+                self.assertEqual(keys, {expected: 1})
+                self.assertEqual(report['sources']['ht']['max_ms'], 200)
+
+    def test_interrupt_before_term(self):
+        # Другая клавиша нажата и отпущена внутри tapping-term, потом отпущен hold-tap
+        events = [(0, 0, 'p'), (50, 1, 'p'), (100, 1, 'r'), (150, 0, 'r')]
+        expected = {'hold-preferred': 'LCTRL', 'balanced': 'LCTRL', 'tap-unless-interrupted': 'LCTRL',
+                    'tap-preferred': 'ESC'}
+        for flavor, key in expected.items():
+            with self.subTest(flavor=flavor):
+                report, keys = self.keys(flavor, events)
+                self.assertEqual(keys, {key: 1})
+                self.assertEqual(report['keys']['A'], 1)
+
+    def test_bulk_matches_per_event(self):
+        ast = fs.load_keymap()
+        rng = random.Random(15)
+        width = len(ast['layers'][0]['bindings'])
+        events, free_at, t = [], {}, 0.0
+        while len(events) < 6000:
+            t += rng.choice([2, 10, 30, 60, 120, 250])
+            position = rng.randrange(width)
+            if free_at.get(position, -1) >= t:
+                continue
+            hold = rng.choice([20, 80, 150, 400])
+            events += [(t, position, 'p'), (t + hold, position, 'r')]
+            free_at[position] = t + hold
+
+        bulk_runs = []
+        engine = fs.BehaviorEngine(ast)
+        plain_run = engine._plain_run
+        engine._plain_run = lambda *args: (bulk_runs.append(args[4] - args[3]), plain_run(*args))
+        batched = engine.run(*trace(events))
+        # emit включает пособытийную обработку всей трассы
+        per_event = fs.BehaviorEngine(ast, emit=lambda *args: None).run(*trace(events))
+
+        self.assertTrue(bulk_runs and max(bulk_runs) > 1)
+        self.assertEqual(batched, per_event)
+        self.assertEqual(batched['events'], len(events))
+
+# ===== Подбор таймингов (user-016) =====
+def sweep_ast():
+    ast = hold_tap_ast('balanced')
+    ast['behaviors'].append({'label': 'td', 'kind': 'tap-dance', 'comment': [], 'line': 2, 'binding_cells': 0,
+                             'tapping_term_ms': 180, 'flavor': None, 'mods': [],
+                             'bindings': [['&kp', 'A'], ['&kp', 'B']]})
+    ast['combos'].append({'name': 'combo_ab', 'comment': [], 'line': 3, 'key_positions': [1, 2],
+                          'timeout_ms': 50, 'require_prior_idle_ms': None, 'layers': [],
+                          'bindings': [['&kp', 'C']]})
+    return ast
+
+class SweepTest(unittest.TestCase):
+    def test_wildcard_and_scaling(self):
+        points = fs.sweep_points("*.tapping_term_ms=x0.5,x1,x1.25", sweep_ast())
+        self.assertEqual(points, [
+            {'ht.tapping_term_ms': 100, 'td.tapping_term_ms': 90},
+            {},
+            {'ht.tapping_term_ms': 250, 'td.tapping_term_ms': 225},
+        ])
+
+    def test_product_of_axes(self):
+        points = fs.sweep_points("ht.tapping_term_ms=150,x1; combo_ab.timeout_ms=x0.8,x2", sweep_ast())
+        self.assertEqual(points, [
+            {'combo_ab.timeout_ms': 40, 'ht.tapping_term_ms': 150},
+            {'combo_ab.timeout_ms': 100, 'ht.tapping_term_ms': 150},
+            {'combo_ab.timeout_ms': 40},
+            {'combo_ab.timeout_ms': 100},
+        ])
+
+    def test_points_equal_to_keymap_collapse(self):
+        self.assertEqual(fs.sweep_points("ht.tapping_term_ms=200,x1; combo_ab.timeout_ms=50", sweep_ast()), [{}])
+        # Разные записи одного значения - одна точка
+        self.assertEqual(fs.sweep_points("td.tapping_term_ms=90,x0.5,x1", sweep_ast()),
+                         [{'td.tapping_term_ms': 90}, {}])
+
+    def test_invalid_spec(self):
+        for spec in ("nope.tapping_term_ms=100", "*.require_prior_idle_ms=x1",
+                     "ht.tapping_term_ms=", "ht.tapping_term_ms=fast"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                fs.sweep_points(spec, sweep_ast())
+
+    def test_pareto_rank(self):
+        def point(name, latency, misfires, missed=0.0):
+            return {'params': {'name': name}, 'latency_ms': latency, 'misfire_rate': misfires, 'missed_rate': missed}
+
+        ranked = fs.ParameterSweep.rank([
+            point('slow_safe', 10, 0), point('dominated', 10, 5), point('fast', 2, 8),
+            point('middle', 5, 3), point('middle_twin', 5, 3, missed=1), point('worse_fast', 2, 9)])
+        self.assertEqual([(p['params']['name'], p['pareto']) for p in ranked], [
+            ('fast', True), ('middle', True), ('middle_twin', True), ('slow_safe', True),
+            ('worse_fast', False), ('dominated', False)])
+
+# ===== Анализ keymap (user-017) =====
+def lint_ast(layers, combos=()):
+    """AST из слоев (списки привязок) и комбо (имя, позиции, слои, привязка)"""
+    return {
+        'behaviors': [],
+        'layers': [{'name': f"layer{n}", 'display_name': None, 'comment': [], 'line': n, 'rows': [len(b)],
+                    'bindings': [binding.split() for binding in b]} for n, b in enumerate(layers)],
+        'combos': [{'name': name, 'comment': [], 'line': 1, 'key_positions': list(keys), 'timeout_ms': 50,
+                    'require_prior_idle_ms': None, 'layers': list(on), 'bindings': [binding.split()]}
+                   for name, keys, on, binding in combos]
+    }
+
+class KeymapLinterTest(unittest.TestCase):
+    BASE = ["&kp A", "&kp B", "&kp C", "&mo 1"]
+    LOWER = ["&kp N1", "&kp N2", "&kp N3", "&trans"]
+
+    def issues(self, ast, level):
+        return [(i['where'], i['message']) for i in fs.KeymapLinter(ast).run() if i['level'] == level]
+
+    def test_clean(self):
+        ast = lint_ast([self.BASE, self.LOWER], [('combo_ab', [0, 1], [], "&kp ESC")])
+        self.assertEqual(self.issues(ast, 'error'), [])
+        self.assertEqual(self.issues(ast, 'warning'), [])
+
+    def test_identical_combos(self):
+        ast = lint_ast([self.BASE, self.LOWER], [('first', [0, 1], [], "&kp ESC"), ('second', [1, 0], [0], "&kp TAB")])
+        [(where, message)] = self.issues(ast, 'error')
+        self.assertEqual(where, 'second')
+        self.assertIn("никогда не сработает", message)
+
+        # На разных слоях - не конфликт
+        ast = lint_ast([self.BASE, self.LOWER], [('first', [0, 1], [0], "&kp ESC"), ('second', [0, 1], [1], "&kp TAB")])
+        self.assertEqual(self.issues(ast, 'error'), [])
+        self.assertEqual(len(self.issues(ast, 'info')), 1)
+
+    def test_nested_combos(self):
+        ast = lint_ast([self.BASE, self.LOWER], [('pair', [0, 1], [], "&kp ESC"), ('triple', [0, 1, 2], [], "&kp TAB")])
+        self.assertEqual(self.issues(ast, 'error'), [])
+        [(where, message)] = self.issues(ast, 'warning')
+        self.assertEqual(where, 'pair')
+        self.assertIn("вложено в triple", message)
+
+    def test_unreachable_layer(self):
+        ast = lint_ast([["&kp A", "&kp B", "&kp C", "&kp D"], self.LOWER])
+        self.assertEqual(self.issues(ast, 'error'), [('layer1', "слой недостижим: на него нет &mo/&tog/&to/&lt")])
+
+        # Комбо базового слоя делает слой достижимым
+        ast = lint_ast([["&kp A", "&kp B", "&kp C", "&kp D"], self.LOWER], [('to_lower', [2, 3], [0], "&mo 1")])
+        self.assertEqual(self.issues(ast, 'error'), [])
+
+    def test_toggle_without_exit(self):
+        base = ["&kp A", "&kp B", "&kp C", "&tog 1"]
+        ast = lint_ast([base, ["&kp N1", "&kp N2", "&kp N3", "&kp N4"]])
+        [(where, message)] = self.issues(ast, 'error')
+        self.assertEqual(where, 'layer1')
+        self.assertIn("выключить нечем", message)
+
+        # &trans пропускает &tog 1 с базового слоя - выход есть
+        ast = lint_ast([base, self.LOWER])
+        self.assertEqual(self.issues(ast, 'error'), [])
+        [(where, message)] = self.issues(ast, 'info')
+        self.assertIn("только переключение", message)
+
+# ===== Конвейер прошивки (user-011) =====
+class FlashSequencerTest(unittest.TestCase):
+    """flash_all / clear_btpairs на SimulatedBootloader"""
+
+    BOARD = "nRF52840-nicenano"
+
+    def run_on_simulator(self, action, serials, plugs, seed=()):
+        """Порядок записи [(серийный номер, образ)]; seed - записи журнала (serial, half, тот же образ?)"""
+        sim = fs.SimulatedBootloader(appear_delay=0.05, reboot_delay=0.02, serials=serials)
+        self.addCleanup(sim.close)
+        watcher = fs.DriveWatcher(roots=[sim.volumes], ignore=[sim.mount_dir])
+        self.addCleanup(watcher.close)
+        ledger = fs.FlashLedger(fs.HistoryDB(sim.root / "history.db", ledger_file=None))
+        flasher = fs.Flasher(sim, force_mode=True, mount_dir=sim.mount_dir, watcher=watcher, devices=sim,
+                             ledger=ledger)
+        self.addCleanup(flasher.validator.shutdown)
+        # Образы разного размера: у одинаковых совпали бы дайджесты в журнале
+        firmware = {key: str(fs.make_test_uf2(sim.root / f"{prefix}-nice_nano_v2-zmk.uf2",
+                                              (16 + index) * fs.UF2_BLOCK_SIZE))
+                    for index, (key, prefix) in enumerate(fs.FIRMWARE_TARGETS.items())}
+        for serial, half, same in seed:
+            digest = flasher.image_digest(firmware[half]) if same else "0" * 64
+            ledger.record(f"{self.BOARD}:{serial}", half, digest, firmware[half])
+        sim.start(plugs)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            getattr(flasher, action)(firmware)
+        self.output = output.getvalue()
+        return [(sim.devices[name]['serial'], image.split('-')[0]) for name, image, _ in sim.flashed]
+
+    def test_flash_all_order(self):
+        self.assertEqual(self.run_on_simulator('flash_all', ['R1', 'L1'], 2),
+                         [('R1', 'sofle_right'), ('L1', 'sofle_left')])
+
+    def test_btclear_order(self):
+        flashed = self.run_on_simulator('clear_btpairs', ['R1', 'L1'], 4)
+        self.assertEqual(flashed, [('R1', 'settings_reset'), ('L1', 'settings_reset'),
+                                   ('R1', 'sofle_right'), ('L1', 'sofle_left')])
+
+    def test_match_half_swaps_steps(self):
+        # Первой подключена левая половинка: шаги меняются местами
+        seed = [('L1', 'left', False), ('R1', 'right', False)]
+        self.assertEqual(self.run_on_simulator('flash_all', ['L1', 'R1'], 2, seed),
+                         [('L1', 'sofle_left'), ('R1', 'sofle_right')])
+        self.assertIn("подключена другая половинка", self.output)
+
+    def test_btclear_swaps_main_steps(self):
+        # После reset журнал помнит половинку: основные шаги тоже меняются
+        seed = [('L1', 'left', False), ('R1', 'right', False)]
+        flashed = self.run_on_simulator('clear_btpairs', ['L1', 'R1'], 4, seed)
+        self.assertEqual(flashed, [('L1', 'settings_reset'), ('R1', 'settings_reset'),
+                                   ('L1', 'sofle_left'), ('R1', 'sofle_right')])
+
+    def test_already_flashed_half_skipped(self):
+        seed = [('R1', 'right', True), ('L1', 'left', False)]
+        self.assertEqual(self.run_on_simulator('flash_all', ['L1'], 1, seed), [('L1', 'sofle_left')])
+        self.assertIn("правую половину: образ уже записан", self.output)
+
+# ===== Бенчмарк на симуляторе (user-013) =====
+class FlashBenchmarkTest(unittest.TestCase):
+    def run_bench(self, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fs.FlashBenchmark(rounds=1, **options).run()
+
+    def test_scenarios_pass(self):
+        for options in ({}, {'direct': True}, {'unmount_failures': 1}):
+            with self.subTest(**options):
+                ok, report = self.run_bench(**options)
+                self.assertTrue(ok)
+                self.assertEqual(set(report['scenarios']), {name for name, _ in fs.FlashBenchmark.SCENARIOS})
+                for data in report['scenarios'].values():
+                    self.assertEqual(data['failed'], 0)
+                    self.assertIn('flash.copy', data['phases'])
+
+# ===== История прошивок (user-023) =====
+class HistoryDBTest(unittest.TestCase):
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.ledger_file = root / "flash_ledger.json"
+        self.db = fs.HistoryDB(root / "history.db", ledger_file=self.ledger_file)
+
+    def add_build(self, key, tag, digest):
+        self.db.record_build(key, {'tag': tag, 'run_id': key, 'commit': key * 8}, {f"{key}.uf2": digest})
+
+    def flash(self, device, digest, ok=True):
+        self.db.add_flash(device, 'left', 'left', digest, f"{digest}.uf2", 1.0, ok)
+
+    def test_latest_flash_per_device(self):
+        self.add_build('old', 'v1.0.0', 'a')
+        self.add_build('new', 'v1.2.0', 'b')
+        self.add_build('rebuild', 'v1.3.0', 'b')  # тот же образ в более новой сборке
+        for device, digest in (('dev1', 'a'), ('dev1', 'b'), ('dev2', 'b'), ('dev2', 'a'), ('dev3', 'c'),
+                               ('dev4', 'b')):
+            self.flash(device, digest)
+        self.flash('dev4', 'a', ok=False)  # неудачная прошивка не меняет состояние
+
+        self.assertEqual([r['device'] for r in self.db.devices_on_build('new')], ['dev1', 'dev4'])
+        self.assertEqual([r['device'] for r in self.db.devices_on_build('old')], ['dev2'])
+        # Контроллер без известной сборки (dev3) всегда "старше"
+        self.assertEqual([(r['device'], r['tag']) for r in self.db.older_than('v1.3.0')],
+                         [('dev2', 'v1.0.0'), ('dev3', None)])
+        self.assertEqual([(r['device'], r['tag']) for r in self.db.older_than('v2.0')],
+                         [('dev1', 'v1.3.0'), ('dev2', 'v1.0.0'), ('dev3', None), ('dev4', 'v1.3.0')])
+        self.assertEqual([r['device'] for r in self.db.older_than('v1.0.0')], ['dev3'])
+
+    def test_flash_committed_immediately(self):
+        self.flash('dev1', 'a')
+        with fs.sqlite3.connect(self.db.path) as other:
+            self.assertEqual(other.execute("SELECT device, digest FROM flashes").fetchall(), [('dev1', 'a')])
+
+    def test_json_ledger_imported_once(self):
+        entry = {'target': 'right', 'half': 'right', 'digest': 'd', 'file': "x.uf2", 'time': "2026-01-02T03:04:05"}
+        self.ledger_file.write_text(json.dumps({'B:S1': entry}))
+        ledger = fs.FlashLedger(self.db)
+        self.assertEqual(ledger.get('B:S1'), entry)
+        self.assertFalse(self.ledger_file.exists())
+
+        # Reset-образ не меняет половинку
+        ledger.record('B:S1', 'reset', 'r', "reset.uf2")
+        self.assertEqual(ledger.get('B:S1')['digest'], 'r')
+        self.assertEqual([(identity, e['half']) for identity, e in ledger.holders('right')], [('B:S1', 'right')])
+        self.assertIsNone(ledger.get('B:S2'))
+
+# ===== Журнал прошивок (user-020) =====
+class FlashLedgerSkipTest(unittest.TestCase):
+    """flash_device с записью журнала о подключенном контроллере"""
+
+    IDENTITY = "nRF52840-nicenano:S1"
+
+    def setUp(self):
+        self.sim = fs.SimulatedBootloader(appear_delay=0, reboot_delay=0.01, serials=['S1'])
+        self.addCleanup(self.sim.close)
+        self.image = fs.make_test_uf2(self.sim.root / "sofle_left-nice_nano_v2-zmk.uf2", 16 * fs.UF2_BLOCK_SIZE)
+        self.ledger = fs.FlashLedger(fs.HistoryDB(self.sim.root / "history.db", ledger_file=None))
+
+    def flash(self, recorded_digest, reflash=False, target='left'):
+        self.ledger.record(self.IDENTITY, 'left', recorded_digest, self.image)
+        watcher = fs.DriveWatcher(roots=[self.sim.volumes], ignore=[self.sim.mount_dir])
+        self.addCleanup(watcher.close)
+        flasher = fs.Flasher(self.sim, force_mode=True, mount_dir=self.sim.mount_dir, watcher=watcher,
+                             devices=self.sim, ledger=self.ledger, reflash=reflash)
+        self.addCleanup(flasher.validator.shutdown)
+        self.sim.start(1)
+        volume = watcher.wait_appeared(timeout=5)
+        self.assertIsNotNone(volume)
+        return flasher.flash_device(volume, str(self.image), self.sim.mount_dir / "slot0", target=target)
+
+    def test_same_digest_skipped(self):
+        result = self.flash(fs.image_digest(self.image))
+        self.assertTrue(result['ok'])
+        self.assertTrue(result['skipped'])
+        self.assertEqual(self.sim.flashed, [])
+
+    def test_different_digest_reflashed(self):
+        self.assert_written(self.flash("0" * 64))
+        self.assertEqual(self.ledger.get(self.IDENTITY)['digest'], fs.image_digest(self.image))
+
+    def assert_written(self, result):
+        self.assertTrue(result['ok'])
+        self.assertFalse(result['skipped'])
+        self.assertTrue(self.sim.wait_gone(result['device'], timeout=5))
+        self.assertEqual(len(self.sim.flashed), 1)
+
+    def test_reflash_ignores_ledger(self):
+        self.assert_written(self.flash(fs.image_digest(self.image), reflash=True))
+
+    def test_reset_never_skipped(self):
+        self.assert_written(self.flash(fs.image_digest(self.image), target='reset'))
+
+# ===== Привилегированный помощник (user-007) =====
+class FakeDevices:
+    """Вместо HOST_DEVICES: bootloader - только sdz, операции записываются"""
+
+    def __init__(self, volume):
+        self.volume = volume
+        self.calls = []
+
+    def is_bootloader(self, device):
+        return device == 'sdz'
+
+    def for_mount(self, path):
+        return 'sdz' if Path(path) == self.volume else 'sda'
+
+    def unmount(self, path, force=False):
+        self.calls.append(('unmount', path))
+        return True, '', ''
+
+    def mount(self, device, target, uid=None, gid=None):
+        self.calls.append(('mount', device, target))
+        return True, '', ''
+
+    def eject(self, path):
+        self.calls.append(('eject', path))
+        return True, '', ''
+
+class PrivilegedHelperTest(unittest.TestCase):
+    def setUp(self):
+        root = Path(os.path.realpath(tempfile.mkdtemp()))
+        self.mount_dir = root / "mount"
+        (self.mount_dir / "slot0").mkdir(parents=True)
+        self.volume = root / "NICENANO"
+        self.volume.mkdir()
+        self.devices = FakeDevices(self.volume)
+        patcher = unittest.mock.patch.object(fs, 'HOST_DEVICES', self.devices)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def execute(self, **request):
+        return fs._helper_execute(request, self.mount_dir)
+
+    def test_allowed_operations(self):
+        slot = str(self.mount_dir / "slot0")
+        self.assertTrue(self.execute(op='unmount', path=str(self.volume))['ok'])
+        self.assertTrue(self.execute(op='mount', device="/dev/sdz", target=slot, uid=1000, gid=1000)['ok'])
+        self.assertTrue(self.execute(op='eject', path=slot)['ok'])
+        self.assertEqual(self.devices.calls, [('unmount', str(self.volume)), ('mount', "/dev/sdz", slot),
+                                              ('eject', slot)])
+
+    def test_rejected_operations(self):
+        outside = tempfile.mkdtemp()
+        os.symlink(outside, self.mount_dir / "escape")
+        rejected = [
+            dict(op='write', src="/etc/passwd", dest_dir=outside),
+            dict(op='mount', device="/dev/sda", target=str(self.mount_dir / "slot0")),
+            dict(op='mount', device="/dev/sdz", target=outside),
+            dict(op='mount', device="/dev/sdz", target=str(self.mount_dir / "escape")),
+            dict(op='unmount', path="/"),
+            dict(op='unmount', path="/dev/sda"),
+            dict(op='eject', path=outside),
+        ]
+        for request in rejected:
+            with self.subTest(request=request):
+                result = self.execute(**request)
+                self.assertFalse(result['ok'])
+                self.assertTrue(result['err'])
+        self.assertEqual(self.devices.calls, [])
+
+    def test_stops_when_start_connection_closes(self):
+        sock_path = Path(tempfile.mkdtemp()) / "helper.sock"
+        server = threading.Thread(target=fs.run_privileged_helper,
+                                  args=(str(sock_path), os.getpid(), os.getuid(), str(self.mount_dir)))
+        server.start()
+        self.addCleanup(server.join, 5)
+
+        def connect():
+            for _ in range(200):
+                try:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.connect(str(sock_path))
+                    return sock
+                except OSError:
+                    sock.close()
+                    threading.Event().wait(0.01)
+            self.fail("помощник не запустился")
+
+        def call(sock, request):
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            return json.loads(sock.makefile('rb').readline())
+
+        owner = connect()
+        other = connect()
+        self.assertEqual(call(owner, {'ops': [{'op': 'ping'}]})['results'][0]['out'], 'pong')
+
+        # Чужое соединение не останавливает помощника
+        self.assertEqual(call(other, {'shutdown': True}), {'results': []})
+        other.close()
+        self.assertEqual(call(owner, {'ops': [{'op': 'ping'}]})['results'][0]['out'], 'pong')
+
+        owner.close()
+        server.join(5)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(sock_path.exists())
+
+if __name__ == '__main__':
+    unittest.main()